@@ -1,4 +1,4 @@
 from .markov import Markov
 
 async def setup(bot):
-    bot.add_cog(Markov(bot))
+    await bot.add_cog(Markov(bot))
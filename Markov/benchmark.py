@@ -0,0 +1,312 @@
+""" Benchmark Markov training and generation outside of a running bot
+
+Messages are fed through `Markov.on_message` and text is generated through \
+    `Markov.generate_text` using a stubbed bot and an in-memory Config, so \
+    the numbers cover tokenizing, counting, caching and storage but not \
+    Discord itself. Run it from the repository root, e.g.
+
+    python -m Markov.benchmark --messages 5000 --modes word,chunk,chunk5 --depths 1,2,3,4
+    python -m Markov.benchmark --corpus messages.txt --backend sqlite --backoff
+
+A replayed corpus is a text file with one message per line.
+"""
+import argparse
+import asyncio
+import copy
+import json
+import random
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+
+from . import markov
+from .model import tokenize
+
+# User ID used for every benchmarked message
+USER_ID = 1
+# Channel and guild IDs attached to benchmarked messages
+CHANNEL_ID = GUILD_ID = 2
+
+
+class StubValue:
+    """ A single Config value backed by a nested dict """
+    def __init__(self, data: dict, path: tuple, default):
+        self.data = data
+        self.path = path
+        self.default = default
+
+    def get(self):
+        node = self.data
+        for key in self.path:
+            if not isinstance(node, dict) or key not in node:
+                return copy.deepcopy(self.default)
+            node = node[key]
+        return copy.deepcopy(node)
+
+    async def __call__(self):
+        return self.get()
+
+    async def set(self, value):
+        node = self.data
+        for key in self.path[:-1]:
+            node = node.setdefault(key, {})
+        # Round trip through JSON like Red's drivers do
+        node[self.path[-1]] = json.loads(json.dumps(value))
+
+    async def get_raw(self, *keys, default=KeyError):
+        value = self.get()
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                if default is KeyError:
+                    raise KeyError(key)
+                return default
+            value = value[key]
+        return value
+
+    async def set_raw(self, *keys, value):
+        data = self.get()
+        node = data
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        node[keys[-1]] = value
+        await self.set(data)
+
+
+class StubGroup:
+    """ The Config values registered for one user or guild """
+    def __init__(self, data: dict, path: tuple, defaults: dict):
+        self.data = data
+        self.path = path
+        self.defaults = defaults
+
+    def __getattr__(self, name: str):
+        if name not in self.defaults:
+            raise AttributeError(name)
+        return StubValue(self.data, self.path + (name,), self.defaults[name])
+
+    async def all(self):
+        return {name: getattr(self, name).get() for name in self.defaults}
+
+
+class StubConfig:
+    """ Just enough of Red's Config for the Markov cog, kept in memory """
+    def __init__(self):
+        self.data = {}
+        self.defaults = {"GLOBAL": {}, "USER": {}, "GUILD": {}}
+
+    @classmethod
+    def get_conf(cls, *args, **kwargs):
+        return cls()
+
+    def register_global(self, **defaults):
+        self.defaults["GLOBAL"].update(defaults)
+
+    def register_user(self, **defaults):
+        self.defaults["USER"].update(defaults)
+
+    def register_guild(self, **defaults):
+        self.defaults["GUILD"].update(defaults)
+
+    def __getattr__(self, name: str):
+        defaults = self.__dict__.get("defaults", {}).get("GLOBAL", {})
+        if name not in defaults:
+            raise AttributeError(name)
+        return StubValue(self.data, ("GLOBAL", name), defaults[name])
+
+    async def all(self):
+        return await StubGroup(self.data, ("GLOBAL",), self.defaults["GLOBAL"]).all()
+
+    def user_from_id(self, user_id: int):
+        return StubGroup(self.data, ("USER", str(user_id)), self.defaults["USER"])
+
+    def guild_from_id(self, guild_id: int):
+        return StubGroup(self.data, ("GUILD", str(guild_id)), self.defaults["GUILD"])
+
+    def user(self, user):
+        return self.user_from_id(user.id)
+
+    def guild(self, guild):
+        if guild is None:
+            raise AttributeError("guild")
+        return self.guild_from_id(guild.id)
+
+    async def _all(self, scope: str):
+        return {int(key): {**self.defaults[scope], **value}
+                for key, value in self.data.get(scope, {}).items()}
+
+    async def all_users(self):
+        return await self._all("USER")
+
+    async def all_guilds(self):
+        return await self._all("GUILD")
+
+
+def synthetic_corpus(count: int, vocabulary: int = 2000, seed: int = 0) -> list:
+    """ Generate messages with Zipf-distributed words and some punctuation """
+    rng = random.Random(seed)
+    words = [f"word{i}" for i in range(vocabulary)]
+    weights = [1 / (rank + 1) for rank in range(vocabulary)]
+    punctuation = [",", ".", "!", "?", "'s", " (", ")"]
+    messages = []
+    for _ in range(count):
+        tokens = rng.choices(words, weights, k=rng.randint(1, 20))
+        message = " ".join(token + (rng.choice(punctuation) if rng.random() < 0.1 else "")
+                           for token in tokens)
+        messages.append(message)
+    return messages
+
+
+def replayed_corpus(path: Path, count: int = None) -> list:
+    """ Read one message per line, keeping only lines the cog would train on """
+    with open(path, encoding="utf-8") as corpus:
+        messages = [line.rstrip("\n") for line in corpus]
+    messages = [m for m in messages if m and m[0].isalnum()]
+    return messages[:count] if count else messages
+
+
+async def make_cog(data_path: Path, backend: str, executor: str):
+    """ Build a cog around a stubbed bot and Config """
+    async def ready():
+        pass
+    markov.Config = StubConfig
+    markov.cog_data_path = lambda *args, **kwargs: data_path
+    bot = SimpleNamespace(user=SimpleNamespace(id=0), wait_until_red_ready=ready)
+    cog = markov.Markov(bot)
+    # Flushes are done explicitly so they are timed with the work they follow
+    cog.flush_models.cancel()
+    cog.compact_models.cancel()
+    await cog.conf.backend.set(backend)
+    await cog.conf.executor.set(executor)
+    await cog.load_settings()
+    return cog
+
+
+def serialized_size(cog, data_path: Path, backend: str) -> int:
+    """ Measure the stored size of the benchmarked user's models in bytes """
+    if backend == "sqlite":
+        return sum(f.stat().st_size for f in data_path.glob("models.sqlite3*"))
+    chains = cog.conf.user_from_id(USER_ID).chains.get()
+    return len(json.dumps(chains))
+
+
+async def run_pass(messages: list, mode: str, depth: int, backoff: bool, args,
+                   traced: bool = False) -> dict:
+    """ Train a fresh model on the corpus and generate text from it """
+    with tempfile.TemporaryDirectory() as tmp:
+        data_path = Path(tmp)
+        cog = await make_cog(data_path, args.backend, args.executor)
+        user = cog.conf.user_from_id(USER_ID)
+        await user.enabled.set(True)
+        await user.mode.set(mode)
+        await user.chain_depth.set(depth)
+        await user.backoff.set(backoff)
+        await cog.conf.guild_from_id(GUILD_ID).channels.set([CHANNEL_ID])
+        author = SimpleNamespace(id=USER_ID, bot=False)
+        channel = SimpleNamespace(id=CHANNEL_ID)
+        guild = SimpleNamespace(id=GUILD_ID)
+        if traced:
+            tracemalloc.start()
+        try:
+            started = time.perf_counter()
+            for message_id, content in enumerate(messages, 1):
+                await cog.on_message(SimpleNamespace(id=message_id, content=content, author=author,
+                                                     channel=channel, guild=guild))
+            await cog.cache.flush()
+            trained = time.perf_counter() - started
+            entry = await cog.cache.get(USER_ID)
+            await cog.cache.load(entry, entry.key)
+            random.seed(args.seed)
+            tokens = 0
+            started = time.perf_counter()
+            for _ in range(args.generations):
+                text = await cog.generate_text(cog.cache, entry, backoff)
+                tokens += len(tokenize(text, mode, "")[0]) - 1
+            generated = time.perf_counter() - started
+            # Worker processes are not traced, only this one
+            peak = tracemalloc.get_traced_memory()[1] if traced else 0
+        finally:
+            tracemalloc.stop()
+        cog.start_pool("off")
+        await cog.cache.close()
+        await cog.guilds.close()
+        size = serialized_size(cog, data_path, args.backend)
+    return {"trained": trained, "generated": generated, "tokens": tokens,
+            "peak": peak, "size": size}
+
+
+async def run_case(messages: list, mode: str, depth: int, backoff: bool, args) -> dict:
+    """ Benchmark one combination of settings
+
+    Throughput is timed in its own pass since tracing allocations slows \
+        everything down, then the pass is repeated to measure peak memory.
+    """
+    timed = await run_pass(messages, mode, depth, backoff, args)
+    peak = None
+    if args.memory:
+        peak = (await run_pass(messages, mode, depth, backoff, args, traced=True))["peak"] / 2**20
+    return {"mode": mode,
+            "depth": f"{depth}{'/trie' if backoff else ''}",
+            "msg/s": len(messages) / timed["trained"],
+            "tok/s": timed["tokens"] / timed["generated"] if timed["generated"] else 0.0,
+            "peak MB": peak,
+            "size KB": timed["size"] / 1024}
+
+
+def print_table(rows: list):
+    """ Print result rows as right-aligned columns """
+    columns = list(rows[0])
+    cells = [[f"{v:.1f}" if isinstance(v, float) else "-" if v is None else str(v)
+              for v in row.values()]
+             for row in rows]
+    widths = [max(len(c), *(len(line[i]) for line in cells)) for i, c in enumerate(columns)]
+    print("  ".join(c.rjust(w) for c, w in zip(columns, widths)))
+    for line in cells:
+        print("  ".join(v.rjust(w) for v, w in zip(line, widths)))
+
+
+async def main(args):
+    if args.corpus:
+        messages = replayed_corpus(args.corpus, args.messages)
+    else:
+        messages = synthetic_corpus(args.messages, args.vocabulary, args.seed)
+    rows = []
+    for mode in args.modes.split(","):
+        for depth in map(int, args.depths.split(",")):
+            rows.append(await run_case(messages, mode, depth, False, args))
+        if args.backoff:
+            rows.append(await run_case(messages, mode, max(map(int, args.depths.split(","))),
+                                       True, args))
+    print(f"{len(messages)} messages, {args.generations} generations, "
+          f"{args.backend} backend, executor {args.executor}")
+    print_table(rows)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m Markov.benchmark",
+                                     description="Benchmark Markov training and generation")
+    parser.add_argument("--messages", type=int, default=2000,
+                        help="messages to train on (default 2000)")
+    parser.add_argument("--generations", type=int, default=200,
+                        help="texts to generate per case (default 200)")
+    parser.add_argument("--corpus", type=Path,
+                        help="replay messages from a file, one per line")
+    parser.add_argument("--vocabulary", type=int, default=2000,
+                        help="synthetic corpus vocabulary size (default 2000)")
+    parser.add_argument("--modes", default="word,chunk,chunk5",
+                        help="comma-separated token modes (default word,chunk,chunk5)")
+    parser.add_argument("--depths", default="1,2,3,4",
+                        help="comma-separated ngram depths (default 1,2,3,4)")
+    parser.add_argument("--backoff", action="store_true",
+                        help="also benchmark backoff models for each mode")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="skip the slower pass that measures peak memory")
+    parser.add_argument("--backend", choices=("config", "sqlite"), default="config")
+    parser.add_argument("--executor", choices=("off", "thread", "process"), default="off")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
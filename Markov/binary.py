@@ -0,0 +1,396 @@
+""" A compact binary format for exporting and memory-mapping Markov models
+
+Files start with a fixed header followed by 4-byte aligned sections of \
+    little-endian uint32 arrays:
+
+    header    magic, kind, key length and section sizes (HEADER)
+    key       the model key, e.g. "word-2" (UTF-8)
+    tokens    offsets into a UTF-8 blob, sorted so IDs can be binary searched
+    states    flat models: offsets into a sorted UTF-8 blob of state strings
+    edges     tries: per-node offsets into sorted child token IDs and nodes
+    counts    per-state offsets into target token IDs and transition counts
+
+Because tokens and states are sorted, a `MappedModel` can look them up by \
+    binary search directly in the mapped file and only decodes the handful \
+    of strings touched while generating. Worker processes are sent just the \
+    path of a mapped model and keep their own mapping of it between jobs.
+"""
+import mmap
+import os
+import random
+import struct
+import sys
+from array import array
+from bisect import bisect
+from collections import OrderedDict
+from itertools import accumulate
+from pathlib import Path
+
+from .model import UINT32, MarkovModel
+from .trie import NgramTrie
+
+__all__ = ["dump_binary", "load_binary", "read_binary", "write_binary", "MappedModel", "MappedTrie",
+           "open_mapped", "mapped"]
+
+MAGIC = b"MKV1"
+# Magic, kind, key length, tokens, token bytes, states/nodes, state bytes, edges, transitions
+HEADER = struct.Struct("<4sBxHIIIIII")
+FLAT, TRIE = 0, 1
+# Text encoding for tokens, states and keys
+ENCODING = "utf-8"
+ERRORS = "surrogatepass"
+# Mapped models each process keeps open for reuse
+MAPPED_LIMIT = 64
+
+# Path -> MappedModel, least recently used first
+_mapped = OrderedDict()
+
+
+def _encode(text: str) -> bytes:
+    return text.encode(ENCODING, ERRORS)
+
+
+def _decode(data) -> str:
+    return bytes(data).decode(ENCODING, ERRORS)
+
+
+def _padded(data: bytes) -> bytes:
+    return data + b"\0" * (-len(data) % 4)
+
+
+def _uint32(values) -> bytes:
+    values = array(UINT32, values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+def _strings(strings: list):
+    """ Encode strings as (offsets, blob) """
+    encoded = [_encode(s) for s in strings]
+    return [0, *accumulate(map(len, encoded))], b"".join(encoded)
+
+
+def dump_binary(model, key: str) -> bytes:
+    """ Serialize a `MarkovModel` or `NgramTrie` into the binary format """
+    # Renumber tokens in sorted order so readers can binary search them
+    order = sorted(range(len(model.tokens)), key=lambda i: _encode(model.tokens[i]))
+    renumber = array(UINT32, [0] * len(order))
+    for new, old in enumerate(order):
+        renumber[old] = new
+    token_offsets, token_blob = _strings([model.tokens[i] for i in order])
+    if isinstance(model, NgramTrie):
+        kind = TRIE
+        state_blob = b""
+        edge_offsets, edge_tokens, edge_nodes = [0], [], []
+        for children in model.children:
+            edges = sorted((renumber[t], node) for t, node in (children or {}).items())
+            edge_tokens.extend(t for t, _ in edges)
+            edge_nodes.extend(node for _, node in edges)
+            edge_offsets.append(len(edge_tokens))
+        states = len(model.children)
+        sections = [_uint32(edge_offsets), _uint32(edge_tokens), _uint32(edge_nodes)]
+        edges = len(edge_tokens)
+        order = range(states)
+    else:
+        kind = FLAT
+        names = list(model.states)
+        order = sorted(range(len(names)), key=lambda i: _encode(names[i]))
+        state_offsets, state_blob = _strings([names[i] for i in order])
+        states = len(names)
+        sections = [_uint32(state_offsets), _padded(state_blob)]
+        edges = 0
+    offsets, targets, counts = [0], array(UINT32), array(UINT32)
+    for index in order:
+        targets.extend(renumber[t] for t in model.targets[index])
+        counts.extend(model.counts[index])
+        offsets.append(len(targets))
+    key_bytes = _encode(key)
+    header = HEADER.pack(MAGIC, kind, len(key_bytes), len(model.tokens), len(token_blob),
+                         states, len(state_blob), edges, len(targets))
+    return b"".join([header, _padded(key_bytes), _uint32(token_offsets), _padded(token_blob),
+                     *sections, _uint32(offsets), _uint32(targets), _uint32(counts)])
+
+
+def write_binary(path: Path, function, args: tuple, key: str):
+    """ Rebuild a model from its pickled form and write it in the binary format """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_suffix(".tmp")
+    temporary.write_bytes(dump_binary(function(*args), key))
+    os.replace(temporary, path)
+
+
+class _Reader:
+    """ Sequential access to the sections of a binary model buffer """
+    def __init__(self, buffer):
+        self.view = memoryview(buffer)
+        if len(self.view) < HEADER.size:
+            raise ValueError("not a Markov model file")
+        (magic, self.kind, key_length, self.token_count, token_bytes, self.state_count,
+         state_bytes, self.edge_count, self.transition_count) = HEADER.unpack_from(self.view)
+        if magic != MAGIC or self.kind not in (FLAT, TRIE):
+            raise ValueError("not a Markov model file")
+        self.position = HEADER.size
+        self.key = _decode(self.bytes(key_length))
+        self.token_offsets = self.uint32(self.token_count + 1)
+        self.token_blob = self.bytes(token_bytes)
+        if self.kind == TRIE:
+            self.edge_offsets = self.uint32(self.state_count + 1)
+            self.edge_tokens = self.uint32(self.edge_count)
+            self.edge_nodes = self.uint32(self.edge_count)
+        else:
+            self.state_offsets = self.uint32(self.state_count + 1)
+            self.state_blob = self.bytes(state_bytes)
+        self.offsets = self.uint32(self.state_count + 1)
+        self.targets = self.uint32(self.transition_count)
+        self.counts = self.uint32(self.transition_count)
+        if self.position > len(self.view):
+            raise ValueError("truncated Markov model file")
+
+    def bytes(self, length: int):
+        view = self.view[self.position:self.position + length]
+        self.position += length + (-length % 4)
+        return view
+
+    def uint32(self, count: int):
+        view = self.bytes(count * 4)
+        if len(view) != count * 4:
+            raise ValueError("truncated Markov model file")
+        if sys.byteorder == "little":
+            return view.cast(UINT32)
+        # Big-endian machines can't use the mapped data directly
+        values = array(UINT32, view.tobytes())
+        values.byteswap()
+        return values
+
+    def release(self):
+        for name in ("token_offsets", "token_blob", "edge_offsets", "edge_tokens", "edge_nodes",
+                     "state_offsets", "state_blob", "offsets", "targets", "counts"):
+            view = getattr(self, name, None)
+            if isinstance(view, memoryview):
+                view.release()
+        self.view.release()
+
+    def string(self, offsets, blob, index: int) -> str:
+        return _decode(blob[offsets[index]:offsets[index + 1]])
+
+    def search(self, offsets, blob, count: int, text: str) -> int:
+        """ Binary search sorted strings, returning the index or -1 """
+        target = _encode(text)
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(blob[offsets[middle]:offsets[middle + 1]]) < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < count and bytes(blob[offsets[low]:offsets[low + 1]]) == target:
+            return low
+        return -1
+
+    def tokens(self) -> list:
+        return [self.string(self.token_offsets, self.token_blob, i)
+                for i in range(self.token_count)]
+
+
+def load_binary(buffer):
+    """ Deserialize a whole binary model into memory, returning (key, model) """
+    reader = _Reader(buffer)
+    try:
+        tokens = reader.tokens()
+        offsets = array(UINT32, reader.offsets)
+        targets = array(UINT32, reader.targets)
+        counts = array(UINT32, reader.counts)
+        if (offsets[-1] != len(targets) or list(offsets) != sorted(offsets)
+                or any(t >= len(tokens) for t in targets)):
+            raise ValueError("corrupt Markov model file")
+        if reader.kind == FLAT:
+            states = [reader.string(reader.state_offsets, reader.state_blob, i)
+                      for i in range(reader.state_count)]
+            return reader.key, MarkovModel.from_csr(tokens, states, offsets, targets, counts)
+        edge_offsets = list(reader.edge_offsets)
+        if (edge_offsets[-1] != reader.edge_count or edge_offsets != sorted(edge_offsets)
+                or sorted(reader.edge_nodes) != list(range(1, reader.state_count))
+                or any(t >= len(tokens) for t in reader.edge_tokens)):
+            raise ValueError("corrupt Markov model file")
+        parents = array(UINT32, [0] * (reader.state_count - 1))
+        edges = array(UINT32, [0] * (reader.state_count - 1))
+        for node in range(reader.state_count):
+            for i in range(reader.edge_offsets[node], reader.edge_offsets[node + 1]):
+                parents[reader.edge_nodes[i] - 1] = node
+                edges[reader.edge_nodes[i] - 1] = reader.edge_tokens[i]
+        return reader.key, NgramTrie.from_csr(tokens, parents, edges, offsets, targets, counts)
+    finally:
+        reader.release()
+
+
+class MappedModel:
+    """ A read-only flat model sampled directly from a memory-mapped file """
+    def __init__(self, path: Path, reader: _Reader, mapping: mmap.mmap):
+        self.path = Path(path)
+        self.mapping = mapping
+        self.reader = reader
+        self.key = reader.key
+        # Lookups and cumulative weights for what has been sampled, like the models' tables
+        self.indices = {}  # State string or token -> index, or -1 if absent
+        self.tables = {}   # State index -> cumulative weights
+        self.tokens = {}   # Token ID -> token
+
+    def __reduce__(self):
+        # Worker processes map the same file rather than receiving a copy
+        return mapped, (str(self.path),)
+
+    def __len__(self):
+        return self.reader.state_count
+
+    def __contains__(self, state: str):
+        return self.index(state) >= 0
+
+    def index(self, state: str) -> int:
+        """ Find a state's index, or -1 if it has no transitions """
+        index = self.indices.get(state)
+        if index is None:
+            reader = self.reader
+            index = self.indices[state] = reader.search(reader.state_offsets, reader.state_blob,
+                                                        reader.state_count, state)
+        return index
+
+    def token(self, token_id: int) -> str:
+        token = self.tokens.get(token_id)
+        if token is None:
+            reader = self.reader
+            token = self.tokens[token_id] = reader.string(reader.token_offsets, reader.token_blob,
+                                                          token_id)
+        return token
+
+    def sample(self, index: int) -> str:
+        """ Choose a token from a state's transitions according to their weights """
+        reader = self.reader
+        table = self.tables.get(index)
+        if table is None:
+            start, end = reader.offsets[index], reader.offsets[index + 1]
+            if start == end:
+                raise KeyError(index)
+            table = self.tables[index] = array("Q", accumulate(reader.counts[start:end]))
+        position = bisect(table, random.random() * (table[-1] + 0.0), 0, len(table) - 1)
+        return self.token(reader.targets[reader.offsets[index] + position])
+
+    def choose(self, state: str) -> str:
+        """ Choose the next token for a state according to its weights """
+        index = self.index(state)
+        if index < 0:
+            raise KeyError(state)
+        return self.sample(index)
+
+    def weight(self) -> int:
+        """ Count the transitions the model was trained on """
+        return sum(self.reader.counts)
+
+    def nbytes(self) -> int:
+        # Mapped pages belong to the OS page cache rather than the process
+        return 0
+
+    def close(self):
+        self.reader.release()
+        self.mapping.close()
+
+
+class MappedTrie(MappedModel):
+    """ A read-only trie model sampled directly from a memory-mapped file """
+    def __contains__(self, context: tuple):
+        node = 0
+        for previous in context:
+            node = self.child(node, previous)
+            if node is None:
+                return False
+        return self.reader.offsets[node] != self.reader.offsets[node + 1]
+
+    def weight(self) -> int:
+        """ Count the transitions the model was trained on """
+        # Every transition is also counted from the empty context
+        reader = self.reader
+        return sum(reader.counts[reader.offsets[0]:reader.offsets[1]])
+
+    def index(self, token: str) -> int:
+        """ Find a token's ID, or -1 if the model has never seen it """
+        token_id = self.indices.get(token)
+        if token_id is None:
+            reader = self.reader
+            token_id = self.indices[token] = reader.search(reader.token_offsets, reader.token_blob,
+                                                           reader.token_count, token)
+        return token_id
+
+    def child(self, node: int, token: str):
+        reader = self.reader
+        token_id = self.index(token)
+        if token_id < 0:
+            return None
+        start, end = reader.edge_offsets[node], reader.edge_offsets[node + 1]
+        edge_tokens = reader.edge_tokens
+        # Children are sorted by token ID
+        while start < end:
+            middle = (start + end) // 2
+            if edge_tokens[middle] < token_id:
+                start = middle + 1
+            else:
+                end = middle
+        if start < reader.edge_offsets[node + 1] and edge_tokens[start] == token_id:
+            return reader.edge_nodes[start]
+        return None
+
+    def find(self, history: list, depth: int):
+        """ Find the deepest node with transitions for the end of a history """
+        offsets = self.reader.offsets
+        node = found = 0
+        for previous in reversed(history[-depth:] if depth > 0 else ()):
+            node = self.child(node, previous)
+            if node is None:
+                break
+            if offsets[node] != offsets[node + 1]:
+                found = node
+        return found
+
+    def choose(self, history: list, depth: int) -> str:
+        """ Choose the next token after a history, backing off as needed """
+        node = self.find(history, depth)
+        try:
+            return self.sample(node)
+        except KeyError:
+            raise KeyError("model is empty")
+
+
+def open_mapped(path) -> MappedModel:
+    """ Memory-map a binary model file for generation """
+    with open(path, "rb") as file:
+        mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        reader = _Reader(mapping)
+    except ValueError:
+        mapping.close()
+        raise
+    cls = MappedTrie if reader.kind == TRIE else MappedModel
+    return cls(path, reader, mapping)
+
+
+def mapped(path) -> MappedModel:
+    """ Get a mapped model, reusing this process's mapping of the file if it has one
+
+    Files are never rewritten in place, so a path always names the same model. \
+        Mappings dropped from the cache are closed once nothing samples them.
+    """
+    path = str(path)
+    model = _mapped.get(path)
+    if model is None:
+        model = _mapped[path] = open_mapped(path)
+        while len(_mapped) > MAPPED_LIMIT:
+            _mapped.popitem(last=False)
+    else:
+        _mapped.move_to_end(path)
+    return model
+
+
+def read_binary(path):
+    """ Load a binary model file into memory through a read-only mapping """
+    with open(path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+            return load_binary(mapping)
@@ -0,0 +1,395 @@
+import asyncio
+import logging
+import shutil
+import time
+from collections import OrderedDict
+from itertools import count
+from pathlib import Path
+
+from .binary import MappedModel, mapped, write_binary
+from .storage import migrate, open_store
+
+log = logging.getLogger("red.cbd-cogs.markov")
+
+__all__ = ["UserEntry", "ModelCache", "GuildCache", "model_key", "contribution_key",
+           "contributed_guild"]
+
+# Rough per-token growth estimate used between accurate size measurements
+TOKEN_COST = 16
+# Overhead charged for every cached user, including ones without models
+ENTRY_COST = 256
+# Token mode of guild-wide models
+GUILD_MODE = "word"
+# Seconds a mapped snapshot is reused after its model has been trained further
+SNAPSHOT_AGE = 60
+# Mapped snapshots kept per cache
+SNAPSHOT_LIMIT = 64
+
+
+def model_key(mode: str, depth: int, backoff: bool = False) -> str:
+    """ Get the key of the model used for a combination of settings """
+    # Backoff models hold every depth, so only the mode selects them
+    if backoff:
+        return f"{mode}-trie"
+    return f"{mode}-{depth}"
+
+
+def contribution_key(guild_id: int) -> str:
+    """ Get the key of the model recording a user's share of a guild model """
+    return f"guild{guild_id}-trie"
+
+
+def contributed_guild(key: str):
+    """ Get the guild ID from a contribution model key, or None for other keys """
+    if key.startswith("guild") and key.endswith("-trie") and key[5:-5].isdigit():
+        return int(key[5:-5])
+    return None
+
+
+class UserEntry:
+    """ Cached settings and loaded models for a single user (or guild) """
+    __slots__ = ("user_id", "enabled", "depth", "mode", "backoff", "contribute",
+                 "models", "dirty", "nbytes", "handover", "versions")
+
+    def __init__(self, user_id: int, enabled: bool, depth: int, mode: str,
+                 backoff: bool = False, contribute: bool = True):
+        self.user_id = user_id
+        self.enabled = enabled
+        self.depth = depth
+        self.mode = mode
+        self.backoff = backoff
+        self.contribute = contribute  # Whether messages also train guild models
+        self.models = {}    # Model key -> MarkovModel, SQLiteModel or MappedModel
+        self.dirty = set()  # Keys of models changed since the last flush
+        self.nbytes = ENTRY_COST
+        self.handover = None  # Transitions the backoff model needs before it is used, once known
+        self.versions = {}  # Model key -> version, changed whenever the model is
+
+    def measure(self):
+        """ Recalculate the memory used by the entry's models """
+        self.nbytes = ENTRY_COST + sum(m.nbytes() for m in self.models.values())
+
+    @property
+    def key(self):
+        """ The key of the model for the user's current settings """
+        return model_key(self.mode, self.depth, self.backoff)
+
+
+class ModelCache:
+    """ Write-behind cache of user models with LRU eviction
+
+    Training happens against the in-memory models and changed models are \
+        written back to the store in batches instead of once per message.
+    """
+    scope = "user"
+
+    def __init__(self, conf, path: Path, budget: int, threshold: int):
+        self.conf = conf
+        self.path = path
+        self.store = None           # Opened on first use from the config
+        self.budget = budget        # Memory budget in bytes for cached models
+        self.threshold = threshold  # Trained messages that trigger a flush
+        self.entries = OrderedDict()
+        self.pending = 0            # Trained messages since the last flush
+        self.nbytes = 0             # Total size of the cached entries
+        self.lock = asyncio.Lock()
+        self.versions = count(1)     # Source of model versions, unique across reloads
+        self.snapshots = OrderedDict()  # (owner ID, key) -> (version, time, path, MappedModel)
+        self.snapshotting = {}       # (owner ID, key) -> task writing its snapshot
+        self.stale = []              # (time, path) of replaced snapshot files
+
+    def touch(self, entry: UserEntry, key: str):
+        """ Give a cached model a new version because it changed """
+        entry.versions[key] = next(self.versions)
+
+    def insert(self, entry: UserEntry):
+        """ Cache an entry, counting it towards the memory budget """
+        self.entries[entry.user_id] = entry
+        self.nbytes += entry.nbytes
+
+    def evict(self, user_id: int):
+        """ Drop an entry from the cache, if it is cached """
+        entry = self.entries.pop(user_id, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+
+    def grow(self, entry: UserEntry, nbytes: int):
+        """ Add to an entry's size, and the total if the entry is still cached """
+        entry.nbytes += nbytes
+        if self.entries.get(entry.user_id) is entry:
+            self.nbytes += nbytes
+
+    def measure(self, entry: UserEntry):
+        """ Recalculate an entry's size, updating the total to match """
+        before = entry.nbytes
+        entry.measure()
+        if self.entries.get(entry.user_id) is entry:
+            self.nbytes += entry.nbytes - before
+
+    async def open(self):
+        """ Get the store, opening the configured backend on first use """
+        async with self.lock:
+            if self.store is None:
+                self.store = await open_store(self.conf, self.path, scope=self.scope)
+            return self.store
+
+    async def get(self, user_id: int) -> UserEntry:
+        """ Get a user's cached entry, loading their settings on a miss """
+        await self.open()
+        async with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                user_config = self.conf.user_from_id(user_id)
+                entry = UserEntry(
+                    user_id,
+                    await user_config.enabled(),
+                    await user_config.chain_depth() or 1,
+                    (await user_config.mode() or "word").lower(),
+                    await user_config.backoff(),
+                    await user_config.contribute())
+                self.insert(entry)
+            self.entries.move_to_end(user_id)
+            return entry
+
+    async def load(self, entry: UserEntry, key: str, create: bool = False):
+        """ Get a model from an entry, reading it from the store if needed
+
+        Mapped copies can't be trained, so they are replaced by the stored model.
+        """
+        model = entry.models.get(key)
+        if model is None or isinstance(model, MappedModel):
+            model = await self.store.load(entry.user_id, key)
+            if model is None:
+                if not create:
+                    return None
+                model = self.store.new(entry.user_id, key)
+            if isinstance(entry.models.get(key), MappedModel):
+                del entry.models[key]
+            if key not in entry.models:
+                self.touch(entry, key)
+                entry.models[key] = model
+                self.grow(entry, model.nbytes())
+            model = entry.models[key]
+        return model
+
+    async def view(self, entry: UserEntry, key: str):
+        """ Get a model to generate from, mapping the store's binary copy on a miss
+
+        A cold model is only paged in where generation reads it, instead of \
+            parsing all of it, until it is loaded for training.
+        """
+        model = entry.models.get(key)
+        if model is None:
+            model = await self.store.mapped(entry.user_id, key)
+            if model is None:
+                return await self.load(entry, key)
+            if key not in entry.models:
+                self.touch(entry, key)
+            model = entry.models.setdefault(key, model)
+        return model
+
+    def mark(self, entry: UserEntry, key: str, tokens: int):
+        """ Record that a model was trained on a message """
+        # Keep entries that were evicted while their model was loading
+        if entry.user_id not in self.entries:
+            self.insert(entry)
+        entry.dirty.add(key)
+        self.touch(entry, key)
+        self.grow(entry, tokens * TOKEN_COST)
+        self.pending += 1
+
+    def update(self, user_id: int, **settings):
+        """ Apply changed settings to a cached entry """
+        entry = self.entries.get(user_id)
+        if entry is not None:
+            for name, value in settings.items():
+                setattr(entry, name, value)
+            entry.handover = None
+
+    def discard(self, user_id: int, key: str = None):
+        """ Forget cached models, e.g. because they were deleted """
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return
+        if key is None:
+            self.evict(user_id)
+            return
+        entry.dirty.discard(key)
+        entry.handover = None
+        entry.versions.pop(key, None)
+        if entry.models.pop(key, None) is not None:
+            self.measure(entry)
+
+    async def flush_entry(self, entry: UserEntry):
+        """ Write an entry's changed models back to the store """
+        keys, entry.dirty = entry.dirty, set()
+        for key in keys:
+            model = entry.models.get(key)
+            if model is None:
+                continue
+            await self.store.save(entry.user_id, key, model)
+        if keys:
+            self.measure(entry)
+
+    async def persist(self, entry: UserEntry):
+        """ Have the store copy an entry's written back models for mapping once it is evicted """
+        for key, model in list(entry.models.items()):
+            # Only copies that match the stored model are kept
+            if key not in entry.dirty and not isinstance(model, MappedModel):
+                await self.store.persist(entry.user_id, key, model)
+
+    async def flush(self, user_id: int = None):
+        """ Write all changed models (or those of one user) back to the store """
+        if user_id is not None:
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                await self.flush_entry(entry)
+            return
+        self.pending = 0
+        for entry in list(self.entries.values()):
+            if entry.dirty:
+                await self.flush_entry(entry)
+
+    async def compact(self, user_id: int, top_k: int = 0, min_count: int = 1,
+                      decay: float = 1.0, budget: int = 0) -> dict:
+        """ Apply maintenance policies to all of a user's models
+
+        Returns the size of each model before and after compaction. When the \
+            models still exceed the user's `budget` in bytes, each is pruned \
+            further to its proportional share of the budget. Contributions to \
+            guild models are left alone, since they have to match the guild \
+            model and are compacted along with it.
+        """
+        entry = await self.get(user_id)
+        # Make sure models trained since the last flush are included
+        await self.flush_entry(entry)
+        sizes = {}
+        for key in await self.store.keys(user_id):
+            if contributed_guild(key) is not None:
+                continue
+            model = await self.load(entry, key)
+            if model is not None:
+                sizes[key] = list(await self.store.compact(user_id, key, model,
+                                                           top_k, min_count, decay))
+        total = sum(after for _, after in sizes.values())
+        if budget and total > budget:
+            for key, size in sizes.items():
+                share = budget * size[1] // total
+                size[1] = await self.store.fit(user_id, key, entry.models[key], share)
+        for key in sizes:
+            self.touch(entry, key)
+        self.measure(entry)
+        return sizes
+
+    async def switch(self, store) -> int:
+        """ Copy every model to another store and start using it
+
+        Training waits on the lock while models are copied so nothing is \
+            written to the old store after it has been read.
+        """
+        await self.open()
+        async with self.lock:
+            await self.flush()
+            copied = await migrate(self.store, store)
+            await self.store.close()
+            self.entries.clear()
+            self.nbytes = 0
+            self.snapshots.clear()
+            self.store = store
+            return copied
+
+    async def snapshot(self, entry: UserEntry, key: str):
+        """ Get a read-only memory-mapped copy of a cached model for the worker pool
+
+        Workers sample the copy while training goes on with the original, and \
+            worker processes are only sent its path. A copy is rewritten when \
+            the model has changed, but at most once every `SNAPSHOT_AGE` seconds.
+        """
+        name = (entry.user_id, key)
+        version = entry.versions.get(key, 0)
+        snapshot = self.snapshots.get(name)
+        if snapshot is not None and (snapshot[0] == version
+                                     or time.monotonic() - snapshot[1] < SNAPSHOT_AGE):
+            self.snapshots.move_to_end(name)
+            return snapshot[3]
+        task = self.snapshotting.get(name)
+        if task is None:
+            # Copy the arrays here so training can't change them while they're written
+            function, args = entry.models[key].__reduce__()
+            args = (list(args[0]), *args[1:])
+            task = self.snapshotting[name] = asyncio.ensure_future(
+                self.write_snapshot(name, version, function, args))
+            task.add_done_callback(lambda _: self.snapshotting.pop(name, None))
+        return await asyncio.shield(task)
+
+    async def write_snapshot(self, name: tuple, version: int, function, args: tuple):
+        """ Write and map a snapshot file, retiring the one it replaces """
+        path = self.path / "mapped" / self.scope / "{}-{}-{}.mkv".format(*name, version)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, write_binary, path, function, args, name[1])
+        model = mapped(path)
+        old = self.snapshots.pop(name, None)
+        self.snapshots[name] = (version, time.monotonic(), path, model)
+        if old is not None:
+            self.stale.append((time.monotonic(), old[2]))
+        while len(self.snapshots) > SNAPSHOT_LIMIT:
+            self.stale.append((time.monotonic(), self.snapshots.popitem(last=False)[1][2]))
+        # Queued jobs may still be sent old paths, so files outlive them before removal
+        while self.stale and time.monotonic() - self.stale[0][0] > SNAPSHOT_AGE:
+            try:
+                self.stale.pop(0)[1].unlink()
+            except OSError:
+                pass
+        return model
+
+    async def close(self):
+        """ Write back all changed models and close the store """
+        if self.store is not None:
+            await self.flush()
+            for entry in list(self.entries.values()):
+                await self.persist(entry)
+            await self.store.close()
+        self.snapshots.clear()
+        self.stale.clear()
+        shutil.rmtree(self.path / "mapped" / self.scope, ignore_errors=True)
+
+    async def maintain(self):
+        """ Flush when enough messages are pending and evict cold users """
+        if self.pending >= self.threshold:
+            await self.flush()
+        while len(self.entries) > 1 and self.nbytes > self.budget:
+            user_id, entry = next(iter(self.entries.items()))
+            if entry.dirty:
+                await self.flush_entry(entry)
+            await self.persist(entry)
+            # The entry may have been trained or used while flushing or copying
+            if entry.dirty or next(iter(self.entries), None) != user_id:
+                continue
+            log.debug(f"Evicting cached models for user {user_id}")
+            self.evict(user_id)
+
+
+class GuildCache(ModelCache):
+    """ Write-behind cache of guild-wide models, keyed by guild ID
+
+    Each guild has a single backoff model trained on the messages of every \
+        contributing user, so it can be sampled without loading theirs.
+    """
+    scope = "guild"
+
+    async def get(self, guild_id: int) -> UserEntry:
+        """ Get a guild's cached entry, loading its settings on a miss """
+        await self.open()
+        async with self.lock:
+            entry = self.entries.get(guild_id)
+            if entry is None:
+                guild_config = self.conf.guild_from_id(guild_id)
+                entry = UserEntry(
+                    guild_id,
+                    await guild_config.aggregate(),
+                    await guild_config.aggregate_depth() or 1,
+                    GUILD_MODE,
+                    backoff=True)
+                self.insert(entry)
+            self.entries.move_to_end(guild_id)
+            return entry
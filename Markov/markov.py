@@ -1,25 +1,268 @@
+import asyncio
 import discord
+import io
 import logging
-import random
 import re
+import site
+import time
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Union
 
+from discord.ext import tasks
 from redbot.core import checks, Config, commands, bot
+from redbot.core.data_manager import cog_data_path
+
+from .binary import MappedModel, dump_binary, load_binary, read_binary
+from .cache import (GUILD_MODE, GuildCache, ModelCache, contributed_guild, contribution_key,
+                    model_key)
+from .model import count_transitions, generate
+from .prefetch import SentenceBuffer
+from .storage import SQLiteModel, is_trie, open_store
+from .trie import NgramTrie, count_contexts, generate_backoff
 
 log = logging.getLogger("red.cbd-cogs.markov")
 
 __all__ = ["UNIQUE_ID", "Markov"]
 
 UNIQUE_ID = 0x6D61726B6F76
-WORD_TOKENIZER = re.compile(r'(\W+)')
 CONTROL = f"{UNIQUE_ID}"
+# Longest context recorded by backoff models
+TRIE_DEPTH = 4
+# Share of the fixed-depth model's transitions a new backoff model needs before it is used
+BACKOFF_HANDOVER = 0.5
+# Sentences generated per prefetch refill pass
+PREFETCH_BATCH = 20
+# Seconds without training before buffers are refilled
+PREFETCH_IDLE = 2
+# Keys of models that can be imported
+MODEL_KEY = re.compile(r"(word|chunk\d*)-(\d+|trie)")
+# Characters replaced in the names of exported files
+UNSAFE_FILENAME = re.compile(r"[^\w-]")
+# Messages merged into models per backfill batch
+BACKFILL_BATCH = 500
+# Model maintenance settings: config attribute and value type
+COMPACTION_SETTINGS = {"top_k": ("top_k", int),
+                       "min_count": ("min_count", int),
+                       "decay": ("decay", float),
+                       "budget": ("user_budget", int),
+                       "interval": ("compact_interval", int)}
+
 
 class Markov(commands.Cog):
     """ A markov-chain-based text generator cog """
     def __init__(self, bot):
         self.bot = bot
         self.conf = Config.get_conf(self, identifier=UNIQUE_ID, force_registration=True)
-        self.conf.register_user(chains={}, chain_depth=1, mode="word", enabled=False)
-        self.conf.register_guild(channels=[])
+        self.conf.register_user(chains={}, chain_depth=1, mode="word", enabled=False, compacted={},
+                                backoff=False, contribute=True, mapped={})
+        self.conf.register_guild(channels=[], backfill={}, live={}, chains={}, mapped={},
+                                 aggregate=False, aggregate_depth=2)
+        self.conf.register_global(backend="config", cache_budget=64 * 2**20,
+                                  flush_interval=60, flush_threshold=100, backfill_rate=100,
+                                  executor="off", pool_size=2, pool_timeout=10,
+                                  top_k=0, min_count=1, decay=1.0, user_budget=0,
+                                  compact_interval=24, last_compaction=0,
+                                  prefetch_size=5, prefetch_budget=4 * 2**20)
+        self.cache = ModelCache(self.conf, cog_data_path(self), 64 * 2**20, 100)
+        self.guilds = GuildCache(self.conf, cog_data_path(self), 64 * 2**20, 100)
+        self.buffer = SentenceBuffer(5, 4 * 2**20)
+        self.last_trained = 0.0  # Event loop time of the last trained message
+        self.backfills = set()  # Channels currently being backfilled
+        self.live_channels = set()  # Channels known to have a recorded start of live training
+        self.pool = None        # Executor for tokenizing and generating, if any
+        self.pool_kind = "off"
+        self.pool_size = 2
+        self.pool_timeout = 10
+        self.flush_models.start()
+        self.compact_models.start()
+        self.refill_buffers.start()
+
+    async def cog_unload(self):
+        self.flush_models.cancel()
+        self.compact_models.cancel()
+        self.refill_buffers.cancel()
+        self.start_pool("off")
+        # Write back anything trained since the last flush
+        await self.cache.close()
+        await self.guilds.close()
+
+    @tasks.loop(seconds=60)
+    async def flush_models(self):
+        await self.cache.flush()
+        await self.guilds.flush()
+
+    @flush_models.before_loop
+    async def load_settings(self):
+        await self.bot.wait_until_red_ready()
+        settings = await self.conf.all()
+        for cache in (self.cache, self.guilds):
+            cache.budget = settings["cache_budget"]
+            cache.threshold = settings["flush_threshold"]
+        self.flush_models.change_interval(seconds=settings["flush_interval"])
+        self.pool_timeout = settings["pool_timeout"]
+        self.start_pool(settings["executor"], settings["pool_size"])
+        self.buffer.size = settings["prefetch_size"]
+        self.buffer.budget = settings["prefetch_budget"]
+
+    @tasks.loop(hours=1)
+    async def compact_models(self):
+        settings = await self.conf.all()
+        if time.time() - settings["last_compaction"] < settings["compact_interval"] * 3600:
+            return
+        await self.conf.last_compaction.set(time.time())
+        policy = await self.compaction_policy()
+        # Skip the pass entirely when no policy is enabled
+        if policy == {"top_k": 0, "min_count": 1, "decay": 1.0, "budget": 0}:
+            return
+        store = await self.cache.open()
+        users = await store.users()
+        contributors = {}
+        for user_id in users:
+            for key in await store.keys(user_id):
+                if contributed_guild(key) is not None:
+                    contributors.setdefault(contributed_guild(key), []).append(user_id)
+        # Guild models go first so their contributors' shares can be made to match
+        guild_store = await self.guilds.open()
+        for guild_id in await guild_store.users():
+            try:
+                await self.compact_guild(guild_id, policy, contributors.get(guild_id, []))
+            except Exception as e:
+                log.exception(f"Compaction failed for guild {guild_id}", exc_info=e)
+            await self.guilds.maintain()
+        for user_id in users:
+            try:
+                await self.compact_user(user_id, policy)
+            except Exception as e:
+                log.exception(f"Compaction failed for user {user_id}", exc_info=e)
+            await self.cache.maintain()
+
+    @compact_models.before_loop
+    async def wait_for_red(self):
+        await self.bot.wait_until_red_ready()
+
+    @tasks.loop(seconds=5)
+    async def refill_buffers(self):
+        """ Pre-generate text for recently used models so commands respond instantly """
+        # Leave the event loop to training while messages are coming in
+        if asyncio.get_running_loop().time() - self.last_trained < PREFETCH_IDLE:
+            return
+        budget = PREFETCH_BATCH
+        for key, pool, missing in self.buffer.wanted():
+            scope, owner_id, model = key
+            cache = self.guilds if scope == "guild" else self.cache
+            entry = await cache.get(owner_id)
+            if not entry.enabled or entry.key != model:
+                # The owner no longer uses this model
+                self.buffer.drop(key)
+                continue
+            backoff = await self.use_backoff(cache, entry)
+            if not backoff and model_key(entry.mode, entry.depth) not in entry.models:
+                self.buffer.drop(key)
+                continue
+            for _ in range(min(missing, budget)):
+                budget -= 1
+                try:
+                    text = await self.generate_text(cache, entry, backoff)
+                except (asyncio.TimeoutError, KeyError):
+                    # Don't keep trying models that are empty or too slow
+                    self.buffer.drop(key)
+                    break
+                if text and not self.buffer.put(key, pool, text):
+                    break
+                # Let commands and training run between sentences
+                await asyncio.sleep(0)
+            if budget <= 0:
+                break
+
+    @refill_buffers.before_loop
+    async def wait_for_idle(self):
+        await self.bot.wait_until_red_ready()
+
+    async def compaction_policy(self) -> dict:
+        """ Get the configured model maintenance policies """
+        settings = await self.conf.all()
+        return {"top_k": settings["top_k"],
+                "min_count": settings["min_count"],
+                "decay": settings["decay"],
+                "budget": settings["user_budget"] * 1024}
+
+    async def compact_user(self, user_id: int, policy: dict) -> dict:
+        """ Compact a user's models and record their sizes for `show` """
+        sizes = await self.cache.compact(user_id, **policy)
+        self.buffer.invalidate("user", user_id)
+        await self.conf.user_from_id(user_id).compacted.set(sizes)
+        return sizes
+
+    async def compact_guild(self, guild_id: int, policy: dict, contributors: list):
+        """ Compact a guild model, then its contributors' shares of it to match
+
+        Shares are decayed the same way and lose whatever the guild model \
+            pruned, so withdrawing one never subtracts other users' counts. \
+            Guild models are shared, so they are not held to a user's budget.
+        """
+        await self.guilds.compact(guild_id, policy["top_k"], policy["min_count"], policy["decay"])
+        self.buffer.invalidate("guild", guild_id)
+        guild = await self.guilds.get(guild_id)
+        kept = dict((await self.guilds.store.read(guild_id, guild.key)).items())
+        key = contribution_key(guild_id)
+        store = await self.cache.open()
+        for user_id in contributors:
+            await self.cache.flush(user_id)
+            share = NgramTrie()
+            for context, vector in (await store.read(user_id, key)).items():
+                remaining = kept.get(context, {})
+                for token, count in vector.items():
+                    # Rounding down each share keeps their sum within the guild's count
+                    count = min(int(count * policy["decay"]), remaining.get(token, 0))
+                    if count:
+                        share.add(context, token, count)
+            await self.replace_model(self.cache, user_id, key, share)
+
+    def start_pool(self, executor: str, size: int = 1, terminate: bool = False):
+        """ Replace the worker pool used for tokenizing and generating
+
+        With `terminate`, worker processes are killed instead of being left to \
+            finish their jobs. Threads can't be stopped, so they always finish.
+        """
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            if terminate and isinstance(pool, ProcessPoolExecutor):
+                # There's no public way to stop a running job before Python 3.14
+                for process in list((pool._processes or {}).values()):
+                    process.terminate()
+            pool.shutdown(wait=False)
+        if executor == "thread":
+            self.pool = ThreadPoolExecutor(size, thread_name_prefix="markov")
+        elif executor == "process":
+            # Spawned workers need to be able to import this package
+            self.pool = ProcessPoolExecutor(size, initializer=site.addsitedir,
+                                            initargs=(str(Path(__file__).parents[1]),))
+        self.pool_kind = executor
+        self.pool_size = size
+
+    async def offload(self, function, *args, retry: bool = True):
+        """ Run CPU-heavy work in the worker pool, or inline if there is none """
+        pool = self.pool
+        if pool is None:
+            return function(*args)
+        future = asyncio.get_running_loop().run_in_executor(pool, function, *args)
+        try:
+            return await asyncio.wait_for(future, self.pool_timeout)
+        except asyncio.TimeoutError:
+            # Don't let later work queue up behind a runaway job, or leave it running
+            log.warning(f"{function.__name__} timed out after {self.pool_timeout} seconds")
+            if self.pool is pool:
+                self.start_pool(self.pool_kind, self.pool_size, terminate=True)
+            raise
+        except BrokenExecutor:
+            # Jobs sharing a pool with one that timed out are lost when it is stopped
+            if not retry:
+                raise
+            log.debug(f"Retrying {function.__name__} after its worker pool was stopped")
+            if self.pool is pool:
+                self.start_pool(self.pool_kind, self.pool_size)
+            return await self.offload(function, *args, retry=False)
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -32,48 +275,88 @@ class Markov(commands.Cog):
                 return
         except AttributeError:  # Not in a guild
             pass
+        else:
+            if message.channel.id not in self.live_channels:
+                await self.start_live(message.guild, message.channel.id, message.id)
         # Ignore messages from the bot itself
         if message.author.id == self.bot.user.id:
             return
         # Ignore messages that start with non-alphanumeric characters
         if message.content and not message.content[0].isalnum():
             return
-        # Load the user's markov chain and settings
-        enabled, chains, depth, mode = await self.get_user_config(message.author)
+        # Load the user's cached settings
+        entry = await self.cache.get(message.author.id)
         # Check whether the user has enabled markov modeling
-        if enabled is not True:
-            return
-        # Create a token cleaner
-        cleaner = lambda x: x
-        # Choose a tokenizer mode
-        if mode == "word":
-            tokenizer = WORD_TOKENIZER
-            cleaner = lambda x: x.strip()
-        elif mode.startswith("chunk"):
-            chunk_length = 3 if len(mode) == 5 else mode[5:]
-            tokenizer = re.compile(fr'(.{{{chunk_length}}})')
+        if entry.enabled is not True:
+            return
+        # Tokenize the message and count its state vectors
+        try:
+            vectors = await self.count([message.content], entry.mode, entry.depth, entry.backoff)
+        except asyncio.TimeoutError:
+            return
+        if not vectors:
+            return
         # Get or create chain for tokenizer settings
-        model = chains.get(f"{mode}-{depth}", {})
-        # Begin all state chains with the control marker
-        state = CONTROL
-        # Remove code block formatting and outer whitespace
-        content = message.content.replace('`', '').strip()
-        # Split message into cleaned tokens
-        tokens = [t for x in tokenizer.split(content) if (t := cleaner(x))]
-        # Add control character transition to end of token chain
-        tokens.append(CONTROL)
-        # Iterate over the tokens in the message
-        for i, token in enumerate(tokens):
-            # Ensure dict key for vector distribution is created
-            model[state] = model.get(state, {})
-            # Increment the weight for this state vector or initialize it to 1
-            model[state][token] = model[state].get(token, 0) + 1
-            # Produce sliding state window (ngram)
-            j = 1 + i - depth if i >= depth else 0
-            state = "".join(cleaner(x) for x in tokens[j:i+1])
-        # Store the model
-        chains[f"{mode}-{depth}"] = model
-        await self.conf.user(message.author).chains.set(chains)
+        model = await self.cache.load(entry, entry.key, create=True)
+        # Increment the weight for each state vector in the message
+        model.merge(vectors)
+        # Queue the model to be stored
+        self.cache.mark(entry, entry.key, sum(map(len, vectors.values())))
+        self.last_trained = asyncio.get_running_loop().time()
+        await self.cache.maintain()
+        if message.guild is not None:
+            await self.train_guild(message.guild.id, entry, [message.content], vectors)
+
+    async def train_guild(self, guild_id: int, entry, contents: list, vectors: dict):
+        """ Add a user's trained messages to a guild model and their share of it """
+        if not entry.contribute:
+            return
+        guild = await self.guilds.get(guild_id)
+        if not guild.enabled:
+            return
+        # Reuse the user's counts when they were made the same way
+        if not (entry.backoff and entry.mode == GUILD_MODE):
+            try:
+                vectors = await self.count(contents, GUILD_MODE, guild.depth, True)
+            except asyncio.TimeoutError:
+                return
+        tokens = sum(map(len, vectors.values()))
+        model = await self.guilds.load(guild, guild.key, create=True)
+        model.merge(vectors)
+        self.guilds.mark(guild, guild.key, tokens)
+        # Record the user's share so it can be subtracted if they opt out
+        key = contribution_key(guild_id)
+        share = await self.cache.load(entry, key, create=True)
+        share.merge(vectors)
+        self.cache.mark(entry, key, tokens)
+        await self.guilds.maintain()
+
+    async def withdraw(self, user_id: int, guild_id: int = None) -> int:
+        """ Subtract a user's shares from guild models and delete them
+
+        Returns the number of guild models the user was removed from.
+        """
+        await self.cache.flush(user_id)
+        store = await self.cache.open()
+        if guild_id is None:
+            guild_ids = [contributed_guild(key) for key in await store.keys(user_id)]
+        else:
+            guild_ids = [guild_id]
+        withdrawn = 0
+        for guild_id in filter(None, guild_ids):
+            key = contribution_key(guild_id)
+            share = dict((await store.read(user_id, key)).items())
+            guild = await self.guilds.get(guild_id)
+            model = await self.guilds.load(guild, guild.key)
+            if share and model is not None:
+                model.subtract(share)
+                self.guilds.mark(guild, guild.key, 0)
+            self.cache.discard(user_id, key)
+            self.buffer.invalidate("guild", guild_id)
+            if await store.delete(user_id, key):
+                withdrawn += 1
+        await self.guilds.maintain()
+        return withdrawn
 
     @commands.group()
     async def markov(self, ctx: commands.Context):
@@ -81,34 +364,91 @@ class Markov(commands.Cog):
         pass
 
     @markov.command()
-    async def generate(self, ctx: commands.Context, user: discord.abc.User = None):
-        """ Generate text based on user language models """
+    async def generate(self, ctx: commands.Context,
+                       user: Union[discord.Member, discord.User, str] = None):
+        """ Generate text based on user language models
+
+        Use `guild` instead of a user to generate text from everyone \
+            contributing to this server's model.
+        """
+        if user == "guild":
+            await self.generate_guild(ctx)
+            return
         if not isinstance(user, discord.abc.User):
             user = ctx.message.author
-        enabled, chains, depth, mode = await self.get_user_config(user)
-        if not enabled:
+        entry = await self.cache.get(user.id)
+        if not entry.enabled:
             await ctx.send(f"Sorry, {user} won't let me model their speech")
             return
+        # Serve pre-generated text when there is some
+        text = self.buffer.take(("user", user.id, entry.key))
+        if text:
+            await ctx.send(text[:2000])
+            return
+        backoff = await self.use_backoff(self.cache, entry)
         text = None
         i = 0
+        # Models trained on empty messages can end a sentence straight away
         while not text:
-            text = await self.generate_text(chains, depth, mode)
+            try:
+                text = await self.generate_text(self.cache, entry, backoff)
+            except asyncio.TimeoutError:
+                await ctx.send("Sorry, generating text took too long")
+                return
+            except KeyError:
+                await ctx.send(f"Sorry, {user}'s model is empty")
+                return
             if i > 3:
                 await ctx.send(f"I tried to generate text 3 times, now I'm giving up.")
                 return
             i += 1
+        if backoff or model_key(entry.mode, entry.depth) in entry.models:
+            # Have text ready for the next request
+            self.buffer.track(("user", user.id, entry.key))
         await ctx.send(text[:2000])
 
+    async def generate_guild(self, ctx: commands.Context):
+        """ Generate text from the guild-wide model """
+        if ctx.guild is None:
+            await ctx.send("Guild models are only available in servers")
+            return
+        guild = await self.guilds.get(ctx.guild.id)
+        if not guild.enabled:
+            await ctx.send("The guild model is not enabled in this server")
+            return
+        text = self.buffer.take(("guild", guild.user_id, guild.key))
+        if text:
+            await ctx.send(text[:2000])
+            return
+        backoff = await self.use_backoff(self.guilds, guild)
+        try:
+            text = await self.generate_text(self.guilds, guild, backoff)
+        except asyncio.TimeoutError:
+            await ctx.send("Sorry, generating text took too long")
+            return
+        except KeyError:
+            text = None
+        if text and (backoff or model_key(guild.mode, guild.depth) in guild.models):
+            self.buffer.track(("guild", guild.user_id, guild.key))
+        await ctx.send((text or "Sorry, the guild model is empty")[:2000])
+
+    def update_user(self, user_id: int, **settings):
+        """ Apply changed settings to a user's cached entry and buffered text """
+        self.cache.update(user_id, **settings)
+        self.buffer.invalidate("user", user_id)
+
     @markov.command()
     async def enable(self, ctx: commands.Context):
         """ Allow the bot to model your messages and generate text based on that """
         await self.conf.user(ctx.author).enabled.set(True)
+        self.update_user(ctx.author.id, enabled=True)
         await ctx.send("Markov modeling enabled!")
 
     @markov.command()
     async def disable(self, ctx: commands.Context):
         """ Disallow the bot from modeling your message or generating text based on your models """
         await self.conf.user(ctx.author).enabled.set(False)
+        self.update_user(ctx.author.id, enabled=False)
         await ctx.send("Markov text generation is now disabled for your user.\n"
                        "I will stop updating your language models, but they are still stored.\n"
                        "You may want to use `[p]markov` reset to delete them.\n")
@@ -121,36 +461,92 @@ class Markov(commands.Cog):
          - `word`: Tokenize input based on words and punctuation using the regular expression (\W+)
          - `chunk`: Tokenize input into chunks of a certain length. You can specify the chunk size, e.g. "chunk5"
         
-        Separate models will be stored for each combination of mode and depth that you choose.
+        Separate models will be stored for each combination of mode and depth that you choose, \
+            or for each mode when `backoff` is enabled.
         """
         await self.conf.user(ctx.author).mode.set(mode)
+        self.update_user(ctx.author.id, mode=mode.lower())
         await ctx.send(f"Token mode set to '{mode}'.")
 
     @markov.command()
     async def depth(self, ctx: commands.Context, depth: int):
-        """ Set the modeling depth (the "n" in "ngrams") """
+        """ Set the modeling depth (the "n" in "ngrams")
+
+        With `backoff` enabled, depths up to 4 share one model and changing \
+            depth takes effect immediately.
+        """
         await self.conf.user(ctx.author).chain_depth.set(depth)
+        self.update_user(ctx.author.id, depth=depth or 1)
         await ctx.send(f"Ngram modeling depth set to {depth}.")
 
+    @markov.command()
+    async def backoff(self, ctx: commands.Context, enabled: bool):
+        """ Train one model covering every depth and back off to shorter ngrams when generating
+
+        Generation uses the longest context (up to your depth) that has been \
+            seen, so text is produced even from sparse models. Existing \
+            fixed-depth models are kept and used until the new model has \
+            been trained.
+        """
+        await self.conf.user(ctx.author).backoff.set(enabled)
+        self.update_user(ctx.author.id, backoff=enabled)
+        await ctx.send(f"Backoff generation {'enabled' if enabled else 'disabled'}.")
+
+    @markov.command()
+    async def contribute(self, ctx: commands.Context, enabled: bool):
+        """ Choose whether your messages train the guild models of servers that use them
+
+        Turning this off removes what you have contributed from every guild model.
+        """
+        await self.conf.user(ctx.author).contribute.set(enabled)
+        self.update_user(ctx.author.id, contribute=enabled)
+        if enabled:
+            await ctx.send("Your messages will train guild models.")
+            return
+        withdrawn = await self.withdraw(ctx.author.id)
+        await ctx.send(f"Your messages will no longer train guild models. "
+                       f"Removed your contributions from {withdrawn} guild models.")
+
     @markov.command()
     async def show(self, ctx: commands.Context, user: discord.abc.User = None):
         """ Show your current settings and models, or those of another user """
         if not isinstance(user, discord.abc.User):
             user = ctx.message.author
-        enabled, chains, depth, mode = await self.get_user_config(user, lazy=False)
-        models = '\n'.join(chains.keys())
-        await ctx.send(f"**Enabled:** {enabled}\n"
-                       f"**Chain Depth:** {depth}\n"
-                       f"**Token Mode:** {mode}\n"
+        # Settings come from the cache so stored models aren't loaded just to list them
+        entry = await self.cache.get(user.id)
+        # Make sure recently trained models are listed
+        await self.cache.flush(user.id)
+        store = await self.cache.open()
+        compacted = await self.conf.user(user).compacted()
+        models = []
+        for key in await store.keys(user.id):
+            line = f"{key} ({await store.size(user.id, key) / 1024:.1f} KB"
+            if key in compacted:
+                before, after = compacted[key]
+                line += f", compacted from {before / 1024:.1f} KB to {after / 1024:.1f} KB"
+            models.append(f"{line})")
+        models = '\n'.join(models)
+        await ctx.send(f"**Enabled:** {entry.enabled}\n"
+                       f"**Chain Depth:** {entry.depth}\n"
+                       f"**Token Mode:** {entry.mode}\n"
+                       f"**Backoff:** {entry.backoff}\n"
                        f"**Stored Models:**\n{models}")
 
     @markov.command()
     async def delete(self, ctx: commands.Context, model: str):
         """ Delete a specific model from your profile """
-        chains = await self.conf.user(ctx.message.author).chains()
-        if model in chains.keys():
-            del chains[model]
-            await self.conf.user(ctx.message.author).chains.set(chains)
+        guild_id = contributed_guild(model)
+        if guild_id is not None:
+            # Deleting a guild contribution also removes it from the guild model
+            if await self.withdraw(ctx.message.author.id, guild_id):
+                await ctx.send(f"Deleted model")
+            else:
+                await ctx.send(f"Model not found")
+            return
+        self.cache.discard(ctx.message.author.id, model)
+        self.buffer.invalidate("user", ctx.message.author.id, model)
+        store = await self.cache.open()
+        if await store.delete(ctx.message.author.id, model):
             await ctx.send(f"Deleted model")
         else:
             await ctx.send(f"Model not found")
@@ -158,7 +554,62 @@ class Markov(commands.Cog):
     @markov.command()
     async def reset(self, ctx: commands.Context):
         """ Remove all language models from your profile """
-        await self.conf.user(ctx.author).chains.set({})
+        await self.withdraw(ctx.author.id)
+        self.cache.discard(ctx.author.id)
+        self.buffer.invalidate("user", ctx.author.id)
+        store = await self.cache.open()
+        await store.reset(ctx.author.id)
+
+    @markov.command()
+    async def export(self, ctx: commands.Context, model: str = None):
+        """ Download one of your models as a compact binary file
+
+        Defaults to the model for your current settings. The file can be \
+            loaded again with `[p]markov import`, on this bot or another.
+        """
+        entry = await self.cache.get(ctx.author.id)
+        key = model or entry.key
+        await self.cache.flush(ctx.author.id)
+        store = await self.cache.open()
+        if key not in await store.keys(ctx.author.id):
+            await ctx.send("Model not found")
+            return
+        data = dump_binary(await store.read(ctx.author.id, key), key)
+        limit = ctx.guild.filesize_limit if ctx.guild else 8 * 2**20
+        if len(data) > limit:
+            await ctx.send(f"Sorry, that model is too large to upload ({len(data) / 2**20:.1f} MB)")
+            return
+        await ctx.send(f"Exported {key} ({len(data) / 1024:.1f} KB)",
+                       file=discord.File(io.BytesIO(data), filename=f"{key}.mkv"))
+
+    @markov.command(name="import")
+    async def import_model(self, ctx: commands.Context, model: str = None):
+        """ Replace one of your models with an exported file attached to the command
+
+        The model keeps the name it was exported with unless `model` is given.
+        """
+        if not ctx.message.attachments:
+            await ctx.send("Attach a file made with `[p]markov export` to import it")
+            return
+        try:
+            key, imported = load_binary(await ctx.message.attachments[0].read())
+        except ValueError as e:
+            await ctx.send(f"Sorry, I can't import that file: {e}")
+            return
+        key = model or key
+        # Guild contributions can't be imported without desyncing the guild model
+        if not MODEL_KEY.fullmatch(key) or is_trie(key) != isinstance(imported, NgramTrie):
+            await ctx.send(f"Sorry, '{key}' isn't a valid name for that model")
+            return
+        await self.replace_model(self.cache, ctx.author.id, key, imported)
+        await ctx.send(f"Imported {key}")
+
+    async def replace_model(self, cache, owner_id: int, key: str, model):
+        """ Overwrite a stored model, e.g. when importing, and forget cached copies """
+        store = await cache.open()
+        await store.write(owner_id, key, model)
+        cache.discard(owner_id, key)
+        self.buffer.invalidate(cache.scope, owner_id, key)
 
     @checks.admin_or_permissions(manage_guild=True)
     @commands.guild_only()
@@ -174,77 +625,400 @@ class Markov(commands.Cog):
         """ Disable modeling of messages in a channel """
         await self.channels_update(channel or ctx.channel.id, ctx.guild, False)
 
+    @checks.admin_or_permissions(manage_guild=True)
+    @commands.guild_only()
+    @markov.command(name="guildmodel")
+    async def guild_model(self, ctx: commands.Context, enabled: bool, depth: int = None):
+        """ Enable a server-wide model trained on every contributing user
+
+        The model is updated as users' own models are trained and can be \
+            used with `[p]markov generate guild`. Depths up to 4 are supported.
+        """
+        guild_config = self.conf.guild(ctx.guild)
+        await guild_config.aggregate.set(enabled)
+        if depth is not None:
+            await guild_config.aggregate_depth.set(depth)
+        self.guilds.update(ctx.guild.id, enabled=enabled,
+                           depth=await guild_config.aggregate_depth() or 1)
+        self.buffer.invalidate("guild", ctx.guild.id)
+        await ctx.send(f"Guild model {'enabled' if enabled else 'disabled'}.")
+
+    @checks.admin_or_permissions(manage_guild=True)
+    @commands.guild_only()
+    @markov.command()
+    async def backfill(self, ctx: commands.Context, channel: discord.TextChannel = None, limit: int = None):
+        """ Train enabled users' models on a channel's message history
+
+        History is read oldest first, up to the first message trained \
+            live, and merged into models in batches. Progress is saved as it goes, so running the command again \
+            resumes where the last run stopped. Use `limit` to cap the number \
+            of messages read in this run.
+        """
+        channel = channel or ctx.channel
+        if channel.id not in await self.conf.guild(ctx.guild).channels():
+            await ctx.send("Modeling is not enabled in that channel")
+            return
+        if channel.id in self.backfills:
+            await ctx.send("That channel is already being backfilled")
+            return
+        self.backfills.add(channel.id)
+        try:
+            await self._backfill(ctx, channel, limit)
+        finally:
+            self.backfills.discard(channel.id)
+
+    async def _backfill(self, ctx: commands.Context, channel: discord.TextChannel, limit: int = None):
+        checkpoints = self.conf.guild(ctx.guild).backfill
+        last_id = await checkpoints.get_raw(str(channel.id), default=None)
+        after = discord.Object(id=last_id) if last_id else None
+        # Stop where live training took over, so no message is trained twice
+        before = discord.Object(id=await self.start_live(ctx.guild, channel.id))
+        rate = await self.conf.backfill_rate()
+        status = await ctx.send(f"Backfilling {channel.mention}...")
+        read = trained = 0
+        batch = {}  # (user ID, mode, depth, backoff) -> message contents
+        started = asyncio.get_running_loop().time()
+        async for message in channel.history(limit=limit, after=after, before=before,
+                                             oldest_first=True):
+            read += 1
+            last_id = message.id
+            if await self.backfill_message(message, batch):
+                trained += 1
+            # Keep to the configured throughput cap
+            elapsed = asyncio.get_running_loop().time() - started
+            if read / rate > elapsed:
+                await asyncio.sleep(read / rate - elapsed)
+            if read % BACKFILL_BATCH:
+                continue
+            await self.merge_batch(batch, ctx.guild.id)
+            batch = {}
+            await checkpoints.set_raw(str(channel.id), value=last_id)
+            await status.edit(content=f"Backfilling {channel.mention}: read {read} messages, "
+                                      f"trained on {trained}...")
+        await self.merge_batch(batch, ctx.guild.id)
+        if last_id:
+            await checkpoints.set_raw(str(channel.id), value=last_id)
+        await status.edit(content=f"Backfilled {channel.mention}: read {read} messages, "
+                                  f"trained on {trained}")
+
+    async def start_live(self, guild: discord.Guild, channel_id: int, message_id: int = None) -> int:
+        """ Record where live training of a channel started, if it isn't known yet
+
+        Returns the ID of the first message trained live, or a snowflake for \
+            the current time when none is given. Backfills stop there.
+        """
+        live = self.conf.guild(guild).live
+        started = await live.get_raw(str(channel_id), default=None)
+        if started is None:
+            started = message_id or discord.utils.time_snowflake(discord.utils.utcnow())
+            await live.set_raw(str(channel_id), value=started)
+        self.live_channels.add(channel_id)
+        return started
+
+    async def backfill_message(self, message: discord.Message, batch: dict) -> bool:
+        """ Add a historical message to a backfill batch if it can be trained """
+        # Apply the same filters as live messages
+        if message.author.id == self.bot.user.id:
+            return False
+        if message.content and not message.content[0].isalnum():
+            return False
+        entry = await self.cache.get(message.author.id)
+        if entry.enabled is not True:
+            return False
+        batch.setdefault((entry.user_id, entry.mode, entry.depth, entry.backoff),
+                         []).append(message.content)
+        return True
+
+    async def merge_batch(self, batch: dict, guild_id: int = None):
+        """ Count a batch of messages and merge them into the cached models """
+        for (user_id, mode, depth, backoff), contents in batch.items():
+            vectors = await self.count(contents, mode, depth, backoff)
+            if not vectors:
+                continue
+            key = model_key(mode, depth, backoff)
+            entry = await self.cache.get(user_id)
+            model = await self.cache.load(entry, key, create=True)
+            model.merge(vectors)
+            self.cache.mark(entry, key, sum(map(len, vectors.values())))
+            if guild_id is not None:
+                await self.train_guild(guild_id, entry, contents, vectors)
+        await self.cache.maintain()
+
+    @checks.is_owner()
+    @markov.command(name="setbackfill", hidden=True)
+    async def set_backfill(self, ctx: commands.Context, rate: int):
+        """ Set the maximum number of messages per second read by backfills
+
+        Default is 100
+        """
+        await self.conf.backfill_rate.set(max(rate, 1))
+        await ctx.send(f"Backfill rate set to {max(rate, 1)} messages per second")
+
+    @checks.is_owner()
+    @markov.command(hidden=True)
+    async def compaction(self, ctx: commands.Context, setting: str = None, value: float = None):
+        """ View or set model maintenance policies
+
+        Available settings are:
+         - `top_k`: Keep at most this many transitions per state (0 for no limit)
+         - `min_count`: Drop transitions seen fewer times than this
+         - `decay`: Multiply every count by this factor on each compaction
+         - `budget`: Prune each user's models to fit in this many KB (0 for no limit)
+         - `interval`: Hours between background compactions
+
+        All policies are disabled by default.
+        """
+        if setting is not None and value is not None:
+            try:
+                attribute, kind = COMPACTION_SETTINGS[setting.lower()]
+            except KeyError:
+                await ctx.send(f"Unknown compaction setting '{setting}'")
+                return
+            await getattr(self.conf, attribute).set(kind(value))
+        settings = await self.conf.all()
+        await ctx.send("\n".join(f"**{name}:** {settings[attribute]}"
+                                 for name, (attribute, _) in COMPACTION_SETTINGS.items()))
+
+    @checks.is_owner()
+    @markov.command(hidden=True)
+    async def compact(self, ctx: commands.Context, user: discord.abc.User = None):
+        """ Compact a user's models now using the maintenance policies """
+        if not isinstance(user, discord.abc.User):
+            user = ctx.message.author
+        sizes = await self.compact_user(user.id, await self.compaction_policy())
+        if not sizes:
+            await ctx.send("No models to compact")
+            return
+        await ctx.send("\n".join(f"{key}: {before / 1024:.1f} KB -> {after / 1024:.1f} KB"
+                                 for key, (before, after) in sizes.items()))
+
+    @checks.is_owner()
+    @markov.command(name="bulkexport", hidden=True)
+    async def bulk_export(self, ctx: commands.Context):
+        """ Write every stored model to binary files in the cog's data folder
+
+        Files are written to `exports/<users or guilds>/<ID>/` and can be \
+            copied to another bot and loaded with `[p]markov bulkimport`.
+        """
+        root = cog_data_path(self) / "exports"
+        exported = size = 0
+        for cache in (self.cache, self.guilds):
+            await cache.flush()
+            store = await cache.open()
+            for owner_id in await store.users():
+                folder = root / f"{cache.scope}s" / str(owner_id)
+                folder.mkdir(parents=True, exist_ok=True)
+                for key in await store.keys(owner_id):
+                    data = dump_binary(await store.read(owner_id, key), key)
+                    # The key is stored in the file, so the name only needs to be safe
+                    (folder / f"{UNSAFE_FILENAME.sub('_', key)}.mkv").write_bytes(data)
+                    exported += 1
+                    size += len(data)
+                    await asyncio.sleep(0)
+        await ctx.send(f"Exported {exported} models ({size / 2**20:.1f} MB) to {root}")
+
+    @checks.is_owner()
+    @markov.command(name="bulkimport", hidden=True)
+    async def bulk_import(self, ctx: commands.Context):
+        """ Load every model file in the cog's `exports` folder, replacing stored models """
+        root = cog_data_path(self) / "exports"
+        imported = failed = 0
+        for cache in (self.cache, self.guilds):
+            for path in sorted((root / f"{cache.scope}s").glob("*/*.mkv")):
+                try:
+                    key, model = read_binary(path)
+                    owner_id = int(path.parent.name)
+                except ValueError as e:
+                    log.warning(f"Skipping {path}: {e}")
+                    failed += 1
+                    continue
+                await self.replace_model(cache, owner_id, key, model)
+                imported += 1
+        await ctx.send(f"Imported {imported} models" + (f", skipped {failed}" if failed else ""))
+
+    @checks.is_owner()
+    @markov.command(name="setexecutor", hidden=True)
+    async def set_executor(self, ctx: commands.Context, executor: str, size: int = 2, timeout: int = 10):
+        """ Set where tokenizing and text generation run
+
+        Available executors are:
+         - `off`: Run on the bot's event loop (default)
+         - `thread`: Run in a pool of `size` threads
+         - `process`: Run in a pool of `size` worker processes
+
+        Pools generate from memory-mapped copies of models, which are \
+            refreshed at most once a minute while the models are trained.
+        Work taking longer than `timeout` seconds is abandoned.
+        """
+        executor = executor.lower()
+        if executor not in ("off", "thread", "process"):
+            await ctx.send(f"Unknown executor '{executor}'")
+            return
+        await self.conf.executor.set(executor)
+        await self.conf.pool_size.set(size)
+        await self.conf.pool_timeout.set(timeout)
+        self.pool_timeout = timeout
+        self.start_pool(executor, size)
+        await ctx.send(f"Executor set to {executor}")
+
+    @checks.is_owner()
+    @markov.command(name="setcache", hidden=True)
+    async def set_cache(self, ctx: commands.Context, megabytes: int):
+        """ Set the memory budget in megabytes for cached models
+
+        Least recently used models are written back and evicted to stay \
+            within the budget
+
+        Default is 64
+        """
+        await self.conf.cache_budget.set(megabytes * 2**20)
+        for cache in (self.cache, self.guilds):
+            cache.budget = megabytes * 2**20
+            await cache.maintain()
+        await ctx.send(f"Model cache budget set to {megabytes} MB")
+
+    @checks.is_owner()
+    @markov.command(name="setprefetch", hidden=True)
+    async def set_prefetch(self, ctx: commands.Context, size: int, megabytes: float = None):
+        """ Set how many sentences are pre-generated for each recently used model
+
+        Buffered sentences for all models are kept within `megabytes` of \
+            memory. Use a size of 0 to always generate on demand.
+
+        Defaults are 5 sentences and 4 MB
+        """
+        await self.conf.prefetch_size.set(max(size, 0))
+        self.buffer.size = max(size, 0)
+        if megabytes is not None:
+            await self.conf.prefetch_budget.set(int(megabytes * 2**20))
+            self.buffer.budget = int(megabytes * 2**20)
+        self.buffer.clear()
+        requests = self.buffer.hits + self.buffer.misses
+        await ctx.send(f"Prefetching {self.buffer.size} sentences per model within "
+                       f"{self.buffer.budget / 2**20:.1f} MB "
+                       f"({self.buffer.hits} of {requests} requests served from the buffer)")
+
+    @checks.is_owner()
+    @markov.command(name="setflush", hidden=True)
+    async def set_flush(self, ctx: commands.Context, interval: int, threshold: int = None):
+        """ Set how often trained models are written back to storage
+
+        Models are written every `interval` seconds, or sooner once \
+            `threshold` messages have been trained since the last write
+
+        Defaults are 60 seconds and 100 messages
+        """
+        await self.conf.flush_interval.set(interval)
+        self.flush_models.change_interval(seconds=interval)
+        if threshold is not None:
+            await self.conf.flush_threshold.set(threshold)
+            self.cache.threshold = self.guilds.threshold = threshold
+        await ctx.send(f"Models will be written every {interval} seconds "
+                       f"or {self.cache.threshold} messages")
+
+    @checks.is_owner()
+    @markov.command(hidden=True)
+    async def backend(self, ctx: commands.Context, backend: str = None):
+        """ View or set the storage backend for language models
+
+        Available backends are:
+         - `config`: Store each user's models in Red's Config (default)
+         - `sqlite`: Store transition counts in a local SQLite database so \
+            that models never have to be loaded whole
+
+        Switching backends copies every stored model to the new backend.
+        """
+        current = await self.conf.backend()
+        if backend is None:
+            await ctx.send(f"Storage backend is {current}")
+            return
+        backend = backend.lower()
+        if backend not in ("config", "sqlite"):
+            await ctx.send(f"Unknown storage backend '{backend}'")
+            return
+        if backend == current:
+            await ctx.send(f"Storage backend is already {current}")
+            return
+        await ctx.send(f"Copying models to the {backend} backend, this may take a while...")
+        copied = 0
+        for cache in (self.cache, self.guilds):
+            target = await open_store(self.conf, cog_data_path(self), backend, cache.scope)
+            try:
+                copied += await cache.switch(target)
+            except Exception as e:
+                log.exception("Model migration failed", exc_info=e)
+                await target.close()
+                await ctx.send("Model migration failed (see log for details)")
+                return
+        self.buffer.clear()
+        await self.conf.backend.set(backend)
+        await ctx.send(f"Copied {copied} models, storage backend set to {backend}")
+
     async def channels_update(self, channel, guild, add: bool = True):
         """ Update list of channels in which modeling is allowed """
         channels = await self.conf.guild(guild).channels()
         if add:
             channels.append(int(channel))
+            # Messages from here on are trained live rather than by backfills
+            await self.start_live(guild, int(channel))
         else:
             channels.remove(int(channel))
         await self.conf.guild(guild).channels.set(channels)
 
-    async def get_user_config(self, user: discord.abc.User, lazy: bool = True):
-        """ Get a user config, optionally short circuiting if not enabled """
-        user_config = self.conf.user(user)
-        enabled = await user_config.enabled()
-        if lazy and not enabled:
-            return (False, )*4
-        chains = await user_config.chains() or {}
-        depth = await user_config.chain_depth() or 1
-        mode = (await user_config.mode() or "word").lower()
-        return enabled, chains, depth, mode
-
-    async def generate_text(self, chains: dict, depth: int, mode: str):
-        """ Generate text based on the appropriate model for user settings """
-        generator = None
-        if mode == "word":
-            generator = self.generate_word_gram
-        elif mode.startswith("chunk"):
-            generator = self.generate_chunk_gram
-        if not generator:
+    async def count(self, contents: list, mode: str, depth: int, backoff: bool = False) -> dict:
+        """ Count the transitions in messages for the model selected by user settings """
+        if backoff:
+            return await self.offload(count_contexts, contents, mode, TRIE_DEPTH, CONTROL)
+        return await self.offload(count_transitions, contents, mode, depth, CONTROL)
+
+    async def use_backoff(self, cache, entry) -> bool:
+        """ Load the model to generate text from, returning whether it is the backoff model
+
+        A backoff model starts out empty when it is turned on, so the \
+            fixed-depth model trained before it is used until the backoff \
+            model has been trained on a comparable number of transitions.
+        """
+        fixed_key = model_key(entry.mode, entry.depth)
+        trie = await cache.view(entry, entry.key) if entry.backoff else None
+        if trie is not None:
+            if entry.handover is None:
+                fixed = await cache.view(entry, fixed_key)
+                weight = 0
+                if fixed is not None:
+                    weight = await cache.store.weight(entry.user_id, fixed_key, fixed)
+                entry.handover = int(weight * BACKOFF_HANDOVER)
+            if (not entry.handover
+                    or await cache.store.weight(entry.user_id, entry.key, trie) >= entry.handover):
+                entry.handover = 0
+                return True
+        await cache.view(entry, fixed_key)
+        return False
+
+    async def generate_text(self, cache: ModelCache, entry, backoff: bool = False):
+        """ Generate text based on the appropriate model for an entry's settings """
+        depth, mode = entry.depth, entry.mode
+        if mode != "word" and not mode.startswith("chunk"):
             return f"Sorry, I don't have a text generator for token mode '{mode}'"
-        # Get appropriate model for settings
-        try:
-            model = chains[f"{mode}-{depth}"]
-        except KeyError:
+        # Get appropriate model for settings, preferring the backoff model
+        generator = generate
+        key = model_key(mode, depth)
+        if backoff and model_key(mode, depth, True) in entry.models:
+            generator = generate_backoff
+            key = model_key(mode, depth, True)
+            depth = min(depth, TRIE_DEPTH)
+        model = entry.models.get(key)
+        if model is None:
             return "Sorry, I can't find a model to use"
-        output = []
-        i = 0
-        gram = ""
-        # Begin in a state of transitioning from message boundary
-        state = CONTROL
-        while gram.strip() != CONTROL:
-            # Generate and store next gram
-            gram = await generator(model, state)
-            output.append(gram)
-            # Produce sliding state window (ngram)
-            i += 1
-            j = i - depth if i > depth else 0
-            state = "".join(output[j:i])
-        if not output:
-            return
-        return "".join(output[:-1])
-
-    async def generate_word_gram(self, model: dict, state: str):
-        """ Generate text for word-mode vectorization """
-        # Remove word boundaries from ngram; whitespace is added back later
-        state = state.replace(" ", "")
-        # Choose the next word taking into account recorded vector weights
-        gram = await self.choose_gram(model, state)
-        # Don't worry about it ;)
-        prepend_space = all((state != CONTROL,
-                             gram[-1].isalnum() or gram in "\"([{|",
-                             state[-1] not in "\"([{'/-_"))
-        # Format gram
-        return f"{' ' if prepend_space else ''}{gram}"
-
-    async def generate_chunk_gram(self, *args):
-        """ Generate text for chunk-mode vectorization """
-        return await self.choose_gram(*args)
-
-    async def choose_gram(self, model: dict, state: str):
-        """ Here lies the secret sauce """
-        gram, = random.choices(population=list(model[state].keys()),
-                               weights=list(model[state].values()),
-                               k=1)  # Caution: basically magic
-        return gram
+        if isinstance(model, SQLiteModel):
+            # Sample a copy so training can go on while rows are read off the event loop
+            snapshot = model.snapshot()
+            if self.pool is None:
+                text = await model.store.query(generator, snapshot, depth, mode, CONTROL)
+            else:
+                text = await self.offload(generator, snapshot, depth, mode, CONTROL)
+            model.adopt(snapshot)
+            return text
+        if self.pool is not None and not isinstance(model, MappedModel):
+            # Workers sample a mapped copy, so they neither race training nor get sent the model
+            model = await cache.snapshot(entry, key)
+        return await self.offload(generator, model, depth, mode, CONTROL)
@@ -0,0 +1,363 @@
+import base64
+import random
+import re
+import sys
+from array import array
+from bisect import bisect
+from itertools import accumulate
+
+__all__ = ["MarkovModel", "transitions", "tokenize", "count_transitions", "generate"]
+
+WORD_TOKENIZER = re.compile(r'(\W+)')
+# Array typecode for unsigned 32-bit integers on this platform
+UINT32 = next(code for code in "IL" if array(code).itemsize == 4)
+# Marker identifying the packed (compact) on-disk representation
+PACKED_FORMAT = "packed-1"
+# States with at least this many transitions get a token lookup while training
+SLOT_INDEX_MIN = 8
+
+
+def tokenize(content: str, mode: str, end: str):
+    """ Split message content into cleaned tokens for a tokenization mode
+
+    Returns the tokens (ending with the control marker `end`) and the \
+        cleaner used to build states from them, or `(None, None)` for \
+        unknown modes.
+    """
+    # Create a token cleaner
+    cleaner = _identity
+    # Choose a tokenizer mode
+    if mode == "word":
+        tokenizer = WORD_TOKENIZER
+        cleaner = str.strip
+    elif mode.startswith("chunk"):
+        chunk_length = 3 if len(mode) == 5 else mode[5:]
+        tokenizer = re.compile(fr'(.{{{chunk_length}}})')
+    else:
+        return None, None
+    # Remove code block formatting and outer whitespace
+    content = content.replace('`', '').strip()
+    # Split message into cleaned tokens
+    tokens = [t for x in tokenizer.split(content) if (t := cleaner(x))]
+    # Add control character transition to end of token chain
+    tokens.append(end)
+    return tokens, cleaner
+
+
+def _identity(token: str) -> str:
+    return token
+
+
+def count_transitions(contents: list, mode: str, depth: int, end: str) -> dict:
+    """ Tokenize messages and count their transitions as {state: {token: count}} """
+    vectors = {}
+    for content in contents:
+        tokens, cleaner = tokenize(content, mode, end)
+        if tokens is None:
+            break
+        for state, token in transitions(tokens, depth, cleaner, end):
+            vector = vectors.setdefault(state, {})
+            vector[token] = vector.get(token, 0) + 1
+    return vectors
+
+
+def transitions(tokens: list, depth: int, cleaner, start: str):
+    """ Yield (state, token) pairs using a sliding ngram state window """
+    # Begin all state chains with the control marker
+    state = start
+    for i, token in enumerate(tokens):
+        yield state, token
+        # Produce sliding state window (ngram)
+        j = 1 + i - depth if i >= depth else 0
+        state = "".join(cleaner(x) for x in tokens[j:i+1])
+
+
+def prune(targets: array, counts: array, top_k: int = 0, min_count: int = 1, decay: float = 1.0):
+    """ Decay and prune one state's transitions, returning (target, count) pairs """
+    min_count = max(min_count, 1)
+    pairs = [(t, int(c * decay)) for t, c in zip(targets, counts)]
+    pairs = [(t, c) for t, c in pairs if c >= min_count]
+    if top_k and len(pairs) > top_k:
+        # Keep the heaviest transitions in their original order
+        keep = sorted(range(len(pairs)), key=lambda i: -pairs[i][1])[:top_k]
+        pairs = [pairs[i] for i in sorted(keep)]
+    return pairs
+
+
+def _pack(values: array) -> str:
+    """ Encode an integer array as little-endian base64 """
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return base64.b64encode(values.tobytes()).decode("ascii")
+
+
+def _unpack(data: str) -> array:
+    """ Decode a little-endian base64 integer array """
+    values = array(UINT32)
+    values.frombytes(base64.b64decode(data))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+class MarkovModel:
+    """ Transition counts for a single chain with interned tokens
+
+    Tokens are interned to integer IDs and each state keeps its transitions \
+        in a pair of packed arrays (token IDs and counts) in the order they \
+        were first seen, so sampling behaves exactly like the nested dicts \
+        this replaces.
+    """
+    __slots__ = ("tokens", "token_ids", "states", "targets", "counts", "tables", "slots")
+
+    def __init__(self):
+        self.tokens = []     # Token ID -> token string
+        self.token_ids = {}  # Token string -> token ID
+        self.states = {}     # State string -> state index
+        self.targets = []    # State index -> array of token IDs
+        self.counts = []     # State index -> array of transition counts
+        self.tables = {}     # State index -> cumulative weights for sampling
+        self.slots = {}      # State index -> {token ID: position}, for states being trained
+
+    def __contains__(self, state: str):
+        return state in self.states
+
+    def __len__(self):
+        return len(self.states)
+
+    def intern(self, token: str) -> int:
+        """ Get the ID for a token, assigning a new one if necessary """
+        token_id = self.token_ids.get(token)
+        if token_id is None:
+            token_id = self.token_ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+    def add(self, state: str, token: str, count: int = 1):
+        """ Increment the weight of a state transition """
+        index = self.states.get(state)
+        if index is None:
+            index = self.states[state] = len(self.targets)
+            self.targets.append(array(UINT32))
+            self.counts.append(array(UINT32))
+        # Invalidate the sampling table for the changed state only
+        self.tables.pop(index, None)
+        token_id = self.intern(token)
+        targets = self.targets[index]
+        slots = self.slots.get(index)
+        if slots is None and len(targets) >= SLOT_INDEX_MIN:
+            # Scanning is cheaper than a dict until a state fans out
+            slots = self.slots[index] = {t: i for i, t in enumerate(targets)}
+        if slots is not None:
+            position = slots.get(token_id)
+        else:
+            try:
+                position = targets.index(token_id)
+            except ValueError:
+                position = None
+        if position is None:
+            if slots is not None:
+                slots[token_id] = len(targets)
+            targets.append(token_id)
+            self.counts[index].append(count)
+        else:
+            self.counts[index][position] += count
+
+    def merge(self, vectors: dict):
+        """ Add a batch of {state: {token: count}} transition counts """
+        for state, vector in vectors.items():
+            for token, count in vector.items():
+                self.add(state, token, count)
+
+    def table(self, index: int) -> array:
+        """ Get the cumulative weights for a state, building them if needed """
+        table = self.tables.get(index)
+        if table is None:
+            table = self.tables[index] = array("Q", accumulate(self.counts[index]))
+        return table
+
+    def choose(self, state: str) -> str:
+        """ Choose the next token for a state according to its weights
+
+        This draws exactly like `random.choices(tokens, weights=counts)` \
+            but bisects a cached cumulative weight table instead of copying \
+            the state's tokens and weights on every call.
+        """
+        index = self.states[state]
+        table = self.table(index)
+        position = bisect(table, random.random() * (table[-1] + 0.0), 0, len(table) - 1)
+        return self.tokens[self.targets[index][position]]
+
+    def compact(self, top_k: int = 0, min_count: int = 1, decay: float = 1.0):
+        """ Decay and prune transition counts, dropping anything left empty
+
+        Counts are multiplied by `decay` (rounding down), transitions with \
+            fewer than `min_count` observations are removed and each state \
+            keeps at most its `top_k` heaviest transitions (0 for no limit). \
+            The token table is rebuilt so unused tokens are released.
+        """
+        tokens = self.tokens
+        states, targets, counts = self.states, self.targets, self.counts
+        self.tokens, self.token_ids, self.states, self.targets, self.counts = [], {}, {}, [], []
+        self.tables = {}
+        self.slots = {}
+        for state, index in states.items():
+            pairs = prune(targets[index], counts[index], top_k, min_count, decay)
+            if not pairs:
+                continue
+            self.states[state] = len(self.targets)
+            self.targets.append(array(UINT32, (self.intern(tokens[t]) for t, _ in pairs)))
+            self.counts.append(array(UINT32, (c for _, c in pairs)))
+
+    def fit(self, budget: int):
+        """ Prune the rarest transitions until the model fits in `budget` bytes """
+        threshold = 1
+        while self.states and self.nbytes() > budget:
+            threshold = max(threshold + 1, int(threshold * 1.5))
+            self.compact(min_count=threshold)
+
+    def weight(self) -> int:
+        """ Count the transitions the model was trained on """
+        return sum(map(sum, self.counts))
+
+    def items(self):
+        """ Yield (state, {token: count}) pairs in insertion order """
+        for state, index in self.states.items():
+            yield state, {self.tokens[t]: c
+                          for t, c in zip(self.targets[index], self.counts[index])}
+
+    def nbytes(self) -> int:
+        """ Approximate the memory used by the model's data """
+        strings = sum(len(token) for token in self.tokens)
+        strings += sum(len(state) for state in self.states)
+        arrays = sum(len(t) for t in self.targets) * 4 * 2
+        tables = sum(len(t) for t in self.tables.values()) * 8
+        # Roughly a dict entry and an int object per indexed transition
+        slots = sum(len(s) for s in self.slots.values()) * 64
+        return strings + arrays + tables + slots
+
+    @classmethod
+    def from_dict(cls, chain: dict):
+        """ Build a model from a nested {state: {token: count}} dict """
+        model = cls()
+        for state, vector in chain.items():
+            for token, count in vector.items():
+                model.add(state, token, count)
+        return model
+
+    def to_dict(self) -> dict:
+        """ Convert the model to a nested {state: {token: count}} dict """
+        return dict(self.items())
+
+    @classmethod
+    def load(cls, data: dict = None):
+        """ Load a model from either stored representation """
+        if not data:
+            return cls()
+        if data.get("format") != PACKED_FORMAT:
+            return cls.from_dict(data)
+        return cls.from_csr(data["tokens"], data["states"], _unpack(data["offsets"]),
+                            _unpack(data["targets"]), _unpack(data["counts"]))
+
+    def csr(self):
+        """ Concatenate the per-state arrays into offsets, targets and counts
+
+        Packing happens when the model is stored, so the token lookups kept \
+            for training are released and rebuilt if the model is trained again.
+        """
+        self.slots = {}
+        offsets = array(UINT32, [0])
+        targets = array(UINT32)
+        counts = array(UINT32)
+        for state_targets, state_counts in zip(self.targets, self.counts):
+            targets.extend(state_targets)
+            counts.extend(state_counts)
+            offsets.append(len(targets))
+        return offsets, targets, counts
+
+    @classmethod
+    def from_csr(cls, tokens: list, states: list, offsets: array, targets: array, counts: array):
+        """ Build a model from its concatenated (CSR-style) arrays """
+        model = cls()
+        model.tokens = list(tokens)
+        model.token_ids = {token: i for i, token in enumerate(model.tokens)}
+        model.states = {state: i for i, state in enumerate(states)}
+        for start, end in zip(offsets, offsets[1:]):
+            model.targets.append(targets[start:end])
+            model.counts.append(counts[start:end])
+        return model
+
+    def __reduce__(self):
+        # Pickle as flat buffers, e.g. when shipping models to worker processes
+        return _from_buffers, (self.tokens, list(self.states),
+                               *(values.tobytes() for values in self.csr()))
+
+    def dump(self) -> dict:
+        """ Produce the compact (CSR-style) representation for storage """
+        offsets, targets, counts = self.csr()
+        return {"format": PACKED_FORMAT,
+                "tokens": list(self.tokens),
+                "states": list(self.states),
+                "offsets": _pack(offsets),
+                "targets": _pack(targets),
+                "counts": _pack(counts)}
+
+
+def _from_buffers(tokens: list, states: list, *buffers: bytes) -> MarkovModel:
+    """ Unpickle a model from native-endian array buffers """
+    arrays = []
+    for buffer in buffers:
+        values = array(UINT32)
+        values.frombytes(buffer)
+        arrays.append(values)
+    return MarkovModel.from_csr(tokens, states, *arrays)
+
+
+def word_gram(model, state: str, end: str) -> str:
+    """ Generate text for word-mode vectorization """
+    # Remove word boundaries from ngram; whitespace is added back later
+    state = state.replace(" ", "")
+    # Choose the next word taking into account recorded vector weights
+    gram = model.choose(state)  # Caution: basically magic
+    return spaced(state, gram, end)
+
+
+def spaced(state: str, gram: str, end: str) -> str:
+    """ Format a generated word, adding a space after the previous one if needed """
+    # Don't worry about it ;)
+    prepend_space = all((state != end,
+                         gram[-1].isalnum() or gram in "\"([{|",
+                         state[-1] not in "\"([{'/-_"))
+    # Format gram
+    return f"{' ' if prepend_space else ''}{gram}"
+
+
+def chunk_gram(model, state: str, end: str) -> str:
+    """ Generate text for chunk-mode vectorization """
+    return model.choose(state)
+
+
+def generate(model, depth: int, mode: str, end: str) -> str:
+    """ Generate text from a model until it transitions to the control marker """
+    generator = word_gram if mode == "word" else chunk_gram
+    output = []
+    i = 0
+    gram = ""
+    # Begin in a state of transitioning from message boundary
+    state = end
+    while gram.strip() != end:
+        # Generate and store next gram, ending early on states that were pruned
+        try:
+            gram = generator(model, state, end)
+        except KeyError:
+            if not output:
+                raise
+            output.append(end)
+            break
+        output.append(gram)
+        # Produce sliding state window (ngram)
+        i += 1
+        j = i - depth if i > depth else 0
+        state = "".join(output[j:i])
+    return "".join(output[:-1])
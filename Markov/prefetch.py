@@ -0,0 +1,98 @@
+import time
+from collections import OrderedDict, deque
+
+__all__ = ["SentenceBuffer"]
+
+# Overhead charged for every buffered sentence on top of its length
+SENTENCE_COST = 64
+# Most pools kept, dropping the least recently used
+POOL_LIMIT = 256
+# Seconds a pool is kept after text was last requested from it
+POOL_IDLE = 3600
+
+
+class SentenceBuffer:
+    """ Pools of pre-generated sentences for recently used models
+
+    Pools are keyed by (scope, owner ID, model key) and created once text \
+        has been generated on demand, so only models people actually \
+        generate from are refilled. Least recently used pools are dropped to \
+        stay within the memory budget and `POOL_LIMIT`, and pools nobody has \
+        used for `POOL_IDLE` seconds are dropped before refilling.
+    """
+    def __init__(self, size: int, budget: int):
+        self.size = size        # Sentences kept ready per model
+        self.budget = budget    # Memory budget in bytes across all pools
+        self.pools = OrderedDict()
+        self.used = {}          # Pool key -> monotonic time text was last requested
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def take(self, key: tuple):
+        """ Get a buffered sentence for a model, or None if there is none ready """
+        if not self.size:
+            return None
+        pool = self.pools.get(key)
+        if pool is not None:
+            self.pools.move_to_end(key)
+            self.used[key] = time.monotonic()
+        if not pool:
+            self.misses += 1
+            return None
+        self.hits += 1
+        text = pool.popleft()
+        self.nbytes -= len(text) + SENTENCE_COST
+        return text
+
+    def track(self, key: tuple):
+        """ Start buffering for a model that text was just generated from """
+        if not self.size:
+            return
+        if key not in self.pools:
+            self.pools[key] = deque()
+            while len(self.pools) > POOL_LIMIT:
+                self.drop(next(iter(self.pools)))
+        self.pools.move_to_end(key)
+        self.used[key] = time.monotonic()
+
+    def wanted(self):
+        """ List (key, pool, missing) for pools that need refilling, most recent first """
+        idle = time.monotonic() - POOL_IDLE
+        for key in [k for k, used in self.used.items() if used < idle]:
+            self.drop(key)
+        return [(key, pool, self.size - len(pool))
+                for key, pool in reversed(self.pools.items())
+                if len(pool) < self.size]
+
+    def put(self, key: tuple, pool: deque, text: str) -> bool:
+        """ Add a generated sentence unless its pool was invalidated meanwhile """
+        if self.pools.get(key) is not pool or len(pool) >= self.size:
+            return False
+        pool.append(text)
+        self.nbytes += len(text) + SENTENCE_COST
+        while self.nbytes > self.budget and self.pools:
+            oldest = next(iter(self.pools))
+            if oldest == key and len(self.pools) > 1:
+                self.pools.move_to_end(key)
+                continue
+            self.drop(oldest)
+        return key in self.pools
+
+    def drop(self, key: tuple):
+        """ Remove a pool and release its sentences """
+        pool = self.pools.pop(key, None)
+        self.used.pop(key, None)
+        if pool is not None:
+            self.nbytes -= sum(len(text) + SENTENCE_COST for text in pool)
+
+    def invalidate(self, scope: str, owner_id: int, key: str = None):
+        """ Drop an owner's pools (or the pool of one model) after it changed """
+        for pool_key in [k for k in self.pools if k[:2] == (scope, owner_id)]:
+            if key is None or pool_key[2] == key:
+                self.drop(pool_key)
+
+    def clear(self):
+        self.pools.clear()
+        self.used.clear()
+        self.nbytes = 0
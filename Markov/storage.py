@@ -0,0 +1,579 @@
+import asyncio
+import logging
+import random
+import sqlite3
+import threading
+import time
+from bisect import bisect
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate, count
+from pathlib import Path
+
+from .binary import mapped, write_binary
+from .model import MarkovModel
+from .trie import TRIE_FORMAT, NgramTrie, decode_context, encode_context
+
+log = logging.getLogger("red.cbd-cogs.markov")
+
+__all__ = ["ConfigStore", "SQLiteModel", "SQLiteTrie", "SQLiteStore",
+           "is_trie", "load_model", "open_store", "migrate"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS ngrams (
+    user INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    state TEXT NOT NULL,
+    token TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (user, model, state, token)
+)
+"""
+UPSERT = """
+INSERT INTO ngrams (user, model, state, token, count) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (user, model, state, token) DO UPDATE SET count = count + excluded.count
+"""
+PRUNE_TOP_K = """
+DELETE FROM ngrams WHERE rowid IN (
+    SELECT rowid FROM (
+        SELECT rowid, ROW_NUMBER() OVER (PARTITION BY state ORDER BY count DESC, rowid) AS rank
+        FROM ngrams WHERE user = ? AND model = ?
+    ) WHERE rank > ?
+)
+"""
+# Rows written per executemany call
+BATCH_SIZE = 5000
+# Sampling tables kept per SQLite model before the cache is cleared
+TABLE_LIMIT = 1024
+# Seconds a replaced binary copy is kept for jobs that were already sent its path
+MAPPED_AGE = 60
+
+
+def is_trie(key: str) -> bool:
+    """ Check whether a model key refers to a multi-depth trie model """
+    return key.endswith("-trie")
+
+
+def load_model(data: dict):
+    """ Load a model of the type recorded in its stored representation """
+    if data.get("format") == TRIE_FORMAT:
+        return NgramTrie.load(data)
+    return MarkovModel.load(data)
+
+
+def model_rows(user_id: int, key: str, model):
+    """ Flatten an in-memory model into (user, model, state, token, count) rows """
+    return [(user_id, key, encode_context(state) if isinstance(state, tuple) else state,
+             token, count)
+            for state, vector in model.items()
+            for token, count in vector.items()]
+
+
+class ConfigStore:
+    """ Stores each user's (or guild's) models as packed blobs in Red's Config
+
+    Models can also be kept as binary copies under `path`, so generating \
+        from a model that isn't cached maps its file instead of parsing the \
+        blob. Config records which copy is current and every write to a \
+        model forgets its copy.
+    """
+    name = "config"
+
+    def __init__(self, conf, scope: str = "user", path: Path = None):
+        self.conf = conf
+        self.scope = scope
+        self.group = conf.guild_from_id if scope == "guild" else conf.user_from_id
+        self.path = path          # Folder of binary copies, or None to not keep any
+        self.writes = Counter()   # User ID -> model writes, to spot copies made stale while written
+        self.names = count()      # Source of unique copy file names
+        self.stale = []           # (time, path) of replaced copies
+
+    def new(self, user_id: int, key: str):
+        return NgramTrie() if is_trie(key) else MarkovModel()
+
+    async def load(self, user_id: int, key: str):
+        data = await self.group(user_id).chains.get_raw(key, default=None)
+        if data is None:
+            return None
+        return load_model(data)
+
+    async def save(self, user_id: int, key: str, model: MarkovModel):
+        await self.unmap(user_id, key)
+        await self.group(user_id).chains.set_raw(key, value=model.dump())
+
+    async def read(self, user_id: int, key: str) -> MarkovModel:
+        """ Load a complete model into memory """
+        return await self.load(user_id, key) or self.new(user_id, key)
+
+    async def write(self, user_id: int, key: str, model: MarkovModel):
+        """ Replace a stored model with the given one """
+        await self.save(user_id, key, model)
+
+    async def size(self, user_id: int, key: str, model: MarkovModel = None) -> int:
+        """ Approximate the size of a stored model in bytes """
+        model = model or await self.load(user_id, key)
+        return model.nbytes() if model else 0
+
+    async def weight(self, user_id: int, key: str, model: MarkovModel = None) -> int:
+        """ Count the transitions a stored model was trained on """
+        model = model or await self.load(user_id, key)
+        return model.weight() if model else 0
+
+    async def compact(self, user_id: int, key: str, model: MarkovModel,
+                      top_k: int, min_count: int, decay: float):
+        """ Decay and prune a model, returning its size before and after """
+        before = model.nbytes()
+        model.compact(top_k, min_count, decay)
+        await self.save(user_id, key, model)
+        return before, model.nbytes()
+
+    async def fit(self, user_id: int, key: str, model: MarkovModel, budget: int) -> int:
+        """ Prune a model's rarest transitions until it fits in a budget """
+        model.fit(budget)
+        await self.save(user_id, key, model)
+        return model.nbytes()
+
+    async def persist(self, user_id: int, key: str, model: MarkovModel):
+        """ Write a binary copy of a model that matches the stored one, replacing any old copy """
+        if self.path is None:
+            return
+        writes = self.writes[user_id]
+        # Copy the arrays before anything can train the model further
+        function, args = model.__reduce__()
+        args = (list(args[0]), *args[1:])
+        path = self.path / f"{user_id}-{key}-{next(self.names)}-{time.time_ns()}.mkv"
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, write_binary, path, function, args, key)
+        old = await self.group(user_id).mapped.get_raw(key, default=None)
+        if self.writes[user_id] != writes:
+            # The stored model changed while the copy was written
+            self.retire(path)
+            return
+        await self.group(user_id).mapped.set_raw(key, value=path.name)
+        if old is not None:
+            self.retire(self.path / old)
+
+    async def mapped(self, user_id: int, key: str):
+        """ Map a stored model's binary copy for generation, or get None if it has none """
+        name = await self.group(user_id).mapped.get_raw(key, default=None)
+        if name is None or self.path is None:
+            return None
+        try:
+            return mapped(self.path / name)
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring unreadable copy of model {key} of {user_id}: {e}")
+            await self.unmap(user_id, key)
+            return None
+
+    async def unmap(self, user_id: int, key: str = None):
+        """ Forget the binary copy of a model (or all of a user's models) """
+        self.writes[user_id] += 1
+        copies = await self.group(user_id).mapped()
+        if key is None:
+            names, copies = list(copies.values()), {}
+        else:
+            names = [copies.pop(key)] if key in copies else []
+        if not names:
+            return
+        await self.group(user_id).mapped.set(copies)
+        if self.path is not None:
+            for name in names:
+                self.retire(self.path / name)
+
+    def retire(self, path: Path):
+        """ Remove a replaced copy once jobs that were sent its path are done """
+        self.stale.append((time.monotonic(), path))
+        while self.stale and time.monotonic() - self.stale[0][0] > MAPPED_AGE:
+            try:
+                self.stale.pop(0)[1].unlink()
+            except OSError:
+                pass
+
+    async def users(self):
+        configs = await (self.conf.all_guilds() if self.scope == "guild"
+                         else self.conf.all_users())
+        return [user_id for user_id, data in configs.items() if data.get("chains")]
+
+    async def keys(self, user_id: int):
+        return list(await self.group(user_id).chains())
+
+    async def delete(self, user_id: int, key: str) -> bool:
+        chains = await self.group(user_id).chains()
+        if key not in chains:
+            return False
+        await self.unmap(user_id, key)
+        del chains[key]
+        await self.group(user_id).chains.set(chains)
+        return True
+
+    async def reset(self, user_id: int):
+        await self.unmap(user_id)
+        await self.group(user_id).chains.set({})
+
+    async def close(self):
+        # Nothing samples the replaced copies once the store is closed
+        for _, path in self.stale:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+        self.stale.clear()
+
+
+class SQLiteModel:
+    """ A model whose transitions live in the SQLite store
+
+    Training is buffered in memory until the store flushes it as a batch, \
+        and sampling only reads the rows for the state being generated.
+    """
+    __slots__ = ("store", "user_id", "key", "pending", "tables", "epoch")
+
+    def __init__(self, store, user_id: int, key: str):
+        self.store = store
+        self.user_id = user_id
+        self.key = key
+        self.pending = {}  # State -> {token: count} not yet written
+        self.tables = {}   # State -> (tokens, cumulative weights)
+        self.epoch = 0     # Incremented whenever the model's transitions change
+
+    def __reduce__(self):
+        # Worker processes open the database themselves rather than sharing connections
+        return _reopen, (type(self), self.store.path, self.user_id, self.key, self.pending)
+
+    def __contains__(self, state: str):
+        return state in self.pending or self.store.has_state(self.user_id, self.key, state)
+
+    def add(self, state: str, token: str, count: int = 1):
+        """ Buffer an increment to the weight of a state transition """
+        self.epoch += 1
+        self.tables.pop(state, None)
+        vector = self.pending.setdefault(state, {})
+        vector[token] = vector.get(token, 0) + count
+
+    def merge(self, vectors: dict):
+        """ Buffer a batch of {state: {token: count}} transition counts """
+        self.epoch += 1
+        for state, vector in vectors.items():
+            self.tables.pop(state, None)
+            pending = self.pending.setdefault(state, {})
+            for token, count in vector.items():
+                pending[token] = pending.get(token, 0) + count
+
+    def subtract(self, vectors: dict):
+        """ Buffer the removal of a batch of transition counts """
+        self.merge({state: {token: -count for token, count in vector.items()}
+                    for state, vector in vectors.items()})
+
+    def invalidate(self):
+        """ Forget sampling tables after the stored rows were changed """
+        self.epoch += 1
+        self.tables.clear()
+
+    def snapshot(self):
+        """ Copy the model so it can be sampled off the event loop while training continues """
+        snapshot = type(self)(self.store, self.user_id, self.key)
+        snapshot.pending = {state: dict(vector) for state, vector in self.pending.items()}
+        snapshot.tables = dict(self.tables)
+        snapshot.epoch = self.epoch
+        return snapshot
+
+    def adopt(self, snapshot):
+        """ Keep the sampling tables a snapshot built, unless the model changed since """
+        if snapshot.epoch == self.epoch and len(snapshot.tables) < TABLE_LIMIT:
+            self.tables = snapshot.tables
+
+    def take(self):
+        """ Remove and return the buffered transitions as rows """
+        pending, self.pending = self.pending, {}
+        return [(self.user_id, self.key, state, token, count)
+                for state, vector in pending.items()
+                for token, count in vector.items()]
+
+    def table(self, state: str):
+        """ Get the tokens and cumulative weights for a state """
+        table = self.tables.get(state)
+        if table is None:
+            vector = dict(self.store.state_rows(self.user_id, self.key, state))
+            for token, count in self.pending.get(state, {}).items():
+                vector[token] = vector.get(token, 0) + count
+            # Pending subtractions may cancel out stored counts
+            vector = {token: count for token, count in vector.items() if count > 0}
+            if not vector:
+                raise KeyError(state)
+            if len(self.tables) >= TABLE_LIMIT:
+                self.tables.clear()
+            table = self.tables[state] = (list(vector), list(accumulate(vector.values())))
+        return table
+
+    def choose(self, state: str) -> str:
+        """ Choose the next token for a state according to its weights """
+        tokens, weights = self.table(state)
+        return tokens[bisect(weights, random.random() * (weights[-1] + 0.0), 0, len(weights) - 1)]
+
+    def nbytes(self) -> int:
+        """ Approximate the memory used by buffered rows and tables """
+        pending = sum(len(state) + sum(len(t) + 8 for t in vector)
+                      for state, vector in self.pending.items())
+        tables = sum(sum(len(t) + 8 for t in tokens) for tokens, _ in self.tables.values())
+        return pending + tables
+
+
+class SQLiteTrie(SQLiteModel):
+    """ A multi-depth trie model whose transitions live in the SQLite store
+
+    Each context is stored as its own state, encoded most recent token \
+        first, so generation looks up progressively shorter contexts until \
+        one has been seen.
+    """
+    __slots__ = ()
+
+    def add(self, context: tuple, token: str, count: int = 1):
+        """ Buffer an increment to the weight of a context transition """
+        super().add(encode_context(context), token, count)
+
+    def merge(self, vectors: dict):
+        """ Buffer a batch of {context: {token: count}} transition counts """
+        super().merge({encode_context(context): vector for context, vector in vectors.items()})
+
+    def choose(self, history: list, depth: int) -> str:
+        """ Choose the next token after a history, backing off as needed """
+        for length in range(min(depth, len(history)), -1, -1):
+            try:
+                return super().choose(encode_context(tuple(reversed(history[-length:])))
+                                      if length else "")
+            except KeyError:
+                continue
+        raise KeyError("model is empty")
+
+
+class SQLiteStore:
+    """ Stores models as (user, model, state, token) -> count rows in SQLite
+
+    Batched writes run on a single background thread and queries on \
+        another, so the event loop never waits on the database. Each thread \
+        reading the database, including generation workers, uses its own \
+        connection, which WAL mode allows to proceed alongside the writer.
+    """
+    name = "sqlite"
+
+    def __init__(self, path: Path):
+        self.path = str(path)
+        self.local = threading.local()  # Each thread's reader connection
+        self.readers = []               # Every reader connection, for closing
+        self.readers_lock = threading.Lock()
+        self.writer = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="markov-sqlite")
+        self.reader_executor = ThreadPoolExecutor(max_workers=1,
+                                                  thread_name_prefix="markov-sqlite-read")
+        schema = self.connect()
+        schema.executescript(SCHEMA)
+        schema.close()
+
+    def connect(self):
+        # Connections are closed from whichever thread closes the store
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    @property
+    def reader(self):
+        """ The calling thread's connection for reads """
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.connect()
+            with self.readers_lock:
+                self.readers.append(connection)
+        return connection
+
+    async def run(self, function, *args):
+        """ Run a write operation on the writer thread """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def query(self, function, *args):
+        """ Run a read operation on the reader thread """
+        return await asyncio.get_running_loop().run_in_executor(self.reader_executor,
+                                                                function, *args)
+
+    def fetch(self, sql: str, parameters: tuple = ()) -> list:
+        return self.reader.execute(sql, parameters).fetchall()
+
+    def _write(self, statements):
+        if self.writer is None:
+            self.writer = self.connect()
+        with self.writer:
+            for sql, rows in statements:
+                for i in range(0, len(rows), BATCH_SIZE):
+                    self.writer.executemany(sql, rows[i:i + BATCH_SIZE])
+
+    def has_state(self, user_id: int, key: str, state: str) -> bool:
+        return self.reader.execute(
+            "SELECT 1 FROM ngrams WHERE user = ? AND model = ? AND state = ? LIMIT 1",
+            (user_id, key, state)).fetchone() is not None
+
+    def state_rows(self, user_id: int, key: str, state: str):
+        return self.reader.execute(
+            "SELECT token, count FROM ngrams WHERE user = ? AND model = ? AND state = ? "
+            "ORDER BY rowid", (user_id, key, state)).fetchall()
+
+    def new(self, user_id: int, key: str):
+        return (SQLiteTrie if is_trie(key) else SQLiteModel)(self, user_id, key)
+
+    async def load(self, user_id: int, key: str):
+        exists = await self.query(self.fetch,
+                                  "SELECT 1 FROM ngrams WHERE user = ? AND model = ? LIMIT 1",
+                                  (user_id, key))
+        return self.new(user_id, key) if exists else None
+
+    async def save(self, user_id: int, key: str, model: SQLiteModel):
+        rows = model.take()
+        if not rows:
+            return
+        statements = [(UPSERT, rows)]
+        if any(count < 0 for *_, count in rows):
+            # Drop transitions whose counts were subtracted away
+            statements.append(("DELETE FROM ngrams WHERE user = ? AND model = ? AND count <= 0",
+                               [(user_id, key)]))
+        await self.run(self._write, statements)
+
+    async def read(self, user_id: int, key: str):
+        """ Load a complete model into memory """
+        return await self.query(self._read, user_id, key)
+
+    def _read(self, user_id: int, key: str):
+        trie = is_trie(key)
+        model = NgramTrie() if trie else MarkovModel()
+        for state, token, count in self.reader.execute(
+                "SELECT state, token, count FROM ngrams WHERE user = ? AND model = ? "
+                "ORDER BY rowid", (user_id, key)):
+            model.add(decode_context(state) if trie else state, token, count)
+        return model
+
+    async def write(self, user_id: int, key: str, model):
+        """ Replace a stored model with the given one """
+        await self.run(self._write, [
+            ("DELETE FROM ngrams WHERE user = ? AND model = ?", [(user_id, key)]),
+            (UPSERT, model_rows(user_id, key, model))])
+
+    async def size(self, user_id: int, key: str, model: SQLiteModel = None) -> int:
+        """ Approximate the size of a stored model in bytes """
+        (size,), = await self.query(
+            self.fetch, "SELECT COALESCE(SUM(LENGTH(state) + LENGTH(token) + 8), 0) FROM ngrams "
+            "WHERE user = ? AND model = ?", (user_id, key))
+        return size
+
+    async def weight(self, user_id: int, key: str, model: SQLiteModel = None) -> int:
+        """ Count the transitions a stored model was trained on """
+        # Tries count every transition once more from the empty context
+        trie = is_trie(key)
+        (weight,), = await self.query(
+            self.fetch, "SELECT COALESCE(SUM(count), 0) FROM ngrams WHERE user = ? AND model = ?"
+            + (" AND state = ''" if trie else ""), (user_id, key))
+        if model is not None:
+            pending = [model.pending.get("", {})] if trie else model.pending.values()
+            weight += sum(sum(vector.values()) for vector in pending)
+        return weight
+
+    async def compact(self, user_id: int, key: str, model: SQLiteModel,
+                      top_k: int, min_count: int, decay: float):
+        """ Decay and prune a model, returning its size before and after """
+        await self.save(user_id, key, model)
+        before = await self.size(user_id, key)
+        statements = []
+        if decay != 1.0:
+            statements.append(("UPDATE ngrams SET count = CAST(count * ? AS INTEGER) "
+                               "WHERE user = ? AND model = ?", [(decay, user_id, key)]))
+        statements.append(("DELETE FROM ngrams WHERE user = ? AND model = ? AND count < ?",
+                           [(user_id, key, max(min_count, 1))]))
+        if top_k:
+            statements.append((PRUNE_TOP_K, [(user_id, key, top_k)]))
+        await self.run(self._write, statements)
+        model.invalidate()
+        return before, await self.size(user_id, key)
+
+    async def fit(self, user_id: int, key: str, model: SQLiteModel, budget: int) -> int:
+        """ Prune a model's rarest transitions until it fits in a budget """
+        await self.save(user_id, key, model)
+        threshold = 1
+        while (size := await self.size(user_id, key)) > budget:
+            threshold = max(threshold + 1, int(threshold * 1.5))
+            await self.run(self._write, [
+                ("DELETE FROM ngrams WHERE user = ? AND model = ? AND count < ?",
+                 [(user_id, key, threshold)])])
+        model.invalidate()
+        return size
+
+    async def persist(self, user_id: int, key: str, model: SQLiteModel):
+        # Sampling only ever reads the rows it needs, so there is nothing to copy
+        pass
+
+    async def mapped(self, user_id: int, key: str):
+        return None
+
+    async def users(self):
+        return [user_id for user_id, in await self.query(self.fetch,
+                                                         "SELECT DISTINCT user FROM ngrams")]
+
+    async def keys(self, user_id: int):
+        return [key for key, in await self.query(
+            self.fetch, "SELECT DISTINCT model FROM ngrams WHERE user = ?", (user_id,))]
+
+    async def delete(self, user_id: int, key: str) -> bool:
+        if await self.load(user_id, key) is None:
+            return False
+        await self.run(self._write, [
+            ("DELETE FROM ngrams WHERE user = ? AND model = ?", [(user_id, key)])])
+        return True
+
+    async def reset(self, user_id: int):
+        await self.run(self._write, [("DELETE FROM ngrams WHERE user = ?", [(user_id,)])])
+
+    async def close(self):
+        await self.run(self._close_writer)
+        self.executor.shutdown()
+        self.reader_executor.shutdown()
+        with self.readers_lock:
+            for connection in self.readers:
+                connection.close()
+            self.readers.clear()
+
+    def _close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+# Stores opened by worker processes to sample SQLite models, by database path
+_worker_stores = {}
+
+
+def _reopen(cls, path: str, user_id: int, key: str, pending: dict):
+    """ Unpickle a SQLite model in a worker process """
+    store = _worker_stores.get(path)
+    if store is None:
+        store = _worker_stores[path] = SQLiteStore(path)
+    model = cls(store, user_id, key)
+    model.pending = pending
+    return model
+
+
+async def open_store(conf, path: Path, backend: str = None, scope: str = "user"):
+    """ Open the storage backend selected in the global config
+
+    User models and guild models (`scope="guild"`) are kept apart, \
+        with guild IDs in place of user IDs.
+    """
+    backend = backend or await conf.backend()
+    if backend == SQLiteStore.name:
+        return SQLiteStore(path / ("guilds.sqlite3" if scope == "guild" else "models.sqlite3"))
+    return ConfigStore(conf, scope, path / "models" / scope)
+
+
+async def migrate(source, target):
+    """ Copy every user's models from one store to another """
+    copied = 0
+    for user_id in await source.users():
+        for key in await source.keys(user_id):
+            await target.write(user_id, key, await source.read(user_id, key))
+            copied += 1
+    return copied
@@ -0,0 +1,316 @@
+import random
+from array import array
+from bisect import bisect
+from itertools import accumulate
+
+from .model import SLOT_INDEX_MIN, UINT32, _pack, _unpack, prune, spaced, tokenize
+
+__all__ = ["NgramTrie", "count_contexts", "generate_backoff", "encode_context", "decode_context"]
+
+# Marker identifying the serialized trie representation
+TRIE_FORMAT = "trie-1"
+# Joins context tokens into a single state string for storage backends
+CONTEXT_SEPARATOR = "\x1f"
+
+
+def encode_context(context: tuple) -> str:
+    """ Encode a context tuple as a state string """
+    return CONTEXT_SEPARATOR.join(context)
+
+
+def decode_context(state: str) -> tuple:
+    """ Decode a state string produced by `encode_context` """
+    return tuple(state.split(CONTEXT_SEPARATOR)) if state else ()
+
+
+def count_contexts(contents: list, mode: str, depth: int, end: str) -> dict:
+    """ Tokenize messages and count transitions for every context up to `depth`
+
+    Contexts are tuples of the preceding tokens, most recent first, so the \
+        result is {context: {token: count}} including the empty context.
+    """
+    vectors = {}
+    for content in contents:
+        tokens, _ = tokenize(content, mode, end)
+        if tokens is None:
+            break
+        # Messages begin with the control marker as their only history
+        history = [end]
+        for token in tokens:
+            context = ()
+            for i in range(min(depth, len(history)) + 1):
+                if i:
+                    context += (history[-i],)
+                vector = vectors.setdefault(context, {})
+                vector[token] = vector.get(token, 0) + 1
+            history.append(token)
+    return vectors
+
+
+class NgramTrie:
+    """ Transition counts for every ngram depth in one prefix tree
+
+    Each node is a context of preceding tokens (most recent first) so \
+        contexts sharing recent tokens share nodes, and the root holds the \
+        counts for the empty context. Generation walks as deep as the \
+        history allows and samples from the deepest node it reaches.
+    """
+    __slots__ = ("tokens", "token_ids", "children", "targets", "counts", "tables", "slots")
+
+    def __init__(self):
+        self.tokens = []               # Token ID -> token string
+        self.token_ids = {}            # Token string -> token ID
+        self.children = [None]         # Node -> {token ID: child node} or None
+        self.targets = [array(UINT32)]  # Node -> array of token IDs
+        self.counts = [array(UINT32)]   # Node -> array of transition counts
+        self.tables = {}               # Node -> cumulative weights for sampling
+        self.slots = {}                # Node -> {token ID: position}, for nodes being trained
+
+    def __len__(self):
+        return len(self.targets)
+
+    def intern(self, token: str) -> int:
+        """ Get the ID for a token, assigning a new one if necessary """
+        token_id = self.token_ids.get(token)
+        if token_id is None:
+            token_id = self.token_ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+    def child(self, node: int, token_id: int) -> int:
+        """ Get a node's child for a token, creating it if necessary """
+        children = self.children[node]
+        if children is None:
+            children = self.children[node] = {}
+        child = children.get(token_id)
+        if child is None:
+            child = children[token_id] = len(self.targets)
+            self.children.append(None)
+            self.targets.append(array(UINT32))
+            self.counts.append(array(UINT32))
+        return child
+
+    def add(self, context: tuple, token: str, count: int = 1):
+        """ Increment the weight of a transition from a context """
+        node = 0
+        for previous in context:
+            node = self.child(node, self.intern(previous))
+        self.tables.pop(node, None)
+        token_id = self.intern(token)
+        targets = self.targets[node]
+        slots = self.slots.get(node)
+        if slots is None and len(targets) >= SLOT_INDEX_MIN:
+            # Scanning is cheaper than a dict until a node fans out
+            slots = self.slots[node] = {t: i for i, t in enumerate(targets)}
+        if slots is not None:
+            position = slots.get(token_id)
+        else:
+            try:
+                position = targets.index(token_id)
+            except ValueError:
+                position = None
+        if position is None:
+            if slots is not None:
+                slots[token_id] = len(targets)
+            targets.append(token_id)
+            self.counts[node].append(count)
+        else:
+            self.counts[node][position] += count
+
+    def merge(self, vectors: dict):
+        """ Add a batch of {context: {token: count}} transition counts """
+        for context, vector in vectors.items():
+            for token, count in vector.items():
+                self.add(context, token, count)
+
+    def subtract(self, vectors: dict):
+        """ Remove a batch of {context: {token: count}} transition counts
+
+        Counts never drop below zero, and transitions that reach zero are \
+            removed. Nodes left empty are dropped by the next compaction.
+        """
+        for context, vector in vectors.items():
+            node = 0
+            for previous in context:
+                node = (self.children[node] or {}).get(self.token_ids.get(previous))
+                if node is None:
+                    break
+            if node is None:
+                continue
+            self.tables.pop(node, None)
+            # Positions shift as transitions are removed, so the lookup is rebuilt after
+            self.slots.pop(node, None)
+            targets, counts = self.targets[node], self.counts[node]
+            positions = {t: i for i, t in enumerate(targets)}
+            emptied = False
+            for token, count in vector.items():
+                position = positions.get(self.token_ids.get(token))
+                if position is None or counts[position] == 0:
+                    continue
+                counts[position] = max(counts[position] - count, 0)
+                emptied = emptied or not counts[position]
+            if emptied:
+                pairs = [(t, c) for t, c in zip(targets, counts) if c]
+                self.targets[node] = array(UINT32, (t for t, _ in pairs))
+                self.counts[node] = array(UINT32, (c for _, c in pairs))
+
+    def find(self, history: list, depth: int) -> int:
+        """ Find the deepest node with transitions for the end of a history """
+        node = found = 0
+        for previous in reversed(history[-depth:] if depth > 0 else ()):
+            children = self.children[node]
+            token_id = self.token_ids.get(previous)
+            if children is None or token_id not in children:
+                break
+            node = children[token_id]
+            if self.targets[node]:
+                found = node
+        return found
+
+    def choose(self, history: list, depth: int) -> str:
+        """ Choose the next token after a history, backing off as needed """
+        node = self.find(history, depth)
+        if not self.targets[node]:
+            raise KeyError("model is empty")
+        table = self.tables.get(node)
+        if table is None:
+            table = self.tables[node] = array("Q", accumulate(self.counts[node]))
+        position = bisect(table, random.random() * (table[-1] + 0.0), 0, len(table) - 1)
+        return self.tokens[self.targets[node][position]]
+
+    def items(self):
+        """ Yield (context, {token: count}) pairs for every node """
+        stack = [(0, ())]
+        while stack:
+            node, context = stack.pop()
+            if self.targets[node]:
+                yield context, {self.tokens[t]: c
+                                for t, c in zip(self.targets[node], self.counts[node])}
+            for token_id, child in (self.children[node] or {}).items():
+                stack.append((child, context + (self.tokens[token_id],)))
+
+    def compact(self, top_k: int = 0, min_count: int = 1, decay: float = 1.0):
+        """ Decay and prune transition counts, dropping nodes left empty """
+        tokens, children = self.tokens, self.children
+        targets, counts = self.targets, self.counts
+        self.__init__()
+        stack = [(0, 0)]  # (old node, new node)
+        pairs = prune(targets[0], counts[0], top_k, min_count, decay)
+        self.targets[0] = array(UINT32, (self.intern(tokens[t]) for t, _ in pairs))
+        self.counts[0] = array(UINT32, (c for _, c in pairs))
+        while stack:
+            old, new = stack.pop()
+            for token_id, child in (children[old] or {}).items():
+                pairs = prune(targets[child], counts[child], top_k, min_count, decay)
+                # Longer contexts never outweigh the shorter ones they extend,
+                # so an emptied node's descendants are dropped along with it
+                if not pairs:
+                    continue
+                node = self.child(new, self.intern(tokens[token_id]))
+                self.targets[node] = array(UINT32, (self.intern(tokens[t]) for t, _ in pairs))
+                self.counts[node] = array(UINT32, (c for _, c in pairs))
+                stack.append((child, node))
+
+    def fit(self, budget: int):
+        """ Prune the rarest transitions until the model fits in `budget` bytes """
+        threshold = 1
+        while self.targets[0] and self.nbytes() > budget:
+            threshold = max(threshold + 1, int(threshold * 1.5))
+            self.compact(min_count=threshold)
+
+    def weight(self) -> int:
+        """ Count the transitions the model was trained on """
+        # Every transition is also counted from the empty context
+        return sum(self.counts[0])
+
+    def nbytes(self) -> int:
+        """ Approximate the memory used by the model's data """
+        strings = sum(len(token) for token in self.tokens)
+        arrays = sum(len(t) for t in self.targets) * 4 * 2
+        nodes = len(self.targets) * 16
+        tables = sum(len(t) for t in self.tables.values()) * 8
+        # Roughly a dict entry and an int object per indexed transition
+        slots = sum(len(s) for s in self.slots.values()) * 64
+        return strings + arrays + nodes + tables + slots
+
+    def csr(self):
+        """ Flatten the tree into parent, edge, offset, target and count arrays
+
+        Like `MarkovModel.csr`, this releases the token lookups kept for training.
+        """
+        self.slots = {}
+        parents = array(UINT32, [0] * (len(self.targets) - 1))
+        edges = array(UINT32, [0] * (len(self.targets) - 1))
+        for node, children in enumerate(self.children):
+            for token_id, child in (children or {}).items():
+                parents[child - 1] = node
+                edges[child - 1] = token_id
+        offsets = array(UINT32, [0])
+        targets = array(UINT32)
+        counts = array(UINT32)
+        for node_targets, node_counts in zip(self.targets, self.counts):
+            targets.extend(node_targets)
+            counts.extend(node_counts)
+            offsets.append(len(targets))
+        return parents, edges, offsets, targets, counts
+
+    @classmethod
+    def from_csr(cls, tokens: list, parents: array, edges: array,
+                 offsets: array, targets: array, counts: array):
+        """ Build a trie from its flattened arrays """
+        trie = cls()
+        trie.tokens = list(tokens)
+        trie.token_ids = {token: i for i, token in enumerate(trie.tokens)}
+        trie.children = [None] * (len(offsets) - 1)
+        trie.targets = [targets[start:end] for start, end in zip(offsets, offsets[1:])]
+        trie.counts = [counts[start:end] for start, end in zip(offsets, offsets[1:])]
+        # Nodes are numbered in creation order so parents precede children
+        for child, (parent, token_id) in enumerate(zip(parents, edges), 1):
+            if trie.children[parent] is None:
+                trie.children[parent] = {}
+            trie.children[parent][token_id] = child
+        return trie
+
+    def __reduce__(self):
+        # Pickle as flat buffers, e.g. when shipping models to worker processes
+        return _from_buffers, (self.tokens, *(values.tobytes() for values in self.csr()))
+
+    @classmethod
+    def load(cls, data: dict):
+        """ Load a trie from its stored representation """
+        return cls.from_csr(data["tokens"], *(_unpack(data[name]) for name in
+                                               ("parents", "edges", "offsets", "targets", "counts")))
+
+    def dump(self) -> dict:
+        """ Produce the compact representation for storage """
+        parents, edges, offsets, targets, counts = self.csr()
+        return {"format": TRIE_FORMAT,
+                "tokens": list(self.tokens),
+                "parents": _pack(parents),
+                "edges": _pack(edges),
+                "offsets": _pack(offsets),
+                "targets": _pack(targets),
+                "counts": _pack(counts)}
+
+
+def _from_buffers(tokens: list, *buffers: bytes) -> NgramTrie:
+    """ Unpickle a trie from native-endian array buffers """
+    arrays = []
+    for buffer in buffers:
+        values = array(UINT32)
+        values.frombytes(buffer)
+        arrays.append(values)
+    return NgramTrie.from_csr(tokens, *arrays)
+
+
+def generate_backoff(model, depth: int, mode: str, end: str) -> str:
+    """ Generate text from a trie, backing off to shorter contexts when needed """
+    output = []
+    history = [end]
+    while True:
+        token = model.choose(history, depth)
+        if token == end:
+            break
+        output.append(spaced(history[-1], token, end) if mode == "word" else token)
+        history.append(token)
+    return "".join(output)
@@ -2,4 +2,4 @@
 from .scrub import Scrub
 
 async def setup(bot):
-    bot.add_cog(Scrub(bot))
\ No newline at end of file
+    await bot.add_cog(Scrub(bot))
\ No newline at end of file
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+""" Benchmark URL cleaning and check it against recorded output
+
+URLs are cleaned with a pinned copy of the ClearURLs rules shipped in \
+    `Scrub/data`, so results are comparable between runs and machines. Run \
+    it from the repository root, e.g.
+
+    python -m Scrub.benchmark --count 20000
+    python -m Scrub.benchmark --golden-only
+    python -m Scrub.benchmark --rules data.min.json --urls links.txt --no-golden
+
+Every run first checks the golden file: URLs with the cleaned output and \
+    repost decision recorded from the original implementation, covering \
+    redirections (including redirections to redirections) and the \
+    threshold logic used by `on_message`. Any engine has to reproduce it \
+    byte for byte. The exit status is 1 if it doesn't.
+"""
+import argparse
+import hashlib
+import json
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from .corpus import generate_urls
+from .rules import CompiledRules, clean_url, compile_rules, should_repost
+
+DATA_PATH = Path(__file__).parent / "data"
+# Pinned ClearURLs rules and the SHA-256 of the file
+PINNED_RULES = DATA_PATH / "clearurls.json"
+PINNED_DIGEST = "60a981976dafb7d371d86e05b6a5762a8cc3f22172257914bff471c82c1c1595"
+GOLDEN = DATA_PATH / "golden.jsonl"
+# The default threshold setting, used for recorded repost decisions
+THRESHOLD = 2
+ENGINES = {
+    "indexed": lambda url, rules: clean_url(url, rules),
+    "linear": lambda url, rules: clean_url(url, rules, indexed=False),
+}
+
+
+def load_rules(path: Path) -> dict:
+    """ Load a rules file, refusing a pinned file that has been modified """
+    data = path.read_bytes()
+    if path == PINNED_RULES and hashlib.sha256(data).hexdigest() != PINNED_DIGEST:
+        raise ValueError(f"{path} doesn't match the pinned rules")
+    return json.loads(data)
+
+
+def golden_record(url: str, clean: str) -> dict:
+    """ Describe how a URL was cleaned and whether `on_message` would repost it """
+    return {"url": url, "clean": clean, "repost": should_repost(url, clean, THRESHOLD)}
+
+
+def write_golden(path: Path, urls: list, rules: CompiledRules):
+    with open(path, "w", encoding="utf-8") as file:
+        for url in urls:
+            file.write(json.dumps(golden_record(url, clean_url(url, rules))) + "\n")
+
+
+def check_golden(path: Path, rules: CompiledRules, engine: str) -> list:
+    """ List (expected, actual) records an engine doesn't reproduce """
+    mismatches = []
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            expected = json.loads(line)
+            actual = golden_record(expected["url"], ENGINES[engine](expected["url"], rules))
+            if actual != expected:
+                mismatches.append((expected, actual))
+    return mismatches
+
+
+def percentile(values: list, fraction: float) -> float:
+    """ Get a percentile of sorted values """
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def time_engine(urls: list, rules: CompiledRules, engine: str) -> dict:
+    """ Clean every URL once, timing each """
+    function = ENGINES[engine]
+    # Warm up caches and lazily created structures
+    for url in urls[:200]:
+        function(url, rules)
+    latencies = []
+    for url in urls:
+        started = time.perf_counter()
+        function(url, rules)
+        latencies.append(time.perf_counter() - started)
+    total = sum(latencies)
+    latencies.sort()
+    return {"engine": engine,
+            "URLs/s": len(urls) / total if total else 0.0,
+            "p50 us": percentile(latencies, .5) * 1e6,
+            "p99 us": percentile(latencies, .99) * 1e6,
+            "max us": latencies[-1] * 1e6}
+
+
+class TimedPattern:
+    """ Wraps a compiled pattern to add the time spent in it to a total """
+    __slots__ = ("pattern", "totals", "name")
+
+    def __init__(self, pattern, totals: dict, name: str):
+        self.pattern = pattern
+        self.totals = totals
+        self.name = name
+
+    def match(self, *args):
+        started = time.perf_counter()
+        try:
+            return self.pattern.match(*args)
+        finally:
+            self.totals[self.name] += time.perf_counter() - started
+
+    def sub(self, *args):
+        started = time.perf_counter()
+        try:
+            return self.pattern.sub(*args)
+        finally:
+            self.totals[self.name] += time.perf_counter() - started
+
+
+def provider_shares(urls: list, rules: dict, engine: str) -> list:
+    """ Measure each provider's share of the time spent matching patterns
+
+    Patterns are wrapped in timers for this pass, so it covers regex work \
+        only and runs slower than the timed pass.
+    """
+    totals = defaultdict(float)
+    compiled = CompiledRules(rules)
+    for provider in compiled.providers:
+        def timed(pattern, name=provider.name):
+            return TimedPattern(pattern, totals, name)
+        provider.url_pattern = timed(provider.url_pattern)
+        provider.exceptions = [timed(p) for p in provider.exceptions]
+        provider.redirections = [(raw, timed(p)) for raw, p in provider.redirections]
+        provider.rules = [timed(p) for p in provider.rules]
+        provider.raw_rules = [timed(p) for p in provider.raw_rules]
+    for url in urls:
+        ENGINES[engine](url, compiled)
+    overall = sum(totals.values()) or 1.0
+    return sorted(({"provider": name, "ms": seconds * 1e3, "share %": seconds / overall * 100}
+                   for name, seconds in totals.items()),
+                  key=lambda row: -row["ms"])
+
+
+def print_table(rows: list):
+    """ Print result rows as right-aligned columns """
+    columns = list(rows[0])
+    cells = [[f"{v:.1f}" if isinstance(v, float) else str(v) for v in row.values()]
+             for row in rows]
+    widths = [max(len(c), *(len(line[i]) for line in cells)) for i, c in enumerate(columns)]
+    print("  ".join(c.rjust(w) for c, w in zip(columns, widths)))
+    for line in cells:
+        print("  ".join(v.rjust(w) for v, w in zip(line, widths)))
+
+
+def main(args) -> int:
+    rules = load_rules(args.rules)
+    compiled = compile_rules(rules)
+    engines = args.engines.split(",")
+    status = 0
+    if args.write_golden:
+        write_golden(args.golden, generate_urls(rules, args.golden_count, args.seed), compiled)
+        print(f"Wrote {args.golden_count} records to {args.golden}")
+        return 0
+    if args.golden_check:
+        for engine in engines:
+            mismatches = check_golden(args.golden, compiled, engine)
+            print(f"golden {engine}: {len(mismatches)} mismatches")
+            for expected, actual in mismatches[:args.show]:
+                print(f"  expected: {json.dumps(expected)}\n  actual:   {json.dumps(actual)}")
+            if mismatches:
+                status = 1
+    if args.golden_only:
+        return status
+    if args.urls:
+        with open(args.urls, encoding="utf-8") as file:
+            urls = [line.strip() for line in file if line.strip()]
+    else:
+        urls = generate_urls(rules, args.count, args.seed)
+    print(f"{len(compiled)} providers, {len(urls)} URLs")
+    print_table([time_engine(urls, compiled, engine) for engine in engines])
+    if args.providers:
+        print()
+        print_table(provider_shares(urls, rules, engines[0])[:args.providers])
+    return status
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m Scrub.benchmark",
+                                     description="Benchmark URL cleaning")
+    parser.add_argument("--rules", type=Path, default=PINNED_RULES,
+                        help="ClearURLs rules file (default: the pinned copy)")
+    parser.add_argument("--urls", type=Path,
+                        help="benchmark URLs from a file, one per line")
+    parser.add_argument("--count", type=int, default=10000,
+                        help="URLs to generate when no file is given (default 10000)")
+    parser.add_argument("--engines", default="indexed,linear",
+                        help="comma-separated engines to run (default indexed,linear)")
+    parser.add_argument("--providers", type=int, default=15,
+                        help="providers to list by time share, 0 to skip (default 15)")
+    parser.add_argument("--golden", type=Path, default=GOLDEN,
+                        help="golden output file (default: the pinned one)")
+    parser.add_argument("--no-golden", dest="golden_check", action="store_false",
+                        help="skip the golden output check")
+    parser.add_argument("--golden-only", action="store_true",
+                        help="only run the golden output check")
+    parser.add_argument("--write-golden", action="store_true",
+                        help="record the current output as the golden file")
+    parser.add_argument("--golden-count", type=int, default=1000,
+                        help="URLs to record with --write-golden (default 1000)")
+    parser.add_argument("--show", type=int, default=10,
+                        help="golden mismatches to print (default 10)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    for engine in args.engines.split(","):
+        if engine not in ENGINES:
+            parser.error(f"unknown engine '{engine}'")
+    return args
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
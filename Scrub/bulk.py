@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+""" Scrub links in text files outside of Discord
+
+Input is streamed in chunks of lines which are cleaned in a pool of worker \
+    processes, each compiling the rules once, and written out in their \
+    original order. Links are found with the same pattern as the cog and \
+    replaced only when the cog would repost them under the given \
+    threshold. Run it from the repository root, e.g.
+
+    python -m Scrub.bulk --rules data.min.json chat.log > clean.log
+    python -m Scrub.bulk --rules data.min.json --workers 8 -o clean.txt links1.txt links2.txt
+
+Throughput and counts are reported on stderr when done.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+
+from .cache import MISSING, ResultCache
+from .rules import CleaningTimeout, clean_url, compile_rules, should_repost
+from .scrub import URL_PATTERN
+from .worker import time_limit
+
+__all__ = ["BulkCleaner", "scrub_files"]
+
+# Text is passed through byte for byte, even if it isn't valid UTF-8
+ENCODING = "utf-8"
+ERRORS = "surrogateescape"
+
+# The cleaner used by this worker process
+_cleaner = None
+
+
+class BulkCleaner:
+    """ Replaces links in lines of text with their cleaned form """
+    def __init__(self, rules: dict, threshold: int = 2, budget: float = 0,
+                 cache_size: int = 65536):
+        self.rules = compile_rules(rules)
+        self.threshold = threshold
+        self.budget = budget    # Seconds allowed per link, 0 for no limit
+        self.cache = ResultCache(cache_size)
+
+    def clean_link(self, link: str):
+        """ Clean a link, returning None if it ran out of time """
+        clean_link = self.cache.get(0, link)
+        if clean_link is MISSING:
+            try:
+                with time_limit(self.budget):
+                    clean_link = clean_url(link, self.rules)
+            except CleaningTimeout:
+                clean_link = None
+            self.cache.put(0, link, clean_link)
+        return clean_link
+
+    def clean_lines(self, lines: list):
+        """ Clean the links in some lines, returning (lines, counts) """
+        counts = Counter()
+
+        def replace(match):
+            link = match.group(1)
+            clean_link = self.clean_link(link)
+            counts["links"] += 1
+            if clean_link is None:
+                counts["timeouts"] += 1
+            elif clean_link is False:
+                counts["blocked"] += 1
+            elif should_repost(link, clean_link, self.threshold):
+                counts["changed"] += 1
+                return clean_link
+            return link
+        return [URL_PATTERN.sub(replace, line) for line in lines], counts
+
+
+def _initialize(rules: dict, threshold: int, budget: float):
+    global _cleaner
+    _cleaner = BulkCleaner(rules, threshold, budget)
+
+
+def _clean_chunk(lines: list):
+    return _cleaner.clean_lines(lines)
+
+
+def _chunks(paths: list, size: int):
+    """ Read lines from files (or stdin for "-") in chunks """
+    for path in paths:
+        if path == "-":
+            stream = open(sys.stdin.fileno(), encoding=ENCODING, errors=ERRORS,
+                          newline="", closefd=False)
+        else:
+            stream = open(path, encoding=ENCODING, errors=ERRORS, newline="")
+        with stream:
+            while True:
+                chunk = list(islice(stream, size))
+                if not chunk:
+                    break
+                yield chunk
+
+
+def scrub_files(paths: list, output, rules: dict, threshold: int = 2, budget: float = 0,
+                workers: int = 0, chunk_size: int = 1000) -> Counter:
+    """ Clean links in files, writing the result to a text stream
+
+    With no workers, lines are cleaned in this process. Otherwise a few \
+        chunks per worker are kept in flight so memory stays bounded however \
+        large the input is.
+    """
+    totals = Counter()
+    if not workers:
+        cleaner = BulkCleaner(rules, threshold, budget)
+        for chunk in _chunks(paths, chunk_size):
+            lines, counts = cleaner.clean_lines(chunk)
+            output.writelines(lines)
+            totals.update(counts)
+            totals["lines"] += len(lines)
+        return totals
+    with ProcessPoolExecutor(workers, initializer=_initialize,
+                             initargs=(rules, threshold, budget)) as pool:
+        pending = deque()
+
+        def drain(limit: int):
+            while len(pending) > limit:
+                lines, counts = pending.popleft().result()
+                output.writelines(lines)
+                totals.update(counts)
+                totals["lines"] += len(lines)
+        for chunk in _chunks(paths, chunk_size):
+            pending.append(pool.submit(_clean_chunk, chunk))
+            drain(workers * 4)
+        drain(0)
+    return totals
+
+
+def main(args) -> int:
+    with open(args.rules, encoding="utf-8") as file:
+        rules = json.load(file)
+    if args.output:
+        output = open(args.output, "w", encoding=ENCODING, errors=ERRORS, newline="")
+    else:
+        output = open(sys.stdout.fileno(), "w", encoding=ENCODING, errors=ERRORS,
+                      newline="", closefd=False)
+    started = time.perf_counter()
+    with output:
+        totals = scrub_files(args.inputs, output, rules, args.threshold, args.budget,
+                             args.workers, args.chunk)
+    elapsed = time.perf_counter() - started or 1e-9
+    print(f"{totals['lines']} lines, {totals['links']} links in {elapsed:.1f}s "
+          f"({totals['lines'] / elapsed:.0f} lines/s, {totals['links'] / elapsed:.0f} links/s)\n"
+          f"{totals['changed']} changed, {totals['blocked']} blocked, "
+          f"{totals['timeouts']} timed out", file=sys.stderr)
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m Scrub.bulk",
+                                     description="Scrub links in text files")
+    parser.add_argument("inputs", nargs="*", default=["-"],
+                        help="files to read, or - for stdin (default)")
+    parser.add_argument("--rules", type=Path, required=True,
+                        help="ClearURLs rules file (data.min.json)")
+    parser.add_argument("-o", "--output", type=Path,
+                        help="file to write (default stdout)")
+    parser.add_argument("--threshold", type=int, default=2,
+                        help="minimum change in length to replace a link (default 2)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="worker processes, 0 to clean in this process (default: CPU count)")
+    parser.add_argument("--chunk", type=int, default=1000,
+                        help="lines sent to a worker at a time (default 1000)")
+    parser.add_argument("--budget", type=float, default=1.0,
+                        help="seconds allowed per link, 0 for no limit (default 1)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+__all__ = ["MISSING", "ResultCache"]
+
+# Returned by `ResultCache.get` for URLs that haven't been cleaned yet
+MISSING = object()
+
+
+class ResultCache:
+    """ A bounded LRU cache of cleaned URLs
+
+    Entries are keyed by (rules version, URL) so results from replaced \
+        rules are never served, and are cleared when the rules change to \
+        release their memory.
+    """
+    def __init__(self, size: int):
+        self.size = size  # Maximum number of cached URLs
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, version: int, url: str):
+        """ Get the cleaned form of a URL, or MISSING """
+        key = (version, url)
+        result = self.entries.get(key, MISSING)
+        if result is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return result
+
+    def put(self, version: int, url: str, result):
+        """ Remember the cleaned form of a URL, evicting the least recently used """
+        if self.size <= 0:
+            return
+        self.entries[(version, url)] = result
+        self.entries.move_to_end((version, url))
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def resize(self, size: int):
+        self.size = size
+        while len(self.entries) > max(size, 0):
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
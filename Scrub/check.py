@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+""" Check that the provider index gives the same results as a linear scan
+
+Every URL is cleaned once using the host index and once trying every \
+    provider in order, and any difference is reported. Run it from the \
+    repository root against a ClearURLs rules file, e.g.
+
+    python -m Scrub.check --rules data.min.json
+    python -m Scrub.check --rules data.min.json --urls links.txt
+
+Without `--urls`, URLs are generated from the rules. The exit status is 1 \
+    if any URL was cleaned differently.
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+from .corpus import generate_urls
+from .rules import clean_url, compile_rules
+
+
+def variants(url: str) -> list:
+    """ Spellings of a URL that stress the index's host handling """
+    rest = url.split("://", 1)[-1]
+    return [url, url.upper(), f"HTTPS://user@{rest}", f"ftp://{rest}",
+            f"https://www.google.com/url?q={url}"]
+
+
+def compare(urls: list, rules) -> list:
+    """ List (url, linear, indexed) for URLs the index cleans differently """
+    compiled = compile_rules(rules)
+    mismatches = []
+    for url in urls:
+        linear = clean_url(url, compiled, indexed=False)
+        indexed = clean_url(url, compiled)
+        if linear != indexed:
+            mismatches.append((url, linear, indexed))
+    return mismatches
+
+
+def main(args) -> int:
+    with open(args.rules, encoding="utf-8") as file:
+        rules = json.load(file)
+    if args.urls:
+        with open(args.urls, encoding="utf-8") as file:
+            urls = [line.strip() for line in file if line.strip()]
+    else:
+        urls = generate_urls(rules, args.count, args.seed)
+    urls = [variant for url in urls for variant in variants(url)]
+    compiled = compile_rules(rules)
+    mismatches = compare(urls, compiled)
+    print(f"{len(compiled)} providers, {len(compiled.fallback)} not indexed, "
+          f"{len(urls)} URLs, {len(mismatches)} mismatches")
+    for url, linear, indexed in mismatches[:args.show]:
+        print(f"{url}\n  linear:  {linear}\n  indexed: {indexed}")
+    return 1 if mismatches else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m Scrub.check",
+                                     description="Compare indexed and linear URL cleaning")
+    parser.add_argument("--rules", type=Path, required=True,
+                        help="ClearURLs rules file (data.min.json)")
+    parser.add_argument("--urls", type=Path,
+                        help="check URLs from a file, one per line")
+    parser.add_argument("--count", type=int, default=5000,
+                        help="URLs to generate when no file is given (default 5000)")
+    parser.add_argument("--show", type=int, default=10,
+                        help="mismatches to print (default 10)")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
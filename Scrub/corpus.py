@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+""" Generate URLs that exercise a ClearURLs rules file
+
+URLs are built from the hosts and parameter names in the rules themselves, \
+    so every provider gets traffic, with a share of them wrapped in \
+    redirections and a few unrelated hosts mixed in.
+"""
+import random
+import re
+from urllib.parse import quote
+
+__all__ = ["pattern_host", "generate_urls", "wrap"]
+
+# The usual urlPattern prefix, up to the first label of the domain
+URL_PATTERN_PREFIX = re.compile(r'^\^?https\?:\\/\\/(?:\(\?:\[a-z0-9-\]\+\\\.\)\*\??)?')
+# Hosts that no provider should match
+UNRELATED_HOSTS = ["example.com", "discord.com", "github.com"]
+# Query parameters used in addition to ones derived from the rules
+COMMON_PARAMS = ["utm_source=x", "utm_medium=social", "fbclid=IwAR123", "gclid=abc",
+                 "ref=home", "q=hello+world", "id=42", "ved=0ahUKE", "si=xyz",
+                 "feature=share", "igshid=abc", "tag=foo-20", "qid=123", "ga_campaign=z",
+                 "%3Futm_x=1", "a=%2F%20"]
+SUBDOMAINS = ["", "www.", "m.", "smile."]
+PATHS = ["", "item/123", "ref=abc/dp/x", "a/b"]
+
+
+def pattern_host(pattern: str):
+    """ Guess a host and path matched by a urlPattern, or None """
+    rest = URL_PATTERN_PREFIX.sub('', pattern)
+    rest = rest.replace(r'(?:\.[a-z]{2,}){1,}', '.com').replace('\\.', '.').replace('\\/', '/')
+    match = re.match(r'[a-z0-9.\-/_]+', rest)
+    if match is None or '.' not in match.group(0):
+        return None
+    return match.group(0)
+
+
+def generate_urls(rules: dict, count: int, seed: int = 0) -> list:
+    """ Generate a reproducible list of URLs for a rules file """
+    rng = random.Random(seed)
+    providers = list(rules.get('providers', {}).values())
+    hosts = [h for h in (pattern_host(p['urlPattern']) for p in providers) if h]
+    hosts += UNRELATED_HOSTS
+    params = list(COMMON_PARAMS)
+    for provider in providers:
+        for rule in provider.get('rules', [])[:3] + provider.get('referralMarketing', [])[:2]:
+            literal = re.sub(r'[^a-z_]', '', rule)[:12]
+            if literal:
+                params.append(f"{literal}=v{rng.randint(0, 9)}")
+    urls = []
+    for _ in range(count):
+        host, _, path = rng.choice(hosts).partition('/')
+        scheme = "https" if rng.random() < .9 else "http"
+        url = f"{scheme}://{rng.choice(SUBDOMAINS)}{host}/{path}{rng.choice(PATHS)}"
+        query = '&'.join(rng.sample(params, rng.randint(0, 5)))
+        if query:
+            url += ('&' if '?' in url else '?') + query
+        if rng.random() < .1:
+            url += '#frag'
+        wrapped = wrap(url, rng)
+        # Redirections to redirections are only followed once
+        if wrapped != url and rng.random() < .2:
+            wrapped = wrap(wrapped, rng, 1.0)
+        urls.append(wrapped)
+    return urls
+
+
+def wrap(url: str, rng: random.Random, chance: float = .1) -> str:
+    """ Sometimes wrap a URL in a redirection link """
+    choice = rng.random() / chance
+    if choice < .5:
+        return f"https://www.google.com/url?sa=t&url={quote(url, safe='')}&ved=1"
+    if choice < .8:
+        return f"https://l.facebook.com/l.php?u={quote(url, safe='')}&h=AT0"
+    if choice < 1:
+        return f"https://out.reddit.com/t3_x?url={quote(url, safe='')}&token=1"
+    return url
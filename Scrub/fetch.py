@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+from collections import namedtuple
+
+import aiohttp
+
+log = logging.getLogger("red.cbd-cogs.scrub")
+
+__all__ = ["Fetched", "fetch_rules", "MAX_RULES_SIZE"]
+
+# Largest rules file that will be downloaded, in bytes
+MAX_RULES_SIZE = 32 * 2**20
+# Bytes read from the response at a time
+CHUNK_SIZE = 64 * 2**10
+
+# rules is None when the file hasn't changed since the validators were recorded
+Fetched = namedtuple("Fetched", ["rules", "etag", "last_modified", "digest"])
+
+
+async def fetch_rules(session: aiohttp.ClientSession, url: str, etag: str = None,
+                      last_modified: str = None, digest: str = None) -> Fetched:
+    """ Download a rules file unless it matches what was fetched before
+
+    The ETag and Last-Modified validators from the previous download are \
+        sent so the server can answer 304 Not Modified, and the body is \
+        hashed while it streams in so an unchanged file served without \
+        validators isn't parsed again either.
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304:
+            log.debug(f"Rules at {url} not modified")
+            return Fetched(None, etag, last_modified, digest)
+        response.raise_for_status()
+        if (response.content_length or 0) > MAX_RULES_SIZE:
+            raise ValueError(f"Rules file is larger than {MAX_RULES_SIZE} bytes")
+        hasher = hashlib.sha256()
+        chunks = []
+        size = 0
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_RULES_SIZE:
+                raise ValueError(f"Rules file is larger than {MAX_RULES_SIZE} bytes")
+            hasher.update(chunk)
+            chunks.append(chunk)
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+    fetched_digest = hasher.hexdigest()
+    if fetched_digest == digest:
+        log.debug(f"Rules at {url} unchanged")
+        return Fetched(None, etag, last_modified, digest)
+    rules = json.loads(b"".join(chunks))
+    if not isinstance(rules, dict) or not isinstance(rules.get("providers"), dict):
+        raise ValueError("Rules file has no providers")
+    return Fetched(rules, etag, last_modified, fetched_digest)
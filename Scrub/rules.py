@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+import logging
+import re
+from urllib.parse import parse_qsl, unquote, urlencode, urlparse, urlunparse
+
+log = logging.getLogger("red.cbd-cogs.scrub")
+
+__all__ = ["CleaningTimeout", "CompiledProvider", "CompiledRules", "compile_rules", "clean_url",
+           "significant_change", "should_repost"]
+
+# Patterns that depend on group numbering can't be merged into one alternation
+GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+# The usual urlPattern prefix followed by the first label of the domain
+URL_PATTERN_HOST = re.compile(
+    r'\^?https\?:\\/\\/(?:\(\?:\[a-z0-9-\]\+\\\.\)\*\??)?([a-z0-9-]+)([^*+?{]|$)')
+# Characters that can appear in the part of a URL matched by host patterns
+HOST_CHARACTERS = re.compile(r'[A-Za-z0-9.-]*')
+# Longest host label that is looked up in the index
+MAX_LABEL = 63
+
+
+class CleaningTimeout(Exception):
+    """ Raised when cleaning a URL runs over its time budget
+
+    The name of the provider whose patterns were running is filled in as \
+        the exception passes through `clean_url`.
+    """
+    def __init__(self, provider: str = None):
+        super().__init__(provider)
+        self.provider = provider
+
+
+class BrokenPattern:
+    """ Stands in for a pattern that failed to compile
+
+    The error is raised when the pattern is used rather than when rules are \
+        loaded, matching what passing the raw string to `re` would do.
+    """
+    __slots__ = ("error",)
+
+    def __init__(self, error: re.error):
+        self.error = error
+
+    def match(self, *args, **kwargs):
+        raise self.error
+
+    def sub(self, *args, **kwargs):
+        raise self.error
+
+
+def _compile(pattern: str, flags: int = 0):
+    try:
+        return re.compile(pattern, flags)
+    except re.error as e:
+        return BrokenPattern(e)
+
+
+def _combine(patterns: list):
+    """ Merge query parameter rules into a single case-insensitive alternation
+
+    Returns a one-element list when the rules can be merged, or a list of \
+        the individually compiled rules when they can't, e.g. because one \
+        uses backreferences or inline flags.
+    """
+    if not patterns:
+        return []
+    if len(patterns) > 1 and not any(GROUP_REFERENCE.search(p) for p in patterns):
+        try:
+            return [re.compile("|".join(f"(?:{p})" for p in patterns), re.IGNORECASE)]
+        except re.error:
+            pass
+    return [_compile(p, re.IGNORECASE) for p in patterns]
+
+
+class CompiledProvider:
+    """ A ClearURLs provider with its patterns compiled once """
+    __slots__ = ("name", "url_pattern", "complete", "exceptions", "redirections",
+                 "rules", "raw_rules")
+
+    def __init__(self, name: str, provider: dict):
+        self.name = name
+        self.url_pattern = _compile(provider['urlPattern'], re.IGNORECASE)
+        self.complete = bool(provider.get('completeProvider'))
+        self.exceptions = [_compile(p, re.IGNORECASE) for p in provider.get('exceptions', [])]
+        self.redirections = [(p, _compile(p, re.IGNORECASE))
+                             for p in provider.get('redirections', [])]
+        # Regular and referral marketing rules both remove query parameters
+        self.rules = _combine([*provider.get('rules', []),
+                               *provider.get('referralMarketing', [])])
+        self.raw_rules = [_compile(p) for p in provider.get('rawRules', [])]
+
+
+def _top_level_alternation(pattern: str) -> bool:
+    """ Check whether a pattern has a `|` outside of any group """
+    depth = 0
+    escaped = in_class = False
+    for character in pattern:
+        if escaped:
+            escaped = False
+        elif character == '\\':
+            escaped = True
+        elif in_class:
+            in_class = character != ']'
+        elif character == '[':
+            in_class = True
+        elif character == '(':
+            depth += 1
+        elif character == ')':
+            depth -= 1
+        elif character == '|' and depth <= 0:
+            return True
+    return False
+
+
+def host_key(pattern: str):
+    """ Get the domain label a urlPattern requires, or None if it can't be indexed
+
+    Patterns of the form `^https?://(?:[a-z0-9-]+\\.)*?example...` only \
+        match URLs whose host has a label starting with `example`.
+    """
+    match = URL_PATTERN_HOST.match(pattern)
+    if not match or _top_level_alternation(pattern):
+        return None
+    return match.group(1).lower()
+
+
+class CompiledRules:
+    """ A ClearURLs rules file compiled for repeated URL cleaning
+
+    Providers are indexed by the first domain label their `urlPattern` \
+        requires, so cleaning a URL only tries the providers indexed under \
+        a prefix of one of its host labels plus the few that can't be \
+        indexed, in their original order.
+    """
+    __slots__ = ("providers", "index", "fallback", "everything")
+
+    def __init__(self, rules: dict):
+        self.providers = [CompiledProvider(name, provider)
+                          for name, provider in (rules or {}).get('providers', {}).items()]
+        self.index = {}     # Domain label -> provider indices
+        self.fallback = []  # Indices of providers that can't be indexed
+        for i, provider in enumerate(self.providers):
+            key = host_key(provider.url_pattern.pattern) \
+                if isinstance(provider.url_pattern, re.Pattern) else None
+            if key is None:
+                self.fallback.append(i)
+            else:
+                self.index.setdefault(key, []).append(i)
+        self.everything = list(range(len(self.providers)))
+
+    def __len__(self):
+        return len(self.providers)
+
+    def host(self, url: str):
+        """ Get the part of a URL that indexed patterns match against
+
+        Returns None when the index can't be trusted for the URL, e.g. \
+            because case-insensitive matching could treat a non-ASCII \
+            character as one of the ASCII characters the patterns expect.
+        """
+        scheme = url[:8]
+        if not scheme.isascii():
+            return None
+        scheme = scheme.lower()
+        if scheme.startswith("https://"):
+            start = 8
+        elif scheme.startswith("http://"):
+            start = 7
+        else:
+            # Indexed patterns all start with the scheme
+            return ""
+        host = HOST_CHARACTERS.match(url, start).group()
+        end = start + len(host)
+        if end < len(url) and not url[end].isascii():
+            return None
+        return host.lower()
+
+    def candidates(self, host) -> list:
+        """ Get the indices of providers that could match a URL's host """
+        if host is None:
+            return self.everything
+        found = set(self.fallback)
+        for label in host.split("."):
+            for length in range(1, min(len(label), MAX_LABEL) + 1):
+                found.update(self.index.get(label[:length], ()))
+        return sorted(found)
+
+
+def compile_rules(rules: dict) -> CompiledRules:
+    """ Compile a ClearURLs rules file, accepting already compiled rules as-is """
+    if isinstance(rules, CompiledRules):
+        return rules
+    return CompiledRules(rules)
+
+
+def clean_url(url: str, rules: CompiledRules, loop: bool = True, indexed: bool = True):
+    """ Clean the given URL with compiled rules
+
+    URLs matching a provider's `urlPattern` and one or more of that \
+        provider's redirection patterns will cause the URL to be replaced \
+        with the match's first matched group. Set `indexed` to False to try \
+        every provider instead of using the host index.
+    """
+    provider = None
+    try:
+        host = rules.host(url) if indexed else None
+        candidates = rules.candidates(host)
+        position, previous = 0, -1
+        while position < len(candidates):
+            if indexed and previous >= 0 and rules.host(url) != host:
+                # A redirection or raw rule changed the host, so find new candidates
+                host = rules.host(url)
+                candidates = [i for i in rules.candidates(host) if i > previous]
+                position = 0
+                if not candidates:
+                    break
+            previous = candidates[position]
+            position += 1
+            provider = rules.providers[previous]
+            # Check provider urlPattern against provided URI
+            if not provider.url_pattern.match(url):
+                continue
+
+            # completeProvider is a boolean that determines if every url that
+            # matches will be blocked. If you want to specify rules, exceptions
+            # and/or redirections, the value of completeProvider must be false.
+            if provider.complete:
+                return False
+
+            # If any exceptions are matched, this provider is skipped
+            if any(exc.match(url) for exc in provider.exceptions):
+                continue
+
+            # If redirect found, recurse on target (only once)
+            for redir, pattern in provider.redirections:
+                match = pattern.match(url)
+                try:
+                    if match and match.group(1):
+                        if loop:
+                            return clean_url(unquote(match.group(1)), rules, False, indexed)
+                        else:
+                            url = unquote(match.group(1))
+                except IndexError:
+                    log.warning(f"Redirect target match failed [{provider.name}]: {redir}")
+                    pass
+
+            # Explode query parameters to be checked against rules
+            parsed_url = urlparse(url)
+            query_params = parse_qsl(parsed_url.query)
+
+            # Check regular rules and referral marketing rules
+            for rule in provider.rules:
+                query_params = [
+                    param for param in query_params
+                    if not rule.match(param[0])
+                ]
+
+            # Rebuild valid URI string with remaining query parameters
+            url = urlunparse((
+                parsed_url.scheme,
+                parsed_url.netloc,
+                parsed_url.path,
+                parsed_url.params,
+                urlencode(query_params),
+                parsed_url.fragment,
+            ))
+
+            # Run raw rules against the full URI string
+            for raw_rule in provider.raw_rules:
+                url = raw_rule.sub('', url)
+    except CleaningTimeout as e:
+        # Record the innermost provider that was running out of time
+        if e.provider is None and provider is not None:
+            e.provider = provider.name
+        raise
+    return url
+
+
+def significant_change(link: str, clean_link: str, threshold: int) -> bool:
+    """ Check whether a cleaned link differs enough from the original to repost
+
+    Changes shorter than the threshold and ones that only differ by case or \
+        URL encoding are ignored to avoid annoying users with trivial \
+        alterations.
+    """
+    return ((len(link) <= len(clean_link) - threshold or
+             len(link) >= len(clean_link) + threshold) and
+            link.lower() not in (clean_link.lower(),
+                                 unquote(clean_link).lower()))
+
+
+def should_repost(link: str, clean_link, threshold: int) -> bool:
+    """ Decide whether a link's cleaned version should be posted
+
+    Links a provider blocks entirely clean to False and are never reposted, \
+        otherwise the change has to be significant.
+    """
+    if clean_link is False:
+        return False
+    return significant_change(link, clean_link, threshold)
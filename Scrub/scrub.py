@@ -1,16 +1,24 @@
 # -*- coding: utf-8 -*-
 import aiohttp
 import asyncio
-import json
 import logging
 import re
-from collections import namedtuple
+import site
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from pathlib import Path
 from typing import Optional, Union
-from urllib.parse import parse_qsl, unquote, urlencode, urlparse, urlunparse
 
 import discord
+from discord.ext import tasks
 from redbot.core import Config, bot, checks, commands
 
+from .cache import MISSING, ResultCache
+from .fetch import fetch_rules
+from .rules import CompiledRules, clean_url, compile_rules, should_repost
+from .worker import clean_batch
+
 log = logging.getLogger("red.cbd-cogs.scrub")
 
 __all__ = ["UNIQUE_ID", "Scrub"]
@@ -18,6 +26,14 @@ __all__ = ["UNIQUE_ID", "Scrub"]
 UNIQUE_ID = 0x7363727562626572
 URL_PATTERN = re.compile(r'(https?://\S+)')
 DEFAULT_URL = "https://kevinroebert.gitlab.io/ClearUrls/data/data.minify.json"
+# Cleaned URLs remembered by default
+CACHE_SIZE = 4096
+# Messages with at least this many uncached links are cleaned in the worker pool
+OFFLOAD_LINKS = 3
+# Links at least this long are cleaned in the worker pool
+OFFLOAD_LENGTH = 512
+# Seconds allowed on top of the per-URL budgets before a batch is abandoned
+POOL_GRACE = 5
 
 
 class Scrub(commands.Cog):
@@ -37,69 +53,179 @@ class Scrub(commands.Cog):
                                     force_registration=True)
         self.conf.register_global(rules={},
                                   threshold=2,
-                                  url=DEFAULT_URL)
+                                  url=DEFAULT_URL,
+                                  cache_size=CACHE_SIZE,
+                                  refresh_interval=24,
+                                  last_refresh=0,
+                                  validators={},
+                                  executor="off",
+                                  pool_size=2,
+                                  url_budget=0.5)
+        self.compiled = None  # CompiledRules built from the stored rules
+        self.rules_data = {}  # Rules the compiled rules were built from, for workers
+        self.version = 0      # Incremented whenever the compiled rules are replaced
+        self.cache = ResultCache(CACHE_SIZE)
+        self.session = None   # aiohttp session shared by every rules download
+        self.updating = asyncio.Lock()
+        self.loading = asyncio.Lock()  # Held while the rules and pool are set up on first use
+        self.pool = None       # Worker processes for cleaning, if enabled
+        self.pool_kind = "off"
+        self.pool_jobs = set()  # Batches submitted to the pool that haven't finished
+        self.pool_size = 2
+        self.url_budget = 0.5  # Seconds a worker may spend cleaning one URL
+        self.timeouts = Counter()  # Provider name -> URLs that ran out of time
+        self.refresh_rules.start()
+
+    async def cog_unload(self):
+        self.refresh_rules.cancel()
+        self.start_pool("off")
+        if self.session is not None:
+            await self.session.close()
+
+    @tasks.loop(hours=1)
+    async def refresh_rules(self):
+        settings = await self.conf.all()
+        interval = settings["refresh_interval"]
+        if not interval or time.time() - settings["last_refresh"] < interval * 3600:
+            return
+        try:
+            await self.get_rules()
+            await self._update(settings["url"])
+        except Exception as e:
+            log.exception("Scheduled rules update failed", exc_info=e)
+
+    @refresh_rules.before_loop
+    async def wait_for_red(self):
+        await self.bot.wait_until_red_ready()
 
-    def clean_url(self, url: str, rules: dict, loop: bool = True):
+    def clean_url(self, url: str, rules, loop: bool = True):
         """ Clean the given URL with the provided rules data.
 
         URLs matching a provider's `urlPattern` and one or more of that \
             provider's redirection patterns will cause the URL to be replaced \
-            with the match's first matched group.
+            with the match's first matched group. Raw rules data is compiled \
+            first, so pass `CompiledRules` when cleaning more than one URL.
         """
-        for provider_name, provider in rules.get('providers', {}).items():
-            # Check provider urlPattern against provided URI
-            if not re.match(provider['urlPattern'], url, re.IGNORECASE):
-                continue
+        return clean_url(url, compile_rules(rules), loop)
 
-            # completeProvider is a boolean that determines if every url that
-            # matches will be blocked. If you want to specify rules, exceptions
-            # and/or redirections, the value of completeProvider must be false.
-            if provider.get('completeProvider'):
-                return False
+    async def get_rules(self) -> CompiledRules:
+        """ Get the compiled rules, compiling or downloading them on first use """
+        if self.compiled is None:
+            # Messages arriving together at startup would each start an update and a pool
+            async with self.loading:
+                if self.compiled is None:
+                    await self.load_settings()
+                    rules = await self.conf.rules()
+                    if not rules:
+                        await self._update(await self.conf.url())
+                    else:
+                        self.set_rules(rules, compile_rules(rules))
+        return self.compiled
+
+    async def load_settings(self):
+        self.cache.resize(await self.conf.cache_size())
+        self.url_budget = await self.conf.url_budget()
+        self.start_pool(await self.conf.executor(), await self.conf.pool_size())
 
-            # If any exceptions are matched, this provider is skipped
-            if any(re.match(exc, url, re.IGNORECASE)
-                   for exc in provider.get('exceptions', [])):
+    def set_rules(self, rules: dict, compiled: CompiledRules):
+        """ Replace the rules snapshot, invalidating cached results """
+        self.rules_data = rules
+        self.compiled = compiled
+        self.version += 1
+        self.cache.clear()
+
+    def start_pool(self, executor: str, size: int = 1):
+        """ Replace the worker pool used for cleaning links """
+        if self.pool is not None:
+            # Queued batches would only be abandoned (cancel_futures needs Python 3.9)
+            for future in list(self.pool_jobs):
+                future.cancel()
+            self.pool.shutdown(wait=False)
+        self.pool = None
+        if executor == "process":
+            # Spawned workers need to be able to import this package
+            self.pool = ProcessPoolExecutor(size, initializer=site.addsitedir,
+                                            initargs=(str(Path(__file__).parents[1]),))
+        self.pool_kind = executor
+        self.pool_size = size
+
+    async def clean_links(self, links: list, rules: CompiledRules) -> list:
+        """ Clean links with the current rules, reusing earlier results
+
+        Messages with many or very long links are cleaned in the worker \
+            pool, if there is one, so slow rules can't stall the bot.
+        """
+        version, data = self.version, self.rules_data
+        results = {}
+        pending = []
+        for link in links:
+            clean_link = self.cache.get(version, link)
+            if clean_link is MISSING:
+                pending.append(link)
+            else:
+                results[link] = clean_link
+        if not pending:
+            return [results[link] for link in links]
+        if self.pool is not None and (len(pending) >= OFFLOAD_LINKS or
+                                      any(len(link) >= OFFLOAD_LENGTH for link in pending)):
+            cleaned = await self.offload(pending, version, data)
+        else:
+            cleaned = [self.clean_url(link, rules) for link in pending]
+        for link, clean_link in zip(pending, cleaned):
+            if clean_link is None:
+                # Left as it is this time, but not remembered as clean
+                results[link] = link
                 continue
+            results[link] = clean_link
+            # Rules may have been replaced while the workers were busy
+            if version == self.version:
+                self.cache.put(version, link, clean_link)
+        return [results[link] for link in links]
+
+    async def submit(self, timeout: float, *args):
+        """ Clean a batch in the worker pool, tracking it until it finishes """
+        pool = self.pool
+        future = pool.submit(clean_batch, *args)
+        self.pool_jobs.add(future)
+        future.add_done_callback(self.pool_jobs.discard)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        except asyncio.CancelledError:
+            if pool is self.pool or not future.cancelled():
+                raise
+            raise BrokenExecutor("batch cancelled when the pool was replaced")
 
-            # If redirect found, recurse on target (only once)
-            for redir in provider.get('redirections', []):
-                match = re.match(redir, url, re.IGNORECASE)
-                try:
-                    if match and match.group(1):
-                        if loop:
-                            return self.clean_url(unquote(match.group(1)), rules, False)
-                        else:
-                            url = unquote(match.group(1))
-                except IndexError:
-                    log.warning(f"Redirect target match failed [{provider_name}]: {redir}")
-                    pass
-
-            # Explode query parameters to be checked against rules
-            parsed_url = urlparse(url)
-            query_params = parse_qsl(parsed_url.query)
-
-            # Check regular rules and referral marketing rules
-            for rule in (*provider.get('rules', []), *provider.get('referralMarketing', [])):
-                query_params = [
-                    param for param in query_params
-                    if not re.match(rule, param[0], re.IGNORECASE)
-                ]
-
-            # Rebuild valid URI string with remaining query parameters
-            url = urlunparse((
-                parsed_url.scheme,
-                parsed_url.netloc,
-                parsed_url.path,
-                parsed_url.params,
-                urlencode(query_params),
-                parsed_url.fragment,
-            ))
-
-            # Run raw rules against the full URI string
-            for raw_rule in provider.get('rawRules', []):
-                url = re.sub(raw_rule, '', url)
-        return url
+    async def offload(self, links: list, version: int, rules: dict, retry: bool = True) -> list:
+        """ Clean links in the worker pool
+
+        Links that ran out of time come back as None, as do all of them if \
+            the batch failed, so they aren't mistaken for cleaned links.
+        """
+        pool = self.pool
+        budget = self.url_budget
+        timeout = budget * len(links) + POOL_GRACE
+        try:
+            results = await self.submit(timeout, version, links, budget)
+            if results is None:
+                # This worker hasn't compiled these rules yet
+                results = await self.submit(timeout, version, links, budget, rules)
+        except Exception as e:
+            # Don't let later messages queue up behind a broken or runaway worker
+            log.exception("Cleaning links in the worker pool failed", exc_info=e)
+            if self.pool is pool:
+                self.start_pool(self.pool_kind, self.pool_size)
+            if retry and self.pool is not None and isinstance(e, BrokenExecutor):
+                # The batch itself may be fine, so give it one more go in the new pool
+                return await self.offload(links, version, rules, retry=False)
+            return [None] * len(links)
+        cleaned = []
+        for link, (clean_link, provider) in zip(links, results):
+            if provider is not None:
+                self.timeouts[provider] += 1
+                log.warning(f"Cleaning ran out of time in provider {provider}: {link[:200]}")
+                clean_link = None
+            cleaned.append(clean_link)
+        return cleaned
 
     @commands.Cog.listener()
     async def on_message(self, message):
@@ -113,16 +239,12 @@ class Scrub(commands.Cog):
         links = list(set(URL_PATTERN.findall(message.content)))
         if not links:
             return
-        rules = await self.conf.rules() or await self._update(await self.conf.url())
+        rules = await self.get_rules()
         threshold = await self.conf.threshold()
         clean_links = []
-        for link in links:
-            clean_link = self.clean_url(link, rules)
+        for link, clean_link in zip(links, await self.clean_links(links, rules)):
             # Apply a threshold to avoid annoying users with trivial alterations
-            if ((len(link) <= len(clean_link) - threshold or
-                 len(link) >= len(clean_link) + threshold) and
-                 link.lower() not in (clean_link.lower(),
-                                      unquote(clean_link).lower())):
+            if should_repost(link, clean_link, threshold):
                 clean_links.append(clean_link)
         if not len(clean_links):
             return
@@ -178,17 +300,99 @@ class Scrub(commands.Cog):
         """ Update Scrub with the latest rules """
         url = await self.conf.url()
         try:
-            await self._update(url)
+            changed = await self._update(url)
         except Exception as e:
             await ctx.send("Rules update failed (see log for details)")
             log.exception("Rules update failed", exc_info=e)
             return
-        await ctx.send("Rules updated")
-
-    async def _update(self, url):
-        log.debug(f'Downloading rules data from {url}')
-        session = aiohttp.ClientSession()
-        async with session.get(url) as request:
-            rules = json.loads(await request.read())
-        await session.close()
-        await self.conf.rules.set(rules)
+        await ctx.send("Rules updated" if changed else "Rules are already up to date")
+
+    @scrub.command()
+    @checks.admin_or_permissions(manage_guild=True)
+    async def refresh(self, ctx: commands.Context, hours: int = None):
+        """ View or set how often rules are updated automatically
+        
+        Rules are only downloaded again if the server reports they changed, \
+            and only recompiled if their content did. Set to 0 to disable \
+            automatic updates.
+        """
+        if hours is not None and hours < 0:
+            await ctx.send("Refresh interval can't be negative")
+            return
+        action = await self.view_or_set("refresh_interval", hours)
+        await ctx.send(f"Scrub refresh interval in hours {action}")
+
+    @scrub.command()
+    @checks.admin_or_permissions(manage_guild=True)
+    async def stats(self, ctx: commands.Context):
+        """ View statistics for the cleaned link cache """
+        cache = self.cache
+        providers = len(self.compiled) if self.compiled is not None else 0
+        await ctx.send(f"Rules version {self.version} ({providers} providers)\n"
+                       f"Cached links: {len(cache)}/{cache.size}\n"
+                       f"Cache hits: {cache.hits}, misses: {cache.misses} "
+                       f"({cache.hit_rate():.1%} hit rate)")
+        if self.timeouts:
+            slowest = ", ".join(f"{name} ({count})" for name, count in self.timeouts.most_common(5))
+            await ctx.send(f"Providers that ran out of time: {slowest}")
+
+    @scrub.command(hidden=True)
+    @checks.is_owner()
+    async def cachesize(self, ctx: commands.Context, size: int = None):
+        """ View or set how many cleaned links are remembered """
+        if size is not None:
+            if size < 0:
+                await ctx.send("Cache size can't be negative")
+                return
+            self.cache.resize(size)
+        action = await self.view_or_set("cache_size", size)
+        await ctx.send(f"Scrub cache size {action}")
+
+    @scrub.command(name="setexecutor", hidden=True)
+    @checks.is_owner()
+    async def set_executor(self, ctx: commands.Context, executor: str, size: int = 2,
+                           budget: float = 0.5):
+        """ Choose where links are cleaned
+
+        Available executors are:
+         - `off`: Clean links on the bot's event loop
+         - `process`: Clean messages with many or very long links in a pool \
+            of `size` worker processes, giving up on any link that takes \
+            longer than `budget` seconds
+        """
+        executor = executor.lower()
+        if executor not in ("off", "process"):
+            await ctx.send(f"Unknown executor '{executor}'")
+            return
+        await self.conf.executor.set(executor)
+        await self.conf.pool_size.set(size)
+        await self.conf.url_budget.set(budget)
+        self.url_budget = budget
+        self.start_pool(executor, size)
+        await ctx.send(f"Executor set to {executor}")
+
+    async def _update(self, url) -> bool:
+        """ Update the rules from a URL, returning whether they changed """
+        async with self.updating:
+            if self.session is None or self.session.closed:
+                self.session = aiohttp.ClientSession()
+            validators = await self.conf.validators()
+            # Validators only apply to the file they were recorded for
+            if validators.get("url") != url or self.compiled is None:
+                validators = {}
+            log.debug(f'Downloading rules data from {url}')
+            fetched = await fetch_rules(self.session, url,
+                                        validators.get("etag"),
+                                        validators.get("last_modified"),
+                                        validators.get("digest"))
+            await self.conf.validators.set({"url": url,
+                                            "etag": fetched.etag,
+                                            "last_modified": fetched.last_modified,
+                                            "digest": fetched.digest})
+            await self.conf.last_refresh.set(time.time())
+            if fetched.rules is None:
+                return False
+            compiled = compile_rules(fetched.rules)
+            await self.conf.rules.set(fetched.rules)
+            self.set_rules(fetched.rules, compiled)
+            return True
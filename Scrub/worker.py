@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+""" URL cleaning in worker processes with a time budget per URL
+
+Regular expressions hold the GIL while they run, so only separate \
+    processes keep a pathological rule from stalling the bot. Each worker \
+    compiles the rules once per rules version and interrupts any URL that \
+    runs over its budget with a timer signal, which `re` checks for while \
+    matching, so the worker itself stays usable.
+"""
+import signal
+import threading
+from contextlib import contextmanager
+
+from .rules import CleaningTimeout, clean_url, compile_rules
+
+__all__ = ["clean_batch", "time_limit"]
+
+# Compiled rules in this worker process, keyed by rules version
+_loaded = {}
+
+
+def _expire(signum, frame):
+    raise CleaningTimeout()
+
+
+@contextmanager
+def time_limit(seconds: float):
+    """ Raise `CleaningTimeout` if the block runs longer than `seconds`
+
+    Only enforced in the main thread of processes on platforms with \
+        interval timers, which includes pool workers on Unix.
+    """
+    if (not seconds or not hasattr(signal, "setitimer")
+            or threading.current_thread() is not threading.main_thread()):
+        yield
+        return
+    previous = signal.signal(signal.SIGALRM, _expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def clean_batch(version: int, urls: list, budget: float, rules: dict = None):
+    """ Clean URLs with a time budget for each, in a worker process
+
+    Returns None if this worker hasn't compiled the given rules version \
+        and `rules` wasn't passed, otherwise a list of (result, provider) \
+        pairs where provider names the provider that ran out of time, in \
+        which case the result is the URL unchanged.
+    """
+    compiled = _loaded.get(version)
+    if compiled is None:
+        if rules is None:
+            return None
+        _loaded.clear()
+        compiled = _loaded[version] = compile_rules(rules)
+    results = []
+    for url in urls:
+        try:
+            with time_limit(budget):
+                result = clean_url(url, compiled)
+        except CleaningTimeout as e:
+            results.append((url, e.provider or "unknown"))
+        else:
+            results.append((result, None))
+    return results
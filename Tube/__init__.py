@@ -2,4 +2,4 @@
 from .tube import Tube
 
 async def setup(bot):
-    bot.add_cog(Tube(bot))
\ No newline at end of file
+    await bot.add_cog(Tube(bot))
\ No newline at end of file
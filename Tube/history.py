@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+__all__ = ["SeenVideos"]
+
+
+class SeenVideos:
+    """The IDs of videos already posted in a guild, oldest first
+
+    Membership checks are O(1), and once `size` IDs are held adding another evicts the oldest. `changed` is set whenever the IDs change, so callers know when they need saving."""
+    def __init__(self, video_ids=(), size: int = 500):
+        self.ids = OrderedDict.fromkeys(video_ids)
+        self.size = size
+        self.changed = False
+        self._evict()
+        # Trimming what was loaded isn't worth a write on its own
+        self.changed = False
+
+    def __contains__(self, video_id: str):
+        return video_id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def add(self, video_id: str):
+        """Remember a video, returning whether it was new"""
+        if video_id in self.ids:
+            return False
+        self.ids[video_id] = None
+        self.changed = True
+        self._evict()
+        return True
+
+    def resize(self, size: int):
+        self.size = size
+        self._evict()
+
+    def _evict(self):
+        while len(self.ids) > max(self.size, 0):
+            self.ids.popitem(last=False)
+            self.changed = True
+
+    def to_list(self):
+        """Get the IDs for saving, which also marks them as saved"""
+        self.changed = False
+        return list(self.ids)
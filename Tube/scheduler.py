@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import calendar
+import heapq
+import random
+import statistics
+
+__all__ = ["FeedScheduler", "MIN_POLL", "MAX_POLL"]
+
+# Bounds in seconds on how often a single feed is polled
+MIN_POLL = 120
+MAX_POLL = 3 * 3600
+# Polls aimed for between a channel's typical uploads
+POLLS_PER_UPLOAD = 24
+# Fraction of each poll interval randomly added or removed
+JITTER = 0.1
+# Seconds of unused request budget that can be saved up
+BURST = 60
+
+
+def upload_times(feed) -> list:
+    """Get the publication times of a feed's entries as sorted UNIX timestamps"""
+    times = []
+    for entry in (feed or {}).get("entries", []):
+        published = entry.get("published_parsed")
+        if published:
+            times.append(calendar.timegm(published))
+    return sorted(times)
+
+
+class FeedScheduler:
+    """Decides when each feed is polled next
+
+    Feeds are kept in a priority queue by due time. Each feed's interval follows its upload cadence: \
+    the typical gap between its recent uploads, or the time since its last upload if that is longer, \
+    divided by `POLLS_PER_UPLOAD` and kept within `MIN_POLL` and `MAX_POLL`. Failures back off \
+    exponentially. Polls are also limited to a global rate, so the total number of requests matches \
+    polling every feed once per `period` seconds however the polls are shared out."""
+    def __init__(self, period: float):
+        self.period = period  # Average seconds between polls of a feed, as a budget
+        self.queue = []       # Heap of (due time, YouTube channel ID)
+        self.feeds = {}       # YouTube channel ID -> {"due", "interval", "failures"}
+        self.tokens = 0.0     # Requests that may be made right now
+        self.updated = None   # When tokens were last topped up
+
+    def __len__(self):
+        return len(self.feeds)
+
+    @property
+    def rate(self) -> float:
+        """Requests per second allowed by the budget"""
+        return len(self.feeds) / self.period if self.period > 0 else float("inf")
+
+    def schedule(self, channel: str, due: float):
+        self.feeds[channel]["due"] = due
+        heapq.heappush(self.queue, (due, channel))
+
+    def sync(self, channels, now: float):
+        """Start tracking new feeds and forget ones that are no longer subscribed to"""
+        channels = set(channels)
+        for channel in self.feeds.keys() - channels:
+            del self.feeds[channel]
+        for channel in channels - self.feeds.keys():
+            self.feeds[channel] = {"interval": MIN_POLL, "failures": 0}
+            # Spread new feeds out instead of polling them all at once
+            self.schedule(channel, now + random.uniform(0, min(self.period, MIN_POLL)))
+        # Drop queue entries for forgotten or rescheduled feeds once they pile up
+        if len(self.queue) > 2 * len(self.feeds) + 16:
+            self.queue = [(due, channel) for due, channel in self.queue
+                          if self.feeds.get(channel, {}).get("due") == due]
+            heapq.heapify(self.queue)
+
+    def due(self, now: float) -> list:
+        """Take the feeds that are due now, as far as the request budget allows"""
+        burst = max(1.0, self.rate * BURST)
+        if self.updated is None:
+            self.tokens = burst
+        else:
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, burst)
+        self.updated = now
+        channels = []
+        while self.queue and self.queue[0][0] <= now and self.tokens >= 1:
+            due, channel = heapq.heappop(self.queue)
+            state = self.feeds.get(channel)
+            if state is None or state.get("due") != due:
+                # Stale entry for a forgotten or rescheduled feed
+                continue
+            state["due"] = None
+            self.tokens -= 1
+            channels.append(channel)
+        return channels
+
+    def record(self, channel: str, feed, now: float, minimum: float = MIN_POLL):
+        """Schedule a feed's next poll after polling it, where feed is None if the poll failed
+
+        Successful polls are followed by at least `minimum` seconds before the next"""
+        state = self.feeds.get(channel)
+        if state is None:
+            return
+        if feed is None:
+            state["failures"] += 1
+            interval = min(MAX_POLL, state["interval"] * 2 ** state["failures"])
+        else:
+            state["failures"] = 0
+            interval = state["interval"] = max(minimum, self.cadence(feed, now))
+        self.schedule(channel, now + interval * random.uniform(1 - JITTER, 1 + JITTER))
+
+    def cadence(self, feed, now: float) -> float:
+        """Work out how often to poll a feed from its recent uploads"""
+        times = upload_times(feed)
+        if len(times) < 2:
+            return MAX_POLL
+        gap = statistics.median(b - a for a, b in zip(times, times[1:]))
+        # Channels that have gone quiet slow down gradually
+        gap = max(gap, now - times[-1])
+        return min(MAX_POLL, max(MIN_POLL, gap / POLLS_PER_UPLOAD))
+
+    def next_due(self):
+        """Get the earliest time a feed is due, if any"""
+        return self.queue[0][0] if self.queue else None
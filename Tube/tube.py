@@ -5,6 +5,9 @@ import re
 import time
 import hashlib
 import logging
+import random
+import secrets
+from collections import Counter
 
 import aiohttp
 import discord
@@ -16,6 +19,10 @@ from discord.ext import tasks
 from redbot.core import Config, bot, checks, commands
 from redbot.core.utils.chat_formatting import pagify
 
+from .history import SeenVideos
+from .scheduler import MIN_POLL, FeedScheduler
+from .websub import HUB_URL, WebSubReceiver
+
 log = logging.getLogger("red.cbd-cogs.tube")
 
 __all__ = ["UNIQUE_ID", "Tube"]
@@ -29,6 +36,23 @@ TIME_TUPLE = (*(int(x) for x in re.split(r"-|T|:|\+", TIME_DEFAULT)), 0)
 # Word tokenizer
 TOKENIZER = re.compile(r'([^\s]+)')
 
+FEED_URL = "https://www.youtube.com/feeds/videos.xml?channel_id={}"
+# Feeds fetched at the same time
+FETCH_CONCURRENCY = 32
+# Seconds allowed for each request
+FETCH_TIMEOUT = 15
+# Attempts per feed, and the delay in seconds before the first retry
+FETCH_ATTEMPTS = 3
+RETRY_DELAY = 1
+# Statuses worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Seconds between checks for feeds that are due to be polled
+POLL_TICK = 10
+# Seconds between polls of feeds whose updates are pushed, to catch missed notifications
+RECONCILE_POLL = 6 * 3600
+# Seconds between checks for WebSub leases that need renewing
+RENEW_TICK = 60
+
 class Tube(commands.Cog):
     """A YouTube subscription cog
     
@@ -38,8 +62,23 @@ class Tube(commands.Cog):
         self.bot = bot
         self.conf = Config.get_conf(self, identifier=UNIQUE_ID, force_registration=True)
         self.conf.register_guild(subscriptions=[], cache=[])
-        self.conf.register_global(interval=300, cache_size=500)
+        self.conf.register_global(interval=300, cache_size=500,
+                                  websub_callback="", websub_host="0.0.0.0", websub_port=8080,
+                                  websub_hub=HUB_URL, websub_secret="", websub_leases={})
+        self.session = None  # Shared by every feed request
+        self.index = None    # YouTube channel ID -> {subscription uid: (guild ID, Discord channel ID)}
+        self.feed_cache = {}  # YouTube channel ID -> validators, body hash and parsed feed
+        self.seen = {}        # Guild ID -> videos already posted there
+        self.fetch_stats = Counter()  # Fetch outcomes in the current cycle
+        self.last_cycle = Counter()   # Fetch outcomes in the last completed cycle
+        self.cycle_started = time.time()
+        self.scheduler = FeedScheduler(300)
+        self.websub = None   # Receives pushed updates when WebSub is enabled
+        self.saved_leases = {}  # WebSub leases as last saved to Config
+        self.posting = asyncio.Lock()  # Keeps pushed and polled updates from racing
+        self.fetch_limit = asyncio.BoundedSemaphore(FETCH_CONCURRENCY)
         self.background_get_new_videos.start()
+        self.renew_websub.start()
 
     @commands.group()
     async def tube(self, ctx: commands.Context):
@@ -76,7 +115,7 @@ class Tube(commands.Cog):
             if sub['uid'] == newSub['uid']:
                 await ctx.send("This subscription already exists!")
                 return
-        feed = feedparser.parse(await self.get_feed(newSub['id']))
+        feed = feedparser.parse(await self.get_feed(newSub['id']) or b"")
         last_video = {}
         for entry in feed["entries"]:
             if not last_video or entry["published_parsed"] > last_video["published_parsed"]:
@@ -88,8 +127,16 @@ class Tube(commands.Cog):
         except KeyError:
             await ctx.send(f"Error getting channel feed title. Make sure the ID is correct.")
             return
-        subs.append(newSub)
-        await self.conf.guild(ctx.guild).subscriptions.set(subs)
+        async with self.conf.guild(ctx.guild).subscriptions.get_lock():
+            # Subscriptions may have changed while the feed was fetched
+            subs = await self.conf.guild(ctx.guild).subscriptions()
+            if any(sub['uid'] == newSub['uid'] for sub in subs):
+                await ctx.send("This subscription already exists!")
+                return
+            subs.append(newSub)
+            await self.conf.guild(ctx.guild).subscriptions.set(subs)
+        await self.get_index()
+        self.index_subscription(ctx.guild.id, newSub)
         await ctx.send(f"Subscription added: {newSub}")
 
     @checks.admin_or_permissions(manage_guild=True)
@@ -99,7 +146,6 @@ class Tube(commands.Cog):
         """Unsubscribe a Discord channel from a YouTube channel
         
         If no Discord channel is specified and the asAnnouncement flag not set to True, the subscription will be removed from all channels"""
-        subs = await self.conf.guild(ctx.guild).subscriptions()
         unsubbed = []
         if channelDiscord:
             newSub = {'id': channelYouTube,
@@ -107,13 +153,18 @@ class Tube(commands.Cog):
             unsubTarget, unsubType = self.sub_uid(newSub), 'uid'
         else:
             unsubTarget, unsubType = channelYouTube, 'id'
-        for i, sub in enumerate(subs):
-            if sub[unsubType] == unsubTarget:
-                unsubbed.append(subs.pop(i))
-        if not len(unsubbed):
-            await ctx.send("Subscription not found")
-            return
-        await self.conf.guild(ctx.guild).subscriptions.set(subs)
+        async with self.conf.guild(ctx.guild).subscriptions.get_lock():
+            subs = await self.conf.guild(ctx.guild).subscriptions()
+            for i, sub in enumerate(subs):
+                if sub[unsubType] == unsubTarget:
+                    unsubbed.append(subs.pop(i))
+            if not len(unsubbed):
+                await ctx.send("Subscription not found")
+                return
+            await self.conf.guild(ctx.guild).subscriptions.set(subs)
+        await self.get_index()
+        for sub in unsubbed:
+            self.unindex_subscription(sub)
         await ctx.send(f"Subscription(s) removed: {unsubbed}")
 
     @checks.admin_or_permissions(manage_guild=True)
@@ -128,16 +179,17 @@ class Tube(commands.Cog):
         
         You can also remove customization by not specifying any message.
         """
-        subs = await self.conf.guild(ctx.guild).subscriptions()
-        found = False
-        for i, sub in enumerate(subs):
-            if sub['id'] == channelYouTube:
-                found = True
-                subs[i]['custom'] = customMessage
-        if not found:
-            await ctx.send("Subscription not found")
-            return
-        await self.conf.guild(ctx.guild).subscriptions.set(subs)
+        async with self.conf.guild(ctx.guild).subscriptions.get_lock():
+            subs = await self.conf.guild(ctx.guild).subscriptions()
+            found = False
+            for i, sub in enumerate(subs):
+                if sub['id'] == channelYouTube:
+                    found = True
+                    subs[i]['custom'] = customMessage
+            if not found:
+                await ctx.send("Subscription not found")
+                return
+            await self.conf.guild(ctx.guild).subscriptions.set(subs)
         await ctx.send(f"Custom message {'added' if customMessage else 'removed'}")
 
     @checks.admin_or_permissions(manage_guild=True)
@@ -145,16 +197,17 @@ class Tube(commands.Cog):
     @tube.command()
     async def rolemention(self, ctx: commands.Context, channelYouTube, rolemention: Optional[discord.Role]):
         """ Adds a role mention in front of the message """
-        subs = await self.conf.guild(ctx.guild).subscriptions()
-        found = False
-        for i, sub in enumerate(subs):
-            if sub['id'] == channelYouTube:
-                found = True
-                subs[i]['mention'] = rolemention.id
-        if not found:
-            await ctx.send("Subscription not found")
-            return
-        await self.conf.guild(ctx.guild).subscriptions.set(subs)
+        async with self.conf.guild(ctx.guild).subscriptions.get_lock():
+            subs = await self.conf.guild(ctx.guild).subscriptions()
+            found = False
+            for i, sub in enumerate(subs):
+                if sub['id'] == channelYouTube:
+                    found = True
+                    subs[i]['mention'] = rolemention.id
+            if not found:
+                await ctx.send("Subscription not found")
+                return
+            await self.conf.guild(ctx.guild).subscriptions.set(subs)
         await ctx.send(f'Role mention {"added" if rolemention else "removed" }')
              
     @commands.guild_only()
@@ -213,6 +266,82 @@ class Tube(commands.Cog):
         for guild in self.bot.guilds:
             await self._showsubs(ctx, guild)
 
+    async def get_seen(self, guild: discord.Guild):
+        """Get the videos already posted in a guild, loading them if necessary"""
+        if guild.id not in self.seen:
+            self.seen[guild.id] = SeenVideos(await self.conf.guild(guild).cache(),
+                                             await self.conf.cache_size())
+        return self.seen[guild.id]
+
+    async def get_index(self):
+        """Get the index of YouTube channel IDs to their subscribers, building it if necessary
+        
+        Subscriptions in guilds the bot has left or channels that no longer exist are left out. Unavailable guilds are kept, since their channels aren't known until they return"""
+        if self.index is None:
+            self.index = {}
+            for guild_id, data in (await self.conf.all_guilds()).items():
+                guild = self.bot.get_guild(guild_id)
+                if guild is None:
+                    continue
+                for sub in data.get("subscriptions", []):
+                    if guild.unavailable or self.bot.get_channel(int(sub["channel"]["id"])) is not None:
+                        self.index_subscription(guild_id, sub)
+        return self.index
+
+    def reachable(self, channels):
+        """Get the YouTube channels with a subscriber that can be posted to right now
+        
+        Subscribers in unavailable guilds or channels that can't be found are only skipped for now. They are removed from the index when the bot leaves the guild or the channel is deleted"""
+        remaining = []
+        for channel in channels:
+            for guild_id, channel_id in self.index.get(channel, {}).values():
+                guild = self.bot.get_guild(guild_id)
+                if guild is not None and not guild.unavailable and self.bot.get_channel(int(channel_id)):
+                    remaining.append(channel)
+                    break
+        return remaining
+
+    def unindex_where(self, condition):
+        """Drop subscribers for which `condition(guild_id, channel_id)` is true"""
+        if self.index is None:
+            return
+        for channel, subscribers in list(self.index.items()):
+            for uid, (guild_id, channel_id) in list(subscribers.items()):
+                if condition(guild_id, int(channel_id)):
+                    del subscribers[uid]
+            if not subscribers:
+                del self.index[channel]
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild: discord.Guild):
+        # Rebuild the index in case the guild has subscriptions from before
+        self.index = None
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        # Only sent when the bot leaves, not when a guild becomes unavailable
+        self.unindex_where(lambda guild_id, _: guild_id == guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        self.unindex_where(lambda _, channel_id: channel_id == channel.id)
+
+    def index_subscription(self, guild_id: int, sub: dict):
+        uid = sub.get("uid") or self.sub_uid(sub)
+        self.index.setdefault(sub["id"], {})[uid] = (guild_id, sub["channel"]["id"])
+
+    def unindex_subscription(self, sub: dict):
+        uid = sub.get("uid") or self.sub_uid(sub)
+        subscribers = self.index.get(sub["id"], {})
+        subscribers.pop(uid, None)
+        if not subscribers:
+            self.index.pop(sub["id"], None)
+
+    def subscribed_guilds(self, channels):
+        """Get the IDs of guilds subscribed to any of the given YouTube channels"""
+        return sorted({guild_id for channel in channels
+                       for guild_id, _ in self.index.get(channel, {}).values()})
+
     def sub_uid(self, subscription: dict):
         """A subscription must have a unique combination of YouTube channel ID and Discord channel"""
         try:
@@ -240,22 +369,27 @@ class Tube(commands.Cog):
     @tube.command(name="ownerupdate", hidden=True)
     async def owner_get_new_videos(self, ctx: commands.Context):
         """Update feeds and post new videos for all guilds"""
-        fetched = {}
+        feeds = await self.fetch_feeds((await self.get_index()).keys())
         for guild in self.bot.guilds:
             await ctx.send(f"Updating subscriptions for {guild}")
-            update = await self._get_new_videos(guild, fetched, ctx)
-            if not update:
-                continue
-            fetched.update(update)
+            await self._get_new_videos(guild, feeds, ctx)
 
-    async def _get_new_videos(self, guild: discord.Guild, cache: dict = {}, ctx: commands.Context = None, demo: bool = False):
+    async def _get_new_videos(self, guild: discord.Guild, cache: dict = None, ctx: commands.Context = None, demo: bool = False, fetch: bool = True):
+        """Post new videos for a guild's subscriptions
+        
+        Feeds already fetched can be passed in `cache`, keyed by YouTube channel ID. Unless `fetch` is set to False, any other feeds the guild needs are fetched too, otherwise only subscriptions to the given feeds are updated"""
+        if cache is None:
+            cache = {}
         try:
             subs = await self.conf.guild(guild).subscriptions()
-            history = await self.conf.guild(guild).cache()
+            history = await self.get_seen(guild)
         except:
             return
-        new_history = []
-        altered = False
+        altered = {}  # Subscription uid -> fields changed here
+        if fetch:
+            # Fetch every feed this guild needs at once rather than one by one
+            wanted = {sub["id"] for sub in subs if self.bot.get_channel(int(sub["channel"]["id"]))}
+            cache.update(await self.fetch_feeds(wanted - cache.keys()))
         for i, sub in enumerate(subs):
             publish = sub.get("publish", False)
             channel_id = sub["channel"]["id"]
@@ -267,12 +401,9 @@ class Tube(commands.Cog):
             if not channel.permissions_for(guild.me).send_messages:
                 log.warn(f"Not allowed to post subscription to: {channel_id}")
                 continue
-            if not sub["id"] in cache.keys():
-                try:
-                    cache[sub["id"]] = feedparser.parse(await self.get_feed(sub["id"]))
-                except Exception as e:
-                    log.exception(f"Error parsing feed for {sub.get('name', '')} ({sub['id']})")
-                    continue
+            if cache.get(sub["id"]) is None:
+                # Fetching or parsing failed and has been logged
+                continue
             last_video_time = datetime.datetime.fromtimestamp(
                 time.mktime(
                     time.strptime(
@@ -284,13 +415,10 @@ class Tube(commands.Cog):
             for entry in cache[sub["id"]]["entries"][::-1]:
                 published = datetime.datetime.fromtimestamp(time.mktime(entry.get("published_parsed", TIME_TUPLE)))
                 if not sub.get("name"):
-                    altered = True
                     sub["name"] = entry["author"]
+                    altered.setdefault(sub.get("uid") or self.sub_uid(sub), {})["name"] = sub["name"]
                 if ((published > last_video_time and not entry["yt_videoid"] in history)
                     or (demo and published > last_video_time - datetime.timedelta(seconds=1))):
-                    altered = True
-                    subs[i]["previous"] = entry["published"]
-                    new_history.append(entry["yt_videoid"])
                     # Build custom description if one is set
                     custom = sub.get("custom", False)
                     if custom:
@@ -312,26 +440,110 @@ class Tube(commands.Cog):
                         description = f"<@&{mention_id}> {description}"
                     mentions = discord.AllowedMentions(roles=True)
                     message = await channel.send(content=description, allowed_mentions=mentions)
+                    # Only videos that were actually posted count as seen, so failed posts are retried
+                    subs[i]["previous"] = entry["published"]
+                    altered.setdefault(sub.get("uid") or self.sub_uid(sub), {})["previous"] = entry["published"]
+                    history.add(entry["yt_videoid"])
                     if publish:
                         await message.publish()
         if altered:
-            await self.conf.guild(guild).subscriptions.set(subs)
-            await self.conf.guild(guild).cache.set(list(set([*history, *new_history])))
+            # Commands may have changed subscriptions while videos were posted, so only the fields changed here are saved
+            async with self.conf.guild(guild).subscriptions.get_lock():
+                current = await self.conf.guild(guild).subscriptions()
+                for sub in current:
+                    sub.update(altered.get(sub.get("uid") or self.sub_uid(sub), {}))
+                await self.conf.guild(guild).subscriptions.set(current)
+        if history.changed:
+            await self.conf.guild(guild).cache.set(history.to_list())
         self.has_warned_about_invalid_channels = True
         return cache
 
     @checks.is_owner()
     @tube.command(name="setinterval", hidden=True)
     async def set_interval(self, ctx: commands.Context, interval: int):
-        """Set the interval in seconds at which to check for updates
+        """Set the polling budget as an interval in seconds
+        
+        Feeds are polled as often in total as if each was checked once per interval, but channels that upload often are checked more frequently than dormant ones
         
         Very low values will probably get you rate limited
         
         Default is 300 seconds (5 minutes)"""
         await self.conf.interval.set(interval)
-        self.background_get_new_videos.change_interval(seconds=interval)
+        self.scheduler.period = interval
         await ctx.send(f"Interval set to {await self.conf.interval()}")
 
+    @checks.is_owner()
+    @tube.command(name="stats", hidden=True)
+    async def show_stats(self, ctx: commands.Context):
+        """Show how feeds were fetched in the last update cycle
+        
+        Feeds that weren't modified or were downloaded unchanged are not parsed again"""
+        stats = self.last_cycle
+        requests = stats["downloaded"] + stats["not modified"] + stats["failed"]
+        scheduler = self.scheduler
+        await ctx.send(f"Last cycle: {requests} feeds requested, "
+                       f"{stats['not modified']} not modified, "
+                       f"{stats['unchanged']} downloaded unchanged, "
+                       f"{stats['parsed']} parsed, {stats['failed']} failed\n"
+                       f"Scheduling {len(scheduler)} feeds within "
+                       f"{scheduler.rate * 3600:.0f} requests per hour")
+        if self.websub is not None:
+            now = time.time()
+            active = sum(self.websub.active(channel, now) for channel in self.index or {})
+            stats = self.websub.stats
+            await ctx.send(f"WebSub: {active} of {len(scheduler)} feeds pushed, "
+                           f"{stats['verified']} verifications, {stats['received']} notifications, "
+                           f"{stats['rejected']} rejected")
+
+    @checks.is_owner()
+    @tube.command(name="setwebsub", hidden=True)
+    async def set_websub(self, ctx: commands.Context, callback: str, port: int = 8080, host: str = "0.0.0.0", hub: str = HUB_URL):
+        """Receive new videos from a WebSub hub instead of waiting to poll for them
+        
+        The bot listens on `host` and `port` for the hub, which must be able to reach it at the public `callback` URL, e.g. through a reverse proxy. Feeds with pushed updates are still polled every few hours in case a notification goes missing
+        
+        Use `off` as the callback to go back to polling only"""
+        if callback.lower() == "off":
+            callback = ""
+        if (callback, hub) != (await self.conf.websub_callback(), await self.conf.websub_hub()):
+            # Leases were granted for the old callback URLs
+            await self.conf.websub_leases.set({})
+        await self.conf.websub_callback.set(callback)
+        await self.conf.websub_host.set(host)
+        await self.conf.websub_port.set(port)
+        await self.conf.websub_hub.set(hub)
+        try:
+            await self.start_websub()
+        except OSError as e:
+            await ctx.send(f"Couldn't listen on {host}:{port}: {e}")
+            return
+        await ctx.send(f"WebSub {'enabled at ' + callback if callback else 'disabled'}")
+
+    async def start_websub(self):
+        """Start or restart the WebSub receiver from the configured settings"""
+        if self.websub is not None:
+            await self.websub.stop()
+            self.websub = None
+        callback = await self.conf.websub_callback()
+        if not callback:
+            return
+        secret = await self.conf.websub_secret()
+        if not secret:
+            secret = secrets.token_hex(32)
+            await self.conf.websub_secret.set(secret)
+        self.saved_leases = await self.conf.websub_leases()
+        websub = WebSubReceiver(callback, secret, lambda channel: channel in (self.index or {}),
+                                self.receive_feed, await self.conf.websub_hub(), self.saved_leases)
+        await websub.start(await self.conf.websub_host(), await self.conf.websub_port())
+        self.websub = websub
+
+    async def receive_feed(self, channel: str, feed):
+        """Post new videos from a feed pushed by the WebSub hub"""
+        if not feed.get("entries"):
+            # Deleted videos are announced without entries
+            return
+        await self.post_new_videos([channel], {channel: feed})
+
     @checks.is_owner()
     @tube.command(name="setcache", hidden=True)
     async def set_cache(self, ctx: commands.Context, size: int):
@@ -341,43 +553,163 @@ class Tube(commands.Cog):
         
         Default is 500"""
         await self.conf.cache_size.set(size)
+        # Loaded histories shrink now and are saved with their guild's next update
+        for history in self.seen.values():
+            history.resize(size)
         await ctx.send(f"Cache size set to {await self.conf.cache_size()}")
     
-    async def fetch(self, session, url):
-        try:
-            async with session.get(url) as response:
-                return await response.read()
-        except aiohttp.client_exceptions.ClientConnectionError as e:
-            log.exception(f"Fetch failed for url {url}: ", exc_info=e)
-            return None
+    async def fetch(self, session, url, headers: dict = None):
+        """Fetch a URL, retrying with exponential backoff on errors that may be temporary
+        
+        Each attempt counts towards the limit on concurrent requests, but waiting to retry doesn't, so failing feeds don't hold up healthy ones
+        
+        Returns the response status, headers and body, or None if every attempt failed"""
+        delay = RETRY_DELAY
+        for attempt in range(1, FETCH_ATTEMPTS + 1):
+            try:
+                async with self.fetch_limit, session.get(url, headers=headers,
+                                                         timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT)) as response:
+                    if response.status not in RETRY_STATUSES:
+                        return response.status, response.headers, await response.read()
+                    error = f"HTTP {response.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+            if attempt == FETCH_ATTEMPTS:
+                break
+            # Jitter keeps retries from many feeds arriving in lockstep
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay *= 2
+        log.error(f"Fetch failed for url {url} after {FETCH_ATTEMPTS} attempts: {error}")
+        return None
+
+    def get_session(self):
+        """Get the session shared by feed requests, creating it if necessary"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=FETCH_CONCURRENCY)
+            self.session = aiohttp.ClientSession(connector=connector)
+        return self.session
 
     async def get_feed(self, channel):
         """Fetch data from a feed"""
-        async with aiohttp.ClientSession() as session:
-            res = await self.fetch(
-                session,
-                f"https://www.youtube.com/feeds/videos.xml?channel_id={channel}"
-            )
-        return res
+        response = await self.fetch(self.get_session(), FEED_URL.format(channel))
+        if response is None or response[0] != 200:
+            return None
+        return response[2]
 
-    def cog_unload(self):
+    async def get_parsed_feed(self, channel):
+        """Fetch and parse a feed, reusing the last parsed copy if it hasn't changed
+        
+        The previous response's ETag and Last-Modified are sent so YouTube can answer 304 Not Modified, and bodies identical to the last one aren't parsed again"""
+        cached = self.feed_cache.get(channel, {})
+        headers = {}
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("modified"):
+            headers["If-Modified-Since"] = cached["modified"]
+        response = await self.fetch(self.get_session(), FEED_URL.format(channel), headers)
+        if response is None:
+            self.fetch_stats["failed"] += 1
+            return None
+        status, response_headers, data = response
+        if status == 304 and "feed" in cached:
+            self.fetch_stats["not modified"] += 1
+            return cached["feed"]
+        if status != 200:
+            # Error pages aren't feeds, and their validators mustn't replace the last good ones
+            log.error(f"Fetch failed for feed {channel}: HTTP {status}")
+            self.fetch_stats["failed"] += 1
+            return None
+        self.fetch_stats["downloaded"] += 1
+        digest = hashlib.sha256(data).hexdigest()
+        if digest == cached.get("digest"):
+            self.fetch_stats["unchanged"] += 1
+            feed = cached["feed"]
+        else:
+            try:
+                feed = feedparser.parse(data)
+            except Exception:
+                log.exception(f"Error parsing feed for {channel}")
+                self.fetch_stats["failed"] += 1
+                return None
+            self.fetch_stats["parsed"] += 1
+        self.feed_cache[channel] = {"etag": response_headers.get("ETag"),
+                                    "modified": response_headers.get("Last-Modified"),
+                                    "digest": digest,
+                                    "feed": feed}
+        return feed
+
+    async def fetch_feeds(self, channels):
+        """Fetch and parse several feeds concurrently
+        
+        Returns a dict of YouTube channel ID to parsed feed, or None for feeds that failed"""
+        channels = list(channels)
+        feeds = await asyncio.gather(*(self.get_parsed_feed(channel) for channel in channels))
+        return dict(zip(channels, feeds))
+
+    async def cog_unload(self):
         self.background_get_new_videos.cancel()
+        self.renew_websub.cancel()
+        if self.session is not None:
+            await self.session.close()
+        if self.websub is not None:
+            await self.websub.stop()
+
+    async def post_new_videos(self, channels, feeds: dict):
+        """Post new videos from the given feeds to every guild subscribed to them"""
+        async with self.posting:
+            for guild_id in self.subscribed_guilds(channels):
+                guild = self.bot.get_guild(guild_id)
+                if guild is None or guild.unavailable:
+                    continue
+                await self._get_new_videos(guild, feeds, fetch=False)
 
-    @tasks.loop(seconds=1)
+    @tasks.loop(seconds=POLL_TICK)
     async def background_get_new_videos(self):
-        fetched = {}
-        cache_size = await self.conf.cache_size()
-        for guild in self.bot.guilds:
-            update = await self._get_new_videos(guild, fetched)
-            if not update:
-                continue
-            fetched.update(update)
-            # Truncate video ID cache
-            cache = await self.conf.guild(guild).cache()
-            await self.conf.guild(guild).cache.set(cache[-cache_size:])
+        index = await self.get_index()
+        now = time.time()
+        if now - self.cycle_started >= self.scheduler.period:
+            # Report fetch outcomes over one budget interval at a time
+            self.last_cycle, self.fetch_stats = self.fetch_stats, Counter()
+            self.cycle_started = now
+            log.debug(f"Feed cycle: {dict(self.last_cycle)}")
+        self.scheduler.sync(index.keys(), now)
+        # Forget feeds nobody is subscribed to any more
+        for channel in self.feed_cache.keys() - index.keys():
+            del self.feed_cache[channel]
+        channels = self.reachable(self.scheduler.due(now))
+        if not channels:
+            return
+        # Each due feed is fetched and parsed once, then shared by every subscribed guild
+        feeds = await self.fetch_feeds(channels)
+        now = time.time()
+        for channel, feed in feeds.items():
+            # Feeds with pushed updates only need polling to reconcile
+            pushed = self.websub is not None and self.websub.active(channel, now)
+            self.scheduler.record(channel, feed, now, RECONCILE_POLL if pushed else MIN_POLL)
+        await self.post_new_videos(channels, feeds)
+
+    @tasks.loop(seconds=RENEW_TICK)
+    async def renew_websub(self):
+        """Renew WebSub leases apart from polling, so a slow hub can't hold up feeds"""
+        websub = self.websub
+        if websub is None:
+            return
+        index = await self.get_index()
+        await websub.renew(self.get_session(), index.keys())
+        # Leases change as the hub verifies requests, which happens between renewals
+        if websub.leases != self.saved_leases:
+            self.saved_leases = dict(websub.leases)
+            await self.conf.websub_leases.set(self.saved_leases)
+
+    @renew_websub.before_loop
+    async def wait_for_websub(self):
+        await self.bot.wait_until_red_ready()
 
     @background_get_new_videos.before_loop
     async def wait_for_red(self):
         await self.bot.wait_until_red_ready()
-        interval = await self.conf.interval()
-        self.background_get_new_videos.change_interval(seconds=interval)
+        self.scheduler.period = await self.conf.interval()
+        try:
+            await self.start_websub()
+        except OSError:
+            log.exception("Couldn't start the WebSub receiver, falling back to polling")
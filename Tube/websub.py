@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import hmac
+import logging
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+import feedparser
+from aiohttp import web
+
+log = logging.getLogger("red.cbd-cogs.tube")
+
+__all__ = ["HUB_URL", "TOPIC_URL", "WebSubReceiver"]
+
+HUB_URL = "https://pubsubhubbub.appspot.com/subscribe"
+TOPIC_URL = "https://www.youtube.com/xml/feeds/videos.xml?channel_id={}"
+# Lease requested from the hub, which may grant a shorter one
+LEASE_SECONDS = 5 * 86400
+# Seconds before a lease expires that it is renewed
+RENEW_MARGIN = 3600
+# Seconds to wait for a hub to verify a request before sending it again
+VERIFY_TIMEOUT = 600
+# Subscription requests sent to the hub at once
+HUB_CONCURRENCY = 8
+# Largest notification accepted, in bytes
+MAX_NOTIFICATION = 1024 * 1024
+# Signature algorithms a hub may use
+SIGNATURES = {"sha1", "sha256", "sha384", "sha512"}
+
+
+class WebSubReceiver:
+    """Receives pushed feed updates from a WebSub (PubSubHubbub) hub
+
+    Each YouTube channel gets its own callback URL under `callback` and its own secret derived from `secret`, so notifications can be matched to their topic and checked for a valid signature. Leases are renewed from `renew`, which also unsubscribes from channels that are no longer wanted.
+
+    `wanted` is called with a YouTube channel ID to check whether it is still subscribed to, and `on_feed` is awaited with the channel ID and the parsed notification. `leases` restores the leases saved from an earlier receiver with the same callback and hub."""
+    def __init__(self, callback: str, secret: str, wanted, on_feed, hub: str = HUB_URL, leases: dict = None):
+        self.callback = callback.rstrip("/")
+        self.secret = secret.encode()
+        self.wanted = wanted
+        self.on_feed = on_feed
+        self.hub = hub
+        self.leases = dict(leases or {})  # YouTube channel ID -> when its lease expires
+        self.requested = {}  # YouTube channel ID -> (mode, when the hub was asked)
+        self.stats = {"verified": 0, "received": 0, "rejected": 0}
+        self.runner = None
+        self.hub_limit = asyncio.Semaphore(HUB_CONCURRENCY)
+
+    def topic(self, channel: str):
+        return TOPIC_URL.format(channel)
+
+    def callback_url(self, channel: str):
+        return f"{self.callback}/{channel}"
+
+    def channel_secret(self, channel: str):
+        """Get the secret shared with the hub for one channel's subscription"""
+        return hmac.new(self.secret, channel.encode(), hashlib.sha256).hexdigest()
+
+    def verify_signature(self, channel: str, body: bytes, signature: str):
+        """Check an X-Hub-Signature header against a notification body"""
+        method, _, digest = (signature or "").partition("=")
+        if method not in SIGNATURES:
+            return False
+        expected = hmac.new(self.channel_secret(channel).encode(), body, method).hexdigest()
+        return hmac.compare_digest(expected, digest)
+
+    async def start(self, host: str, port: int):
+        """Start listening for the hub"""
+        app = web.Application(client_max_size=MAX_NOTIFICATION)
+        path = urlsplit(self.callback).path.rstrip("/")
+        app.router.add_get(path + "/{channel}", self.handle_verify)
+        app.router.add_post(path + "/{channel}", self.handle_notify)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        log.info(f"Listening for WebSub notifications on {host}:{port}{path}")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle_verify(self, request: web.Request):
+        """Confirm a subscription change the hub is checking, or report a denied one"""
+        channel = request.match_info["channel"]
+        query = request.query
+        mode = query.get("hub.mode")
+        if query.get("hub.topic") != self.topic(channel):
+            return web.Response(status=404)
+        if mode == "denied":
+            log.warning(f"WebSub hub denied subscription to {channel}: {query.get('hub.reason')}")
+            self.leases.pop(channel, None)
+            self.requested.pop(channel, None)
+            return web.Response()
+        # Only confirm changes that match what is wanted now
+        if mode not in ("subscribe", "unsubscribe") or (mode == "subscribe") != self.wanted(channel):
+            return web.Response(status=404)
+        self.requested.pop(channel, None)
+        if mode == "subscribe":
+            try:
+                lease = int(query.get("hub.lease_seconds", LEASE_SECONDS))
+            except ValueError:
+                lease = LEASE_SECONDS
+            self.leases[channel] = time.time() + lease
+        else:
+            self.leases.pop(channel, None)
+        self.stats["verified"] += 1
+        return web.Response(text=query.get("hub.challenge", ""))
+
+    async def handle_notify(self, request: web.Request):
+        """Accept a pushed feed, ignoring it unless it was signed with the channel's secret"""
+        channel = request.match_info["channel"]
+        body = await request.read()
+        # Hubs expect success even for bad signatures, so they can't probe for the secret
+        if not self.wanted(channel) or not self.verify_signature(
+                channel, body, request.headers.get("X-Hub-Signature")):
+            self.stats["rejected"] += 1
+            log.debug(f"Ignored WebSub notification for {channel}")
+            return web.Response(status=202)
+        self.stats["received"] += 1
+        feed = feedparser.parse(body)
+        # Posting can be slow, and the hub shouldn't have to wait for it
+        asyncio.create_task(self.deliver(channel, feed))
+        return web.Response(status=202)
+
+    async def deliver(self, channel: str, feed):
+        try:
+            await self.on_feed(channel, feed)
+        except Exception:
+            log.exception(f"Error handling WebSub notification for {channel}")
+
+    async def request(self, session: aiohttp.ClientSession, channel: str, mode: str = "subscribe"):
+        """Ask the hub to subscribe or unsubscribe, returning whether it accepted the request
+
+        The change only takes effect once the hub has verified it with the callback"""
+        data = {"hub.callback": self.callback_url(channel),
+                "hub.mode": mode,
+                "hub.topic": self.topic(channel),
+                "hub.verify": "async"}
+        if mode == "subscribe":
+            data["hub.lease_seconds"] = str(LEASE_SECONDS)
+            data["hub.secret"] = self.channel_secret(channel)
+        self.requested[channel] = (mode, time.time())
+        try:
+            async with self.hub_limit, session.post(self.hub, data=data,
+                                                    timeout=aiohttp.ClientTimeout(total=30)) as response:
+                if response.status in (202, 204):
+                    return True
+                error = f"HTTP {response.status}: {(await response.text())[:200]}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = repr(e)
+        log.error(f"WebSub {mode} request for {channel} failed: {error}")
+        return False
+
+    def active(self, channel: str, now: float = None):
+        """Check whether a channel's updates are being pushed"""
+        return self.leases.get(channel, 0) > (now or time.time())
+
+    async def renew(self, session: aiohttp.ClientSession, channels, now: float = None):
+        """Subscribe to channels without a lease or whose lease is about to expire, and unsubscribe from unwanted ones"""
+        now = now or time.time()
+        channels = set(channels)
+        changes = []
+        for channel in channels | self.leases.keys():
+            mode = "subscribe" if channel in channels else "unsubscribe"
+            if mode == "subscribe" and self.leases.get(channel, 0) > now + RENEW_MARGIN:
+                continue
+            requested_mode, requested = self.requested.get(channel, (None, 0))
+            if requested_mode == mode and now - requested < VERIFY_TIMEOUT:
+                continue
+            changes.append((channel, mode))
+        await asyncio.gather(*(self.request(session, channel, mode) for channel, mode in changes))
+        # Leases of unwanted channels are dropped even if the hub can't be reached
+        for channel in self.leases.keys() - channels:
+            if self.leases[channel] <= now:
+                del self.leases[channel]
@@ -0,0 +1,24 @@
+""" Self-checks that run the cogs against local stand-ins for the services they use
+
+Run them from the repository root, e.g. `python -m checks.scrub_refresh`. \
+    This package isn't a cog, so Red never installs or loads it.
+"""
+
+__all__ = ["Checklist"]
+
+
+class Checklist:
+    """ Prints the outcome of each check and remembers the ones that failed """
+    def __init__(self):
+        self.failures = []
+
+    def __call__(self, ok: bool, description: str):
+        print(f"{'ok' if ok else 'FAILED'}: {description}")
+        if not ok:
+            self.failures.append(description)
+
+    def status(self) -> int:
+        """ Print a summary, returning the exit status for the run """
+        failures = self.failures
+        print(f"{len(failures)} checks failed" if failures else "All checks passed")
+        return 1 if failures else 0
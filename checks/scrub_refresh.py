@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+""" Check that rules refreshes only reparse files that changed
+
+A local server hands out a rules file with ETag and Last-Modified \
+    validators, and the cog's own update path is run against it with an \
+    in-memory Config. Run it from the repository root, e.g.
+
+    python -m checks.scrub_refresh
+    python -m checks.scrub_refresh --rules data.min.json
+
+It checks that a 304 Not Modified, or an identical file served without \
+    validators, keeps the current rules without parsing or compiling them \
+    again, and that a changed file served with a 200 replaces them. The \
+    exit status is 1 if any check fails.
+"""
+import argparse
+import asyncio
+import copy
+import hashlib
+import json
+import sys
+from email.utils import formatdate
+from pathlib import Path
+from types import SimpleNamespace
+
+from aiohttp import web
+
+from Scrub import scrub
+from Scrub.benchmark import PINNED_RULES, load_rules
+
+from . import Checklist
+
+
+class MemoryValue:
+    """ A global Config value kept in memory """
+    def __init__(self, data: dict, name: str):
+        self.data = data
+        self.name = name
+
+    async def __call__(self):
+        return copy.deepcopy(self.data[self.name])
+
+    async def set(self, value):
+        # Round trip through JSON like Red's drivers do
+        self.data[self.name] = json.loads(json.dumps(value))
+
+
+class MemoryConfig:
+    """ Just enough of Red's Config for rules updates, kept in memory """
+    def __init__(self):
+        self.values = {}
+
+    @classmethod
+    def get_conf(cls, *args, **kwargs):
+        return cls()
+
+    def register_global(self, **defaults):
+        self.values.update(defaults)
+
+    def __getattr__(self, name: str):
+        values = self.__dict__.get("values", {})
+        if name not in values:
+            raise AttributeError(name)
+        return MemoryValue(values, name)
+
+    async def all(self):
+        return copy.deepcopy(self.values)
+
+
+class RulesServer:
+    """ Serves one rules file, answering conditional requests like a static file host """
+    def __init__(self, rules: dict):
+        self.validators = True
+        self.statuses = []
+        self.publish(rules, 0)
+
+    def publish(self, rules: dict, modified: float):
+        self.body = json.dumps(rules).encode()
+        self.etag = f'"{hashlib.sha256(self.body).hexdigest()[:16]}"'
+        self.last_modified = formatdate(modified, usegmt=True)
+
+    async def handle(self, request: web.Request):
+        if self.validators and (request.headers.get("If-None-Match") == self.etag
+                                or request.headers.get("If-Modified-Since") == self.last_modified):
+            response = web.Response(status=304)
+        elif self.validators:
+            response = web.Response(body=self.body, content_type="application/json",
+                                    headers={"ETag": self.etag, "Last-Modified": self.last_modified})
+        else:
+            response = web.Response(body=self.body, content_type="application/json")
+        self.statuses.append(response.status)
+        return response
+
+    async def start(self, host: str):
+        app = web.Application()
+        app.router.add_get("/rules.json", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/rules.json"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+async def run(args, check: Checklist):
+    """ Run every check against the cog's update path """
+    rules = load_rules(args.rules)
+    server = RulesServer(rules)
+    url = await server.start(args.host)
+    compiled = []
+    compile_rules = scrub.compile_rules
+
+    def counted(data):
+        compiled.append(data)
+        return compile_rules(data)
+
+    scrub.Config = MemoryConfig
+    scrub.compile_rules = counted
+    bot = SimpleNamespace(wait_until_red_ready=asyncio.Event().wait)
+    cog = scrub.Scrub(bot)
+    try:
+        changed = await cog._update(url)
+        check(changed and server.statuses == [200] and cog.rules_data == rules and len(compiled) == 1,
+              "first download is parsed and installed")
+        version = cog.version
+
+        changed = await cog._update(url)
+        check(server.statuses[-1] == 304, "validators are sent and the server answers 304")
+        check(not changed and cog.version == version and len(compiled) == 1,
+              "304 keeps the current rules without reparsing")
+
+        server.validators = False
+        changed = await cog._update(url)
+        check(server.statuses[-1] == 200 and not changed and cog.version == version and len(compiled) == 1,
+              "identical file without validators isn't reparsed")
+        server.validators = True
+
+        updated = copy.deepcopy(rules)
+        updated["providers"]["refreshcheck"] = {"urlPattern": r"^https?://refresh\.invalid",
+                                                "rules": ["tracking"]}
+        server.publish(updated, 86400)
+        changed = await cog._update(url)
+        check(server.statuses[-1] == 200 and changed and cog.version == version + 1
+              and len(compiled) == 2, "changed file is parsed with a 200")
+        check(cog.rules_data == updated and await cog.conf.rules() == updated,
+              "changed file replaces the rules")
+        check(scrub.clean_url("https://refresh.invalid/?tracking=1&id=2", cog.compiled)
+              == "https://refresh.invalid/?id=2", "new rules are used for cleaning")
+        validators = await cog.conf.validators()
+        check(validators["etag"] == server.etag and validators["last_modified"] == server.last_modified,
+              "new validators are recorded")
+    finally:
+        scrub.compile_rules = compile_rules
+        await cog.cog_unload()
+        await server.stop()
+
+
+def main(args) -> int:
+    check = Checklist()
+    asyncio.run(run(args, check))
+    return check.status()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m checks.scrub_refresh",
+                                     description="Check conditional rules refreshes")
+    parser.add_argument("--rules", type=Path, default=PINNED_RULES,
+                        help="ClearURLs rules file (default: the pinned copy)")
+    parser.add_argument("--host", default="127.0.0.1", help="address to serve the rules on")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))
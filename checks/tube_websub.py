@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Check the WebSub receiver against a local stand-in for YouTube's hub
+
+The hub accepts subscription requests, verifies them with a challenge like the real one and signs the feeds it publishes with each subscriber's secret. Run it from the repository root:
+
+    python -m checks.tube_websub
+
+It subscribes a receiver, publishes signed, forged and unwanted notifications to it, then unsubscribes, and exits with status 1 if the receiver handled any of them wrongly."""
+import argparse
+import asyncio
+import hmac
+import secrets
+import sys
+import time
+
+import aiohttp
+from aiohttp import web
+
+from Tube.websub import TOPIC_URL, WebSubReceiver
+
+from . import Checklist
+
+__all__ = ["LocalHub"]
+
+FEED = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns:yt="http://www.youtube.com/xml/schemas/2015" xmlns="http://www.w3.org/2005/Atom">
+ <entry>
+  <id>yt:video:{video}</id>
+  <yt:videoId>{video}</yt:videoId>
+  <yt:channelId>{channel}</yt:channelId>
+  <title>Video {video}</title>
+  <link rel="alternate" href="https://www.youtube.com/watch?v={video}"/>
+  <published>2024-01-01T00:00:00+00:00</published>
+ </entry>
+</feed>"""
+
+
+class LocalHub:
+    """A minimal WebSub hub that verifies subscribers and signs what it publishes"""
+    def __init__(self):
+        self.subscriptions = {}  # Topic -> (callback, secret, when the lease expires)
+        self.verifications = []  # (topic, mode, whether the subscriber confirmed it)
+        self.runner = None
+        self.url = None
+        self.tasks = set()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        app = web.Application()
+        app.router.add_post("/subscribe", self.handle_subscribe)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/subscribe"
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle_subscribe(self, request: web.Request):
+        form = await request.post()
+        mode = form.get("hub.mode")
+        if mode not in ("subscribe", "unsubscribe") or not form.get("hub.callback") or not form.get("hub.topic"):
+            return web.Response(status=400)
+        # Like the real hub, requests are accepted first and verified afterwards
+        task = asyncio.create_task(self.verify(dict(form)))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response(status=202)
+
+    async def verify(self, form: dict):
+        topic, mode, callback = form["hub.topic"], form["hub.mode"], form["hub.callback"]
+        challenge = secrets.token_hex(16)
+        params = {"hub.mode": mode, "hub.topic": topic, "hub.challenge": challenge}
+        if mode == "subscribe":
+            params["hub.lease_seconds"] = form.get("hub.lease_seconds", "86400")
+        async with aiohttp.ClientSession() as session:
+            async with session.get(callback, params=params) as response:
+                confirmed = response.status == 200 and await response.text() == challenge
+        self.verifications.append((topic, mode, confirmed))
+        if not confirmed:
+            return
+        if mode == "subscribe":
+            self.subscriptions[topic] = (callback, form.get("hub.secret", ""),
+                                         time.time() + int(params["hub.lease_seconds"]))
+        else:
+            self.subscriptions.pop(topic, None)
+
+    async def publish(self, topic: str, body: bytes, secret: str = None):
+        """Push a feed to a topic's subscriber, returning the response status
+
+        `secret` overrides the subscriber's own, to send a forged notification"""
+        callback, subscribed_secret, _ = self.subscriptions[topic]
+        signature = hmac.new((subscribed_secret if secret is None else secret).encode(),
+                             body, "sha1").hexdigest()
+        async with aiohttp.ClientSession() as session:
+            async with session.post(callback, data=body,
+                                    headers={"Content-Type": "application/atom+xml",
+                                             "X-Hub-Signature": f"sha1={signature}"}) as response:
+                return response.status
+
+    async def send_verification(self, callback: str, topic: str, mode: str = "subscribe"):
+        """Ask a callback to confirm a change nobody requested, returning whether it did"""
+        challenge = secrets.token_hex(16)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(callback, params={"hub.mode": mode, "hub.topic": topic,
+                                                     "hub.challenge": challenge}) as response:
+                return response.status == 200 and await response.text() == challenge
+
+
+async def wait_for(condition, timeout: float = 5):
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+async def run(args, check: Checklist):
+    """Run every check against a receiver subscribed to the local hub"""
+    channel, other = "UCchecksubscribed0000000", "UCcheckunsubscribed00000"
+    wanted = {channel}
+    received = []
+
+    async def on_feed(channel_id, feed):
+        received.append((channel_id, [entry.get("yt_videoid") for entry in feed.get("entries", [])]))
+
+    hub = LocalHub()
+    await hub.start(args.host)
+    callback = f"http://{args.host}:{args.port}/websub"
+    receiver = WebSubReceiver(callback, secrets.token_hex(32), wanted.__contains__, on_feed, hub.url)
+    await receiver.start(args.host, args.port)
+    try:
+        async with aiohttp.ClientSession() as session:
+            await receiver.renew(session, wanted)
+            topic = TOPIC_URL.format(channel)
+            check(await wait_for(lambda: receiver.active(channel)), "subscription is verified and leased")
+            check((topic, "subscribe", True) in hub.verifications, "challenge is echoed to the hub")
+
+            body = FEED.format(channel=channel, video="checkvideo1").encode()
+            check(await hub.publish(topic, body) == 202, "signed notification is accepted")
+            check(await wait_for(lambda: received), "signed notification is delivered")
+            check(received[:1] == [(channel, ["checkvideo1"])], "delivered feed is parsed")
+
+            body = FEED.format(channel=channel, video="checkvideo2").encode()
+            await hub.publish(topic, body, secret="forged")
+            await asyncio.sleep(0.1)
+            check(len(received) == 1 and receiver.stats["rejected"] == 1, "forged notification is ignored")
+
+            check(not await hub.send_verification(receiver.callback_url(other), TOPIC_URL.format(other)),
+                  "unrequested subscription is refused")
+            check(not await hub.send_verification(receiver.callback_url(channel), TOPIC_URL.format(other)),
+                  "verification for another topic is refused")
+
+            wanted.clear()
+            await receiver.renew(session, wanted)
+            check(await wait_for(lambda: not receiver.active(channel)), "unsubscription is verified")
+            check(topic not in hub.subscriptions, "hub drops the subscription")
+    finally:
+        await receiver.stop()
+        await hub.stop()
+
+
+def main(args) -> int:
+    check = Checklist()
+    asyncio.run(run(args, check))
+    return check.status()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m checks.tube_websub",
+                                     description="Check the WebSub receiver against a local hub")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="port for the receiver")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(main(parse_args()))